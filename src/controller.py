@@ -4,6 +4,9 @@ Controller script for condenser water setpoint.
 
 from argparse import ArgumentParser, Namespace
 from configparser import ConfigParser
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import importlib
 import itertools
 import os
@@ -11,7 +14,9 @@ import sys
 from pprint import pformat
 import threading as th
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import Tuple, Mapping, FrozenSet, TYPE_CHECKING
 
 # Issue on Windows where python does not catch keyboard interrupt b/c
 # scipy/sklearn (using intel MLK installed via anaconda) imports do their own
@@ -19,11 +24,15 @@ from datetime import datetime, timedelta
 # https://github.com/ContinuumIO/anaconda-issues/issues/905
 os.environ['FOR_DISABLE_CONSOLE_CTRL_HANDLER'] = '1'
 
-import numpy as np
-import pytz
+# numpy, and the controller modules and their dependencies, are imported when
+# needed so the script starts quickly. See --profile-imports.
+if TYPE_CHECKING:
+    import numpy as np
 
 from utils.logs import get_logger, make_logger
 from utils.credentials import get_credentials
+from utils.schedule import IntervalScheduler
+from utils.script import profile_imports
 
 
 SOURCECODE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -71,24 +80,41 @@ def make_arguments() -> ArgumentParser:
                         action='store_true', help='Exit after one action to test script.')
     parser.add_argument('-n', '--no-network', required=False, default=False,
                         action='store_true', help='For testing code execution: no API calls.')
+    parser.add_argument('-a', '--asyncio', required=False, default=False, action='store_true',
+                        help=('Run all controllers as tasks on one event loop instead of '
+                              'one thread per controller.'))
+    parser.add_argument('-w', '--workers', type=int, required=False, default=4,
+                        help='Maximum concurrent state requests in --asyncio mode.')
+    parser.add_argument('--profile-imports', required=False, default=False, action='store_true',
+                        help=('Run the script under `python -X importtime` and print the '
+                              'slowest imports. Use with --dry-run to time the start up.'))
     
     return parser
 
 
 
-def get_settings(parsed_args: Namespace, section: str='DEFAULT', write_settings=False) -> dict:
+def read_settings(parsed_args: Namespace) -> ConfigParser:
+    cfg = ConfigParser(allow_no_value=True)
+    if parsed_args.settings is None:
+        raise ValueError('No settings file provided.')
+    cfg.read(parsed_args.settings)
+    return cfg
+
+
+
+def get_settings(parsed_args: Namespace, section: str='DEFAULT', write_settings=False,
+                 cfg: ConfigParser=None) -> dict:
     # Combines command line flags with settings parsed from settings ini file.
     # Command line takes precedence. Values set in command line are not over-
     # written by ini file.
     # `settings` is a dictionary created from the commandline args + ini DEFAULT section
     # + the ini section specified in `section` argument. The values are not limited to
     # strings but are processed from the raw ini str values.
+    # If `cfg` is provided, it is used instead of reading the settings file.
     settings = {}
     # try reading them, if error, return previous settings
-    cfg = ConfigParser(allow_no_value=True)
-    if parsed_args.settings is None:
-        raise ValueError('No settings file provided.')
-    cfg.read(parsed_args.settings)
+    if cfg is None:
+        cfg = read_settings(parsed_args)
     # Read DEFAULT settings, then other section, if provided
     sections = ('DEFAULT',) if (section=='DEFAULT' or section not in cfg) else ('DEFAULT', section)
     for (setting, value) in itertools.chain.from_iterable([cfg[sec].items() for sec in sections]):
@@ -96,13 +122,21 @@ def get_settings(parsed_args: Namespace, section: str='DEFAULT', write_settings=
         # and which had non empty values
         # if (setting not in settings) or (settings.get(setting) is None):
         # Float conversion
-        if setting in ('stepsize', 'window', 'interval', 'tolerance'):
+        if setting in ('stepsize', 'window', 'interval', 'tolerance',
+                       'schedule_offset', 'schedule_jitter'):
             settings[setting] = float(value)
+        # Optional float conversion
+        elif setting in ('cache_quantum', 'cache_ttl'):
+            settings[setting] = float(value) if value else None
         # Integer conversion
-        elif setting in ('logs_email_batchsize', 'port'):
+        elif setting in ('logs_email_batchsize', 'port', 'cache_size'):
             settings[setting] = int(value)
+        # Boolean conversion
+        elif setting in ('background_update',):
+            settings[setting] = cfg.BOOLEAN_STATES[value.lower()]
         # Tuple[int, int] conversion
         elif setting=='bounds':
+            import numpy as np
             settings[setting] = np.asarray([tuple(map(float, value.split(',')))])
         # Case-sensitive strings
         elif setting=='target':
@@ -142,7 +176,93 @@ def get_settings(parsed_args: Namespace, section: str='DEFAULT', write_settings=
 
 
 
-def put_control_action(action: np.ndarray, **settings):
+class SettingsService:
+    """
+    Caches settings parsed from the settings ini file, and only re-parses them
+    when the file's modification time or size changes. Safe to share between
+    controller threads.
+
+    Parameters
+    ----------
+    parsed_args : Namespace
+        The parsed command line arguments, with the `settings` file path.
+    """
+
+
+    def __init__(self, parsed_args: Namespace):
+        self.parsed_args = parsed_args
+        self._lock = th.Lock()
+        self._stat = None
+        self._cfg = None
+        self._snapshots = {}    # section -> (read count, settings snapshot)
+        self._reads = 0
+
+
+    def _refresh(self):
+        # Re-parse the file if it changed since it was last read. If it cannot
+        # be accessed, previous settings are kept.
+        try:
+            st = os.stat(self.parsed_args.settings)
+            stat = (st.st_mtime_ns, st.st_size)
+        except (OSError, TypeError):
+            stat = self._stat
+        if self._cfg is None or stat != self._stat:
+            self._cfg = read_settings(self.parsed_args)
+            self._stat = stat
+            self._reads += 1
+
+
+    def get(self, section: str='DEFAULT', write_settings=False,
+            peek: bool=False) -> Tuple[Mapping, FrozenSet[str]]:
+        """
+        Returns a read-only mapping of settings for the section, and the names of
+        settings which changed since the previous call for the same section.
+        All settings are considered changed on the first call. Calls with
+        `peek=True` do not count as previous calls, e.g. to create a controller
+        before its first cycle. Arrays are copied, so changing them does not
+        change the cached settings.
+        """
+        with self._lock:
+            self._refresh()
+            reads, previous = self._snapshots.get(section, (None, {}))
+            if reads == self._reads:
+                settings = previous
+            else:
+                settings = MappingProxyType(get_settings(
+                    self.parsed_args, section=section, write_settings=write_settings,
+                    cfg=self._cfg))
+            if peek:
+                return _copy_arrays(settings), frozenset(settings)
+            if reads == self._reads:
+                return _copy_arrays(previous), frozenset()
+            changed = frozenset(k for k in set(settings) | set(previous) \
+                                if k not in settings or k not in previous \
+                                   or not _equal(settings[k], previous[k]))
+            self._snapshots[section] = (self._reads, settings)
+            return _copy_arrays(settings), changed
+
+
+
+def _copy_arrays(settings: Mapping) -> Mapping:
+    # Settings with mutable values, i.e. `bounds` arrays, copied
+    np = sys.modules.get('numpy')
+    if np is None or not any(isinstance(v, np.ndarray) for v in settings.values()):
+        return settings
+    return MappingProxyType({k: v.copy() if isinstance(v, np.ndarray) else v
+                             for k, v in settings.items()})
+
+
+
+def _equal(a, b) -> bool:
+    # Arrays only exist if numpy was imported
+    np = sys.modules.get('numpy')
+    if np is not None and (isinstance(a, np.ndarray) or isinstance(b, np.ndarray)):
+        return np.array_equal(a, b)
+    return a == b
+
+
+
+def put_control_action(action: 'np.ndarray', **settings):
     output = settings['output']
     with open(output, 'w') as f:
         writer = csv.writer(f)
@@ -151,9 +271,12 @@ def put_control_action(action: np.ndarray, **settings):
 
 
 
-def run(controller_name: str, ev_halt: th.Event):
-    # Get local controller, logger here
-    settings = get_settings(args, section=controller_name)
+def make_controller(controller_name: str):
+    """
+    Creates the logger and controller for a controller section in the settings
+    ini, and returns them along with the controller's module and settings.
+    """
+    settings = dict(settings_service.get(controller_name, write_settings=True, peek=True)[0])
     settings['controller_name'] = controller_name
     # Create a separate logger for each controller with its own name.
     logger = get_logger(controller_name)
@@ -163,44 +286,238 @@ def run(controller_name: str, ev_halt: th.Event):
     # Dynamically import controller functions from submodule
     logger.debug('CTRL MODULE: %s', 'controllers.%s' % settings['import_path'])
     ctrl_module = importlib.import_module('controllers.%s' % settings['import_path'])
-    get_controller = getattr(ctrl_module, 'get_controller')
-    get_current_state = getattr(ctrl_module, 'get_current_state')
-    update_controller = getattr(ctrl_module, 'update_controller')
-    ctrl = get_controller(**settings)
-    while not ev_halt.isSet():
-        try:
-            start = datetime.now(pytz.utc)
-            settings = get_settings(args, section=controller_name, write_settings=True)
-            update_controller(ctrl, **settings)
-            prev_end = start - 2*timedelta(seconds=int(settings['interval']))
-            if settings['no_network']:
-                state = None
-            else:
-                state = get_current_state(prev_end, start, **settings)
-            if state is not None:
-                logger.debug('State\n{}'.format(state))
-                action, *diag = ctrl.predict(state)
-                feedback = diag[0] if len(diag) > 0 else -1
-                logger.info('Last feedback: {:.2f} \tSetpoint: {:.2f}'.format(feedback, action[0]))
-                put_control_action(action, **settings)
-            if settings['dry_run']:
-                logger.info('Dry run finished. Halting.')
+    ctrl = ctrl_module.get_controller(**settings)
+    if settings.get('cache_quantum') is not None:
+        from controllers.cache import wrap_controller
+        ctrl = wrap_controller(ctrl, **settings)
+    return logger, ctrl_module, ctrl, settings
+
+
+
+def apply_settings(ctrl_module, ctrl, **settings):
+    """
+    Calls the module's `update_controller` with new settings. A cache around
+    the controller is cleared, as cached actions depend on the settings.
+    """
+    if 'controllers.cache' in sys.modules \
+        and isinstance(ctrl, sys.modules['controllers.cache'].CachedController):
+        ctrl.clear()
+        ctrl = ctrl.controller
+    ctrl_module.update_controller(ctrl, **settings)
+
+
+
+def make_scheduler(**settings) -> IntervalScheduler:
+    """
+    Creates the scheduler of control actions for a controller section. The
+    jitter is seeded by the section name so each controller keeps its offset
+    across restarts.
+    """
+    return IntervalScheduler(interval=float(settings['interval']),
+                             offset=settings.get('schedule_offset', 0.),
+                             jitter=settings.get('schedule_jitter', 0.),
+                             missed=settings.get('schedule_missed', 'skip'),
+                             seed=settings['controller_name'])
+
+
+
+def act(ctrl, state, logger, **settings):
+    """
+    Predicts and writes the control action for a state, if there is one.
+    """
+    if state is not None:
+        logger.debug('State\n{}'.format(state))
+        action, *diag = ctrl.predict(state)
+        feedback = diag[0] if len(diag) > 0 else -1
+        logger.info('Last feedback: {:.2f} \tSetpoint: {:.2f}'.format(feedback, action[0]))
+        put_control_action(action, **settings)
+
+
+
+def log_tick(tick, logger):
+    logger.debug('Cycle due at {} started {:.1f}s late.'.format(
+                 datetime.fromtimestamp(tick.due, timezone.utc).isoformat(), tick.lateness))
+    if tick.missed > 0:
+        logger.warning('Skipped {} cycle(s) because the previous cycle overran.'.format(tick.missed))
+
+
+
+def cycle(controller_name: str, ctrl_module, ctrl, logger, tick,
+          executor: ThreadPoolExecutor=None) -> Mapping:
+    """
+    Runs one control cycle: re-reads settings, updates the controller if they
+    changed, gets the current state and writes the control action. Returns
+    the settings used. If `executor` is given, the state is requested on it,
+    which limits the number of concurrent requests.
+    """
+    start = datetime.fromtimestamp(tick.start, timezone.utc)
+    settings, changed = settings_service.get(controller_name, write_settings=True)
+    log_tick(tick, logger)
+    if changed or getattr(ctrl_module, 'UPDATE_EVERY_CYCLE', False):
+        logger.debug('Changed settings: %s', ', '.join(sorted(changed)))
+        apply_settings(ctrl_module, ctrl, **settings)
+    prev_end = start - 2*timedelta(seconds=int(settings['interval']))
+    if settings['no_network']:
+        state = None
+    else:
+        request = partial(ctrl_module.get_current_state, prev_end, start, **settings)
+        state = request() if executor is None else executor.submit(request).result()
+    act(ctrl, state, logger, **settings)
+    return settings
+
+
+
+def time_to_next_cycle(scheduler: IntervalScheduler, logger, **settings) -> float:
+    """
+    Returns the seconds to wait until the next cycle, or None to halt after
+    a dry run.
+    """
+    if settings['dry_run']:
+        logger.info('Dry run finished. Halting.')
+        return None
+    scheduler.interval = float(settings['interval'])
+    time_left = scheduler.advance()
+    logger.info('Waiting for {:.1f}s'.format(time_left))
+    return time_left
+
+
+
+def start_controller(controller_name: str):
+    """
+    Returns `make_controller(controller_name)`, or None after logging the
+    error if the controller could not be created, so other controllers keep
+    running.
+    """
+    try:
+        return make_controller(controller_name)
+    except Exception as exc:
+        get_logger().error('Could not start %s: %s', controller_name, exc, exc_info=True)
+        return None
+
+
+
+def close_controller(ctrl, logger):
+    """
+    Calls `ctrl.close()` if the controller has one, e.g. so RL controllers
+    write their experiences and finish a background update before exiting.
+    """
+    close = getattr(ctrl, 'close', None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception as exc:
+        logger.error('Could not close controller: %s', exc, exc_info=True)
+
+
+
+def run(controller_name: str, ev_halt: th.Event):
+    # Get local controller, logger here
+    controller = start_controller(controller_name)
+    if controller is None:
+        return
+    logger, ctrl_module, ctrl, settings = controller
+    scheduler = make_scheduler(**settings)
+    scheduler.start()
+    try:
+        while not ev_halt.isSet():
+            try:
+                tick = scheduler.begin()
+                settings = cycle(controller_name, ctrl_module, ctrl, logger, tick)
+                time_left = time_to_next_cycle(scheduler, logger, **settings)
+                if time_left is None:
+                    ev_halt.set()
+                else:
+                    ev_halt.wait(time_left)
+            except KeyboardInterrupt:
+                logger.info('Keyboard interrupt 1. Halting.')
                 ev_halt.set()
-            else:
-                time_taken = datetime.now(pytz.utc).timestamp() - start.timestamp()
-                time_left = float(settings['interval']) - time_taken
-                logger.info('Waiting for {:.1f}s'.format(time_left))
-                ev_halt.wait(time_left)
-        except KeyboardInterrupt:
-            logger.info('Keyboard interrupt 1. Halting.')
+            except Exception as exc:
+                logger.error(msg=exc, exc_info=True)
+                if settings.get('dry_run', False):  # If dry_run=True, (default assume=False)
+                    ev_halt.set()
+                else:
+                    ev_halt.wait(scheduler.advance())
+    finally:
+        close_controller(ctrl, logger)
+
+
+
+async def wait_event(ev: asyncio.Event, timeout: float) -> bool:
+    """
+    Waits for an event to be set, or the timeout to expire. Returns True if
+    the event was set.
+    """
+    try:
+        await asyncio.wait_for(ev.wait(), timeout=max(timeout, 0.))
+    except asyncio.TimeoutError:
+        pass
+    return ev.is_set()
+
+
+
+async def run_async(controller_name: str, ev_halt: asyncio.Event, executor: ThreadPoolExecutor):
+    # Same as run(), but each cycle runs on a thread of this controller, so
+    # slow predictions or updates do not hold up other controllers on the
+    # event loop. State requests are run in the shared `executor`.
+    loop = asyncio.get_running_loop()
+    controller = start_controller(controller_name)
+    if controller is None:
+        return
+    logger, ctrl_module, ctrl, settings = controller
+    scheduler = make_scheduler(**settings)
+    ctrl_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=controller_name)
+    scheduler.start()
+    try:
+        while not ev_halt.is_set():
+            try:
+                tick = scheduler.begin()
+                settings = await loop.run_in_executor(ctrl_executor, partial(
+                    cycle, controller_name, ctrl_module, ctrl, logger, tick, executor))
+                time_left = time_to_next_cycle(scheduler, logger, **settings)
+                if time_left is None:
+                    ev_halt.set()
+                else:
+                    await wait_event(ev_halt, time_left)
+            except asyncio.CancelledError:
+                logger.info('Task cancelled. Halting.')
+                raise
+            except Exception as exc:
+                logger.error(msg=exc, exc_info=True)
+                if settings.get('dry_run', False):  # If dry_run=True, (default assume=False)
+                    ev_halt.set()
+                else:
+                    await wait_event(ev_halt, scheduler.advance())
+    finally:
+        # A running cycle finishes on its thread before the controller is
+        # closed, which completes even if the event loop stops first.
+        ctrl_executor.submit(close_controller, ctrl, logger)
+        ctrl_executor.shutdown(wait=False)
+
+
+
+async def run_all(controller_names: list, workers: int):
+    """
+    Runs all controllers as tasks on the current event loop, with at most
+    `workers` blocking state requests in flight.
+    """
+    logger = get_logger()
+    ev_halt = asyncio.Event()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='state') as executor:
+        tasks = []
+        for controller_name in controller_names:
+            tasks.append(asyncio.create_task(run_async(controller_name, ev_halt, executor),
+                                             name=controller_name))
+            logger.info('%s task started.' % controller_name)
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for task, result in zip(tasks, results):
+                if isinstance(result, Exception):
+                    logger.error('%s task failed: %s', task.get_name(), result, exc_info=result)
+        finally:
             ev_halt.set()
-        except Exception as exc:
-            logger.error(msg=exc, exc_info=True)
-            if settings.get('dry_run', False):  # If dry_run=True, (default assume=False)
-                ev_halt.set()
-            else:
-                ev_halt.wait(float(settings['interval']) - \
-                            (datetime.now(pytz.utc).timestamp() - start.timestamp()))
+            for task in tasks:
+                task.cancel()
 
 
 
@@ -208,27 +525,37 @@ if __name__ == '__main__':
     try:
         parser = make_arguments()
         args = parser.parse_args()
+        if args.profile_imports:
+            sys.exit(profile_imports())
+        settings_service = SettingsService(args)
         default_settings = get_settings(args)
         logger = make_logger(**default_settings)
         logger.info('Starting script: %s %s' % (sys.executable, ' '.join(sys.argv)))
 
-        threads = []
-        ev_halt = th.Event()
-        for controller_name in default_settings['controllers']:
-            thread = th.Thread(target=run, daemon=False,
-                            kwargs=dict(controller_name=controller_name, ev_halt=ev_halt))
-            thread.start()
-            logger.info('%s thread started.' % controller_name)
+        if default_settings['asyncio']:
+            try:
+                asyncio.run(run_all(default_settings['controllers'], default_settings['workers']))
+            except KeyboardInterrupt:
+                logger.info('Keyboard interrupt 0. Halting.')
+        else:
+            threads = []
+            ev_halt = th.Event()
+            for controller_name in default_settings['controllers']:
+                thread = th.Thread(target=run, daemon=False,
+                                kwargs=dict(controller_name=controller_name, ev_halt=ev_halt))
+                thread.start()
+                threads.append(thread)
+                logger.info('%s thread started.' % controller_name)
 
-        # Wait for threads to finish, or interrupt them in case of error/input
-        try:
-            for thread in threads:
-                thread.join()
-        except KeyboardInterrupt:
-            logger.info('Keyboard interrupt 0. Halting.')
-            ev_halt.set()
-            for thread in threads:
-                thread.join(timeout=2.)
+            # Wait for threads to finish, or interrupt them in case of error/input
+            try:
+                for thread in threads:
+                    thread.join()
+            except KeyboardInterrupt:
+                logger.info('Keyboard interrupt 0. Halting.')
+                ev_halt.set()
+                for thread in threads:
+                    thread.join(timeout=2.)
 
     # Exceptions during settings parsing, thread creation
     except Exception as exc:
@@ -10,66 +10,253 @@ the following interface:
 """
 
 from typing import Union, Tuple
-from collections import deque
+import sys
 
 # from sklearn.base import BaseEstimator
 import numpy as np
 import pandas as pd
-from scipy.optimize import minimize
 
+from utils.buffers import RingBuffer
 
 
-class GridSearchController:
-
 
-    def __init__(self, model, bounds, resolution, vary_idx):
+class GridSearchController:
+    """
+    Evaluates a model over a grid of control values for each state, and picks
+    the control values which minimize the model output.
+
+    Parameters
+    ----------
+    model : Any
+        An estimator with a `predict(X)` method returning one value per row.
+    bounds : Union[Tuple[float, float], Tuple[Tuple[float, float], ...]]
+        (min, max) range for each varied input.
+    resolution : Union[int, Tuple[int, ...]]
+        Number of intervals the range of each varied input is divided into.
+    vary_idx : Union[int, Tuple[int, ...]]
+        Column indices of `X` which are control variables.
+    batch_size : int, optional
+        If provided, states are evaluated in batches such that each call to
+        `model.predict` gets at most this many rows (but at least one whole
+        grid). By default None, where the model is called once per state.
+    levels : int, optional
+        Number of coarse-to-fine refinement passes after the first grid. Each
+        pass evaluates a new grid of the same resolution spanning one grid
+        step on either side of the best points found so far, so the grid
+        step shrinks by a factor of `resolution / 2`. Needs `resolution > 2`.
+        By default 0, i.e. a single exhaustive grid.
+    beam : int, optional
+        Number of best points per state around which to refine, by default 1.
+    precision : float, optional
+        Stop refining once the grid step of all varied inputs is at most this
+        value, even if fewer than `levels` passes were made. By default None.
+
+    Attributes
+    ----------
+    evaluations : int
+        Number of rows passed to `model.predict` by the last `predict` call.
+    """
+
+
+    def __init__(self, model, bounds, resolution, vary_idx, batch_size: int=None,
+                 levels: int=0, beam: int=1, precision: float=None):
         self.model = model
         self.bounds = bounds
         self.resolution = resolution
         self.vary_idx = vary_idx
-
-
-    def predict(self, X: np.ndarray) -> np.ndarray:
+        self.batch_size = batch_size
+        self.levels = levels
+        self.beam = beam
+        self.precision = precision
+        self.evaluations = 0
+        if levels > 0:
+            self._axes()
+
+
+    def _axes(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Bounds as a (varied inputs, 2) array, resolution and column indices
+        # of varied inputs as 1D arrays.
         bounds = self.bounds if isinstance(self.bounds[0], tuple) else (self.bounds,)
         resolution = self.resolution if isinstance(self.resolution, tuple) else (self.resolution,)
-        vary_num = (r + 1 for r in resolution)
         vary_idx = self.vary_idx if isinstance(self.vary_idx, tuple) else (self.vary_idx,)
+        if self.levels > 0 and min(resolution) <= 2:
+            # Refinement shrinks the grid step by resolution / 2 per pass
+            raise ValueError('resolution must be greater than 2 when levels > 0.')
+        return np.asarray(bounds, dtype=float), np.asarray(resolution), np.asarray(vary_idx)
+
+
+    def grid(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the grid of control values, as an array of shape
+        (grid points, varied inputs), along with the column indices of the
+        varied inputs and a boolean mask of the constant inputs in `X`.
+        """
+        bounds, resolution, vary_idx = self._axes()
         const_mask = np.ones(X.shape[1], dtype=bool)
-        const_mask[np.asarray(vary_idx)] = 0
-        const_idx = tuple(np.arange(X.shape[1])[const_mask])
-        
+        const_mask[vary_idx] = 0
+
         vary_coords = []
-        for n, b in zip(vary_num, bounds):
+        for n, b in zip(resolution + 1, bounds):
             vary_coords.append(np.linspace(*b, num=n, endpoint=True))
-        # coords is an array of all possible coordinates on the grid which must
-        # be evaluated to find the optimal point.
+        # vary_coords is an array of all possible coordinates on the grid which
+        # must be evaluated to find the optimal point.
         vary_coords = np.array(np.meshgrid(*vary_coords)).T.reshape(-1, len(vary_idx))
+        return vary_coords.astype(X.dtype), vary_idx, const_mask
+
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        self.evaluations = 0
+        if self.levels > 0:
+            return self._predict_refined(X)
+        elif self.batch_size is None:
+            return self._predict_rows(X)
+        return self._predict_batched(X)
+
+
+    def evaluate(self, X: np.ndarray, controls: np.ndarray, vary_idx: np.ndarray,
+                 const_mask: np.ndarray) -> np.ndarray:
+        """
+        Evaluates the model for each state in `X` (states, inputs) combined
+        with each of its candidate control values in `controls` of shape
+        (states, candidates, varied inputs). Returns model outputs of shape
+        (states, candidates). The model is called on chunks of at most
+        `batch_size` rows, or once per state if `batch_size` is None.
+        """
+        ncandidates = controls.shape[1]
+        nrows = 1 if self.batch_size is None else max(1, self.batch_size // ncandidates)
+        coords = np.empty((min(nrows, len(X)), ncandidates, X.shape[1]), dtype=X.dtype)
+        outputs = np.empty((len(X), ncandidates))
+        for start in range(0, len(X), nrows):
+            x = X[start:start+nrows]
+            chunk = coords[:len(x)]
+            chunk[:, :, const_mask] = x[:, None, const_mask]
+            chunk[:, :, vary_idx] = controls[start:start+len(x)]
+            prediction = self.model.predict(chunk.reshape(-1, X.shape[1]))
+            outputs[start:start+len(x)] = np.reshape(prediction, (len(x), ncandidates))
+            self.evaluations += chunk.shape[0] * ncandidates
+        return outputs
+
+
+    def _predict_rows(self, X: np.ndarray) -> np.ndarray:
+        vary_coords, vary_idx, const_mask = self.grid(X)
         coords = np.zeros((len(vary_coords), X.shape[1]), dtype=X.dtype)
-        coords[:, np.asarray(vary_idx)] = vary_coords
+        coords[:, vary_idx] = vary_coords
 
         control = np.empty((len(X), len(vary_idx)))
         for i, x in enumerate(X):
             coords[:, const_mask] = x[const_mask]
             prediction = self.model.predict(coords)
             best = np.argmin(prediction)
-            control[i] = coords[best, np.asarray(vary_idx)]
-        
-        # _, y, z = model_surface(model=self.model, X=X, vary_idx=self.vary_idx,
-        #                         vary_range=(self.bounds,), vary_num=vary_num)
-        # control = y[np.arange(len(y)).astype(int), np.argmin(z, axis=1).astype(int)]
-        # return np.squeeze(control)
+            control[i] = coords[best, vary_idx]
+        self.evaluations = len(X) * len(coords)
         return control,
 
 
+    def _predict_batched(self, X: np.ndarray) -> np.ndarray:
+        vary_coords, vary_idx, const_mask = self.grid(X)
+        controls = np.broadcast_to(vary_coords, (len(X),) + vary_coords.shape)
+        outputs = self.evaluate(X, controls, vary_idx, const_mask)
+        return vary_coords[np.argmin(outputs, axis=1)].astype(float),
+
+
+    def _predict_refined(self, X: np.ndarray) -> np.ndarray:
+        bounds, resolution, _ = self._axes()
+        vary_coords, vary_idx, const_mask = self.grid(X)
+        controls = np.broadcast_to(vary_coords, (len(X),) + vary_coords.shape)
+        step = (bounds[:, 1] - bounds[:, 0]) / resolution
+        # Local grid offsets spanning one step on either side of a point,
+        # in units of step.
+        offsets = np.array(np.meshgrid(*[np.linspace(-1., 1., num=n, endpoint=True)
+                                         for n in resolution + 1])).T.reshape(-1, len(vary_idx))
+        rows = np.arange(len(X))[:, None]
+
+        outputs = self.evaluate(X, controls, vary_idx, const_mask)
+        best = np.argmin(outputs, axis=1)
+        best_control, best_output = controls[rows[:, 0], best], outputs[rows[:, 0], best]
+        for _ in range(self.levels):
+            if self.precision is not None and np.all(step <= self.precision):
+                break
+            # Refine around the `beam` best candidates of each state
+            beam = min(self.beam, outputs.shape[1])
+            top = np.argpartition(outputs, beam - 1, axis=1)[:, :beam]
+            centers = controls[rows, top]
+            controls = centers[:, :, None, :] + (offsets * step)[None, None, :, :]
+            controls = np.clip(controls, bounds[:, 0], bounds[:, 1]) \
+                         .reshape(len(X), -1, len(vary_idx)).astype(X.dtype)
+            outputs = self.evaluate(X, controls, vary_idx, const_mask)
+            best = np.argmin(outputs, axis=1)
+            improved = outputs[rows[:, 0], best] < best_output
+            best_control[improved] = controls[improved, best[improved]]
+            best_output[improved] = outputs[improved, best[improved]]
+            step = 2 * step / resolution
+        return best_control.astype(float),
 
-class QuasiNewtonController:
 
 
-    def __init__(self, model, bounds, resolution, vary_idx):
+class QuasiNewtonController:
+    """
+    Minimizes a model over the control variables of each state by gradient
+    descent within bounds.
+
+    Parameters
+    ----------
+    model : Any
+        An estimator with a `predict(X)` method returning one value per row,
+        or a `torch.nn.Module` (batched mode only).
+    bounds : Union[Tuple[float, float], Tuple[Tuple[float, float], ...]]
+        (min, max) range for each varied input.
+    resolution : Any
+        Unused. Kept for a common interface with `GridSearchController`.
+    vary_idx : Union[int, Tuple[int, ...]]
+        Column indices of `X` which are control variables.
+    batched : bool, optional
+        If True, all states (and starting points) are optimized together by
+        projected gradient descent with vectorized model calls. Otherwise
+        `scipy.optimize.minimize` (L-BFGS-B) is run for each state. By
+        default False.
+    starts : int, optional
+        Starting points per state in batched mode. The first is the current
+        control value in `X`, the rest are sampled uniformly within bounds.
+        By default 1.
+    maxiter : int, optional
+        Maximum iterations, by default 10.
+    tol : float, optional
+        Batched mode stops when the projected gradient of all points, with
+        controls scaled to [0, 1], is below this value. By default 1e-6.
+    analytic : bool, optional
+        Use analytic gradients in batched mode if the model is an
+        `MLPRegressor` (or `utils.inference.FrozenMLP`) or a
+        `torch.nn.Module`. Otherwise central finite differences are used. By
+        default True.
+    seed : int, optional
+        Random seed for starting points, by default None.
+
+    Attributes
+    ----------
+    iterations : int
+        Iterations taken by the last `predict` call (maximum over states for
+        per-state optimization).
+    evaluations : int
+        Number of rows passed to the model by the last `predict` call.
+    """
+
+
+    def __init__(self, model, bounds, resolution, vary_idx, batched: bool=False,
+                 starts: int=1, maxiter: int=10, tol: float=1e-6, analytic: bool=True,
+                 seed=None):
         self.model = model
         self.bounds = bounds
         self.resolution = resolution
         self.vary_idx = vary_idx
+        self.batched = batched
+        self.starts = starts
+        self.maxiter = maxiter
+        self.tol = tol
+        self.analytic = analytic
+        self.seed = seed
+        self.random = np.random.RandomState(seed) # pylint: disable=no-member
+        self.iterations = 0
+        self.evaluations = 0
 
 
     def f(self, ctrl: np.ndarray, x: np.ndarray, vary_idx) -> np.ndarray:
@@ -78,18 +265,170 @@ class QuasiNewtonController:
 
 
     def predict(self, X):
+        if self.batched:
+            return self._predict_batched(X)
+        # Imported here so feedback controllers start without loading scipy
+        from scipy.optimize import minimize
         vary_idx = np.asarray(self.vary_idx if isinstance(self.vary_idx, tuple) \
                               else (self.vary_idx,))
         y = np.empty((len(X), len(vary_idx)))
+        self.iterations, self.evaluations = 0, 0
         for i, x in enumerate(X):
             argmin = minimize(self.f, x0=x[vary_idx], args=(x, vary_idx),
                               bounds=self.bounds, method='L-BFGS-B',
-                              options={'maxiter': 10, 'disp': True})
+                              options={'maxiter': self.maxiter, 'disp': True})
             y[i] = argmin.x
+            self.iterations = max(self.iterations, argmin.nit)
+            self.evaluations += argmin.nfev
+        return np.squeeze(y),
+
+
+    def objective(self, X: np.ndarray, vary_idx: np.ndarray, scale: np.ndarray,
+                  grad: bool=False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Evaluates the model on each row of `X`. If `grad`, also returns the
+        gradient w.r.t. the control variables in `vary_idx`, multiplied by
+        `scale` (the width of the bounds) i.e. w.r.t controls scaled to [0, 1].
+        Otherwise the gradient is None.
+        """
+        analytic = self.analytic and (_is_torch_module(self.model) or \
+                                      _is_mlp_regressor(self.model))
+        if not grad:
+            self.evaluations += len(X)
+            return _model_value(self.model, X), None
+        elif analytic:
+            self.evaluations += len(X)
+            value, gradient = _model_value_and_grad(self.model, X)
+            return value, gradient[:, vary_idx] * scale
+        # Central differences for all rows and varied inputs in one model call
+        ndim = len(vary_idx)
+        step = 1e-6 * scale
+        X_ = np.repeat(X[:, None, :], 2 * ndim + 1, axis=1)
+        for j, (i, h) in enumerate(zip(vary_idx, step)):
+            X_[:, 1 + 2 * j, i] += h
+            X_[:, 2 + 2 * j, i] -= h
+        self.evaluations += X_.shape[0] * X_.shape[1]
+        values = _model_value(self.model, X_.reshape(-1, X.shape[1])).reshape(len(X), -1)
+        gradient = (values[:, 1::2] - values[:, 2::2]) / (2 * step) * scale
+        return values[:, 0], gradient
+
+
+    def _predict_batched(self, X: np.ndarray) -> np.ndarray:
+        bounds = np.atleast_2d(np.asarray(self.bounds, dtype=float))
+        low, scale = bounds[:, 0], bounds[:, 1] - bounds[:, 0]
+        vary_idx = np.asarray(self.vary_idx if isinstance(self.vary_idx, tuple) \
+                              else (self.vary_idx,))
+        self.iterations, self.evaluations = 0, 0
+
+        # Each state is repeated for every starting point. Optimization is
+        # done over controls u scaled to [0, 1]. x = low + u * scale
+        X_ = np.repeat(np.asarray(X, dtype=float), self.starts, axis=0)
+        u = self.random.uniform(size=(len(X_), len(vary_idx)))
+        u[::self.starts] = np.clip((X_[::self.starts, vary_idx] - low) / scale, 0., 1.)
+        X_[:, vary_idx] = low + u * scale
+        f, g = self.objective(X_, vary_idx, scale, grad=True)
+        # Step size per point such that the first step moves at most a quarter
+        # of the range of controls
+        step = 0.25 / np.maximum(np.abs(g).max(axis=1), 1e-12)
+
+        for _ in range(self.maxiter):
+            projected = u - np.clip(u - g, 0., 1.)
+            active = np.abs(projected).max(axis=1) > self.tol
+            if not np.any(active):
+                break
+            self.iterations += 1
+            idx = np.flatnonzero(active)
+            u_new = np.clip(u[idx] - step[idx, None] * g[idx], 0., 1.)
+            x_new = X_[idx]
+            x_new[:, vary_idx] = low + u_new * scale
+            f_new, _ = self.objective(x_new, vary_idx, scale)
+            # Armijo condition for sufficient decrease
+            accept = f_new <= f[idx] - 1e-4 * np.sum(g[idx] * (u[idx] - u_new), axis=1)
+            step[idx[~accept]] *= 0.5
+            idx = idx[accept]
+            if len(idx) > 0:
+                u_old, g_old = u[idx], g[idx]
+                u[idx], X_[idx] = u_new[accept], x_new[accept]
+                f[idx], g[idx] = self.objective(X_[idx], vary_idx, scale, grad=True)
+                # Barzilai-Borwein step: a scalar secant approximation of the
+                # inverse Hessian. Step is doubled where curvature is not positive.
+                du, dg = u[idx] - u_old, g[idx] - g_old
+                curvature = np.sum(du * dg, axis=1)
+                positive = curvature > 1e-12
+                step[idx] = np.where(positive, np.sum(du * du, axis=1) / np.where(positive, curvature, 1.),
+                                     2. * step[idx])
+
+        best = np.argmin(f.reshape(len(X), self.starts), axis=1)
+        y = X_[np.arange(len(X)) * self.starts + best][:, vary_idx]
         return np.squeeze(y),
 
 
 
+def _is_torch_module(model) -> bool:
+    # torch is only checked for if already imported, since a torch module
+    # cannot exist otherwise.
+    torch = sys.modules.get('torch')
+    return torch is not None and isinstance(model, torch.nn.Module)
+
+
+
+def _is_mlp_regressor(model) -> bool:
+    # An `MLPRegressor`, or a `utils.inference.FrozenMLP` which has the same
+    # attributes.
+    nn = sys.modules.get('sklearn.neural_network')
+    inference = sys.modules.get('utils.inference')
+    return ((nn is not None and isinstance(model, nn.MLPRegressor)) or
+            (inference is not None and isinstance(model, inference.FrozenMLP))) \
+           and model.out_activation_ == 'identity' and model.n_outputs_ == 1
+
+
+
+def _model_value(model, X: np.ndarray) -> np.ndarray:
+    # Model output for a 2D array of inputs, as a 1D array
+    if _is_torch_module(model):
+        torch = sys.modules['torch']
+        with torch.no_grad():
+            return model(torch.as_tensor(X, dtype=torch.float32)).numpy().reshape(len(X))
+    return np.reshape(model.predict(X), len(X))
+
+
+
+def _model_value_and_grad(model, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Model output and its gradient w.r.t. inputs, for an `MLPRegressor` with
+    # a single output or a torch module.
+    if _is_torch_module(model):
+        torch = sys.modules['torch']
+        x = torch.as_tensor(X, dtype=torch.float32).requires_grad_(True)
+        y = model(x).reshape(len(X))
+        gradient, = torch.autograd.grad(y.sum(), x)
+        return y.detach().numpy().astype(float), gradient.numpy().astype(float)
+    # Forward pass through hidden layers, keeping activations
+    activation, derivative = _ACTIVATIONS[model.activation]
+    layers = list(zip(model.coefs_, model.intercepts_))
+    outputs = [X]
+    for W, b in layers[:-1]:
+        outputs.append(activation(outputs[-1] @ W + b))
+    W, b = layers[-1]
+    value = (outputs[-1] @ W + b).reshape(len(X))   # identity output activation
+    # Backward pass
+    gradient = np.repeat(W.T, len(X), axis=0)
+    for (W, _), out in zip(reversed(layers[:-1]), reversed(outputs[1:])):
+        gradient = (gradient * derivative(out)) @ W.T
+    return value, gradient
+
+
+
+# Activation functions of `MLPRegressor` and their derivatives in terms of
+# their output.
+_ACTIVATIONS = {
+    'identity': (lambda z: z, lambda a: np.ones_like(a)),
+    'logistic': (lambda z: 1. / (1. + np.exp(-z)), lambda a: a * (1. - a)),
+    'tanh': (np.tanh, lambda a: 1. - a ** 2),
+    'relu': (lambda z: np.maximum(z, 0.), lambda a: (a > 0).astype(a.dtype)),
+}
+
+
+
 class BinaryApproachController:
      # See: http://www.computrols.com/cooling-tower-control-based-approach/
 
@@ -112,26 +451,40 @@ class BinaryApproachController:
 
 
 class FeedbackController:
-
-    def __init__(self, bounds, kp: float=1., ki: float=1., kd: float=1., window: int=1):
+    """
+    A PID-like controller which scales the last change in action by the
+    weighted error in feedback. Subclasses define `feedback()`.
+
+    Only the last `history` feedbacks, states, actions and errors are kept, in
+    `RingBuffer`s. Numeric histories are stored and read back as copies: an
+    action returned by `predict` is not the stored one, so modifying it, or
+    an array passed in, does not change the history. States are stored by
+    reference, but array states read back by index are copies.
+    """
+
+    def __init__(self, bounds, kp: float=1., ki: float=1., kd: float=1., window: int=1,
+                 history: int=100):
         self.bounds = np.asarray(bounds)
         self.window = window
         self.kp = kp
         self.ki = ki
         self.kd = kd
-        self._feedbacks = []
-        self._states = []
-        self._actions = []
-        self._errors = []
-        self._cum_errors = []
+        # Only the last `history` values are kept. window < history.
+        self.history = history
+        self._feedbacks = RingBuffer(history)
+        self._states = RingBuffer(history, dtype=object)
+        self._actions = RingBuffer(history)
+        self._errors = RingBuffer(history)
+        self._cum_errors = RingBuffer(history)
 
 
     def predict(self, X: np.ndarray):
         feedback = self.feedback(X)
         self._feedbacks.append(feedback)
+        self._states.append(X)
         # proportional
         error = self._feedbacks[-1] - \
-            (np.mean(self._feedbacks[-self.window-1:-1]) if len(self._feedbacks) >= 2 \
+            (self._feedbacks.window_mean(self.window, offset=1) if len(self._feedbacks) >= 2 \
              else self._feedbacks[-1])
         self._errors.append(error)
         # derivative
@@ -177,8 +530,14 @@ class FeedbackController:
 
 
 class SimpleFeedbackController:
-
-    def __init__(self, bounds, stepsize:float=1, window: int=1, tolerance: float=0.1, seed=None):
+    """
+    Steps the action by `stepsize` in the direction which last improved the
+    feedback. Subclasses define `feedback()` and `starting_action()`.
+    History is kept, and copied, as in `FeedbackController`.
+    """
+
+    def __init__(self, bounds, stepsize:float=1, window: int=1, tolerance: float=0.1, seed=None,
+                 history: int=100):
         super().__init__()
         self.bounds = np.asarray(bounds) # 2D array of [(min, max)] for setpoint
         self.stepsize = stepsize
@@ -186,10 +545,12 @@ class SimpleFeedbackController:
         self.tolerance = tolerance
         self.seed = seed
         self.random = np.random.RandomState(seed) # pylint: disable=no-member
-        self._feedbacks = []
-        self._states = deque(maxlen=100)
-        self._actions = []
-        self._errors = deque(maxlen=100)
+        # Only the last `history` values are kept. window < history.
+        self.history = history
+        self._feedbacks = RingBuffer(history)
+        self._states = RingBuffer(history, dtype=object)
+        self._actions = RingBuffer(history)
+        self._errors = RingBuffer(history)
 
 
     def predict(self, X: pd.DataFrame) -> Tuple[np.ndarray, float]:
@@ -204,8 +565,8 @@ class SimpleFeedbackController:
             step_action = self._actions[-1] - self._actions[-min(2, len(self._actions))]
         else:
             # [a|f]_[1|2] is actions and feedbacks at relative times 1, 2 i.e. first, second
-            a_2, a_1 = self._actions[-1], np.mean(self._actions[-self.window-1:-1])
-            f_2, f_1 = self._feedbacks[-1], np.mean(self._feedbacks[-self.window-1:-1])
+            a_2, a_1 = self._actions[-1], self._actions.window_mean(self.window, offset=1)
+            f_2, f_1 = self._feedbacks[-1], self._feedbacks.window_mean(self.window, offset=1)
             # What was the direction of change in action from the last 2 steps?
             dir_a = np.sign(a_2 - a_1)
             # What was the direction of change in feedback from the last 2 steps?
@@ -234,8 +595,6 @@ class SimpleFeedbackController:
             action = self.clip_action(action, X)
             
             self._actions.append(action)
-            self._actions = self._actions[-100:]
-            self._feedbacks = self._feedbacks[-100:]
         return action, feedback
 
 
@@ -248,4 +607,75 @@ class SimpleFeedbackController:
 
 
     def clip_action(self, u: Union[np.ndarray, float, int], X: pd.DataFrame):
-        return np.clip(u, a_min=self.bounds[:, 0], a_max=self.bounds[:, 1])
\ No newline at end of file
+        return np.clip(u, a_min=self.bounds[:, 0], a_max=self.bounds[:, 1])
+
+
+if __name__ == '__main__':
+    # Benchmark per-state vs. batched controllers:
+    # python -m controllers.baseline_control --help
+    from argparse import ArgumentParser
+    from time import perf_counter
+    from sklearn.neural_network import MLPRegressor
+
+    parser = ArgumentParser(description='Benchmark GridSearchController and QuasiNewtonController predict modes.')
+    parser.add_argument('-n', '--rows', type=int, default=2016, help='Number of states.')
+    parser.add_argument('-r', '--resolution', type=int, default=40, help='Grid resolution.')
+    parser.add_argument('-k', '--vary', type=int, default=2, help='Number of varied inputs.')
+    parser.add_argument('-b', '--batch-size', type=int, default=65536,
+                        help='Max rows per model call in batched mode.')
+    parser.add_argument('--levels', type=int, default=2,
+                        help='Refinement levels for coarse-to-fine search.')
+    parser.add_argument('--beam', type=int, default=2,
+                        help='Beam width for coarse-to-fine search.')
+    args = parser.parse_args()
+
+    random = np.random.RandomState(0)
+    X = random.rand(args.rows, 6)
+    model = MLPRegressor(hidden_layer_sizes=(32, 32), max_iter=500)
+    # Smooth objective with a minimum inside the grid
+    inputs = random.rand(1000, 6)
+    model.fit(inputs, np.sum((inputs - 0.3) ** 2, axis=1))
+
+    vary_idx = tuple(range(6 - args.vary, 6))
+    bounds = ((0., 1.),) * args.vary
+    results = {}
+    for batch_size in (None, args.batch_size):
+        ctrl = GridSearchController(model, bounds=bounds, resolution=(args.resolution,) * args.vary,
+                                    vary_idx=vary_idx, batch_size=batch_size)
+        start = perf_counter()
+        results[batch_size], = ctrl.predict(X)
+        print('batch_size={}: {:.3f}s, {} evaluations'.format(
+              batch_size, perf_counter() - start, ctrl.evaluations))
+    print('Same setpoints:', np.array_equal(results[None], results[args.batch_size]))
+
+    # Coarse grid refined to (at least) the same precision as the full grid
+    coarse = 8
+    levels = max(args.levels, int(np.ceil(np.log(args.resolution / coarse) / np.log(coarse / 2))))
+    ctrl = GridSearchController(model, bounds=bounds, resolution=(coarse,) * args.vary,
+                                vary_idx=vary_idx, batch_size=args.batch_size,
+                                levels=levels, beam=args.beam)
+    start = perf_counter()
+    refined, = ctrl.predict(X)
+    print('levels={}, beam={}: {:.3f}s, {} evaluations'.format(
+          levels, args.beam, perf_counter() - start, ctrl.evaluations))
+    # The model surface can be flat near the optimum, so compare objectives
+    objective = {}
+    for name, control in (('full', results[args.batch_size]), ('refined', refined)):
+        x = X.copy()
+        x[:, vary_idx] = control
+        objective[name] = model.predict(x)
+    print('Max objective increase over full grid:',
+          np.max(objective['refined'] - objective['full']))
+
+    # Per-state L-BFGS-B vs. batched projected gradient descent
+    for kwargs in (dict(batched=False), dict(batched=True),
+                   dict(batched=True, starts=4, maxiter=30)):
+        ctrl = QuasiNewtonController(model, bounds=bounds, resolution=None, vary_idx=vary_idx,
+                                     seed=0, **kwargs)
+        start = perf_counter()
+        control, = ctrl.predict(X.copy())
+        x = X.copy()
+        x[:, vary_idx] = control
+        print('{}: {:.3f}s, {} iterations, {} evaluations, mean objective {:.4f}'.format(
+              kwargs, perf_counter() - start, ctrl.iterations, ctrl.evaluations,
+              model.predict(x).mean()))
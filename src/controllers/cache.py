@@ -0,0 +1,205 @@
+"""
+A cache around the `predict(X)` method of model-based controllers such as
+`GridSearchController` and `QuasiNewtonController`. States which are close to
+recently seen states reuse their optimal control values, either as the result
+or as the starting point of the optimization.
+"""
+
+from typing import Union, Tuple, Hashable
+from collections import OrderedDict
+import time
+
+import numpy as np
+
+from utils.logs import get_logger
+
+
+
+class CachedController:
+    """
+    Least-recently-used cache of control actions keyed on a quantized state.
+    Only for controllers whose action depends on the state alone, such as
+    `GridSearchController` and `QuasiNewtonController`. Feedback controllers
+    must see every state to update their history, so they are not cached.
+
+    Parameters
+    ----------
+    controller : Any
+        A controller whose `predict(X)` takes a 2D array of states and returns
+        a tuple whose first element has one row (or value) of control
+        values per state.
+    quantum : Union[float, np.ndarray]
+        Quantization step of the state, for all columns or per column of `X`.
+        States that round to the same multiples of `quantum` share a key.
+    vary_idx : Union[int, Tuple[int, ...]], optional
+        Columns of `X` which are control variables. They are not part of the
+        key and are overwritten with cached values when warm-starting. By
+        default `controller.vary_idx`.
+    maxsize : int, optional
+        Maximum number of cached states, by default 1024.
+    ttl : float, optional
+        Seconds after which a cached value expires, by default None (never).
+    mode : str, optional
+        'return' to return cached control values for cache hits, or 'warm' to
+        write them into the control columns of `X` and call the controller for
+        all states, e.g. as starting points for `QuasiNewtonController`. By
+        default 'return'.
+    logger : str, optional
+        Name of the logger for cache statistics, by default 'cache'.
+    log_every : int, optional
+        Statistics are logged every this many `predict` calls, and when the
+        cache first becomes full. By default 100.
+    clock : Callable[[], float], optional
+        Function returning the current time in seconds, by default
+        `time.monotonic`.
+
+    Attributes
+    ----------
+    hits, misses, evictions, expirations : int
+        Running counts of cache lookups and removals.
+    """
+
+
+    def __init__(self, controller, quantum: Union[float, np.ndarray],
+                 vary_idx: Union[int, Tuple[int, ...]]=None, maxsize: int=1024,
+                 ttl: float=None, mode: str='return', logger: str='cache',
+                 log_every: int=100, clock=time.monotonic):
+        if mode not in ('return', 'warm'):
+            raise ValueError('mode must be one of "return", "warm".')
+        self.controller = controller
+        self.quantum = quantum
+        self.vary_idx = controller.vary_idx if vary_idx is None else vary_idx
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.mode = mode
+        self.logger = get_logger(logger)
+        self.log_every = log_every
+        self.clock = clock
+        self._cache = OrderedDict()
+        self._calls = 0
+        self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+    def clear(self):
+        self._cache.clear()
+
+
+    def keys(self, X: np.ndarray) -> Tuple[Hashable, ...]:
+        """
+        Returns a hashable key for each state in `X` (states, inputs). The key
+        is made of the non-control columns rounded to multiples of `quantum`.
+        The key is None for states with NaN or infinite values, which are
+        never cached.
+        """
+        vary_idx = np.asarray(self.vary_idx if isinstance(self.vary_idx, tuple) \
+                              else (self.vary_idx,), dtype=int)
+        const_mask = np.ones(X.shape[1], dtype=bool)
+        const_mask[vary_idx] = 0
+        quantum = np.broadcast_to(np.asarray(self.quantum, dtype=float), X.shape[1:])
+        scaled = np.round(X[:, const_mask] / quantum[const_mask])
+        # Casting NaN, infinity or values out of range gives arbitrary integers
+        valid = np.all(np.abs(scaled) < 2. ** 62, axis=1)
+        quantized = np.where(valid[:, None], scaled, 0.).astype(np.int64)
+        return tuple(row.tobytes() if ok else None for row, ok in zip(quantized, valid))
+
+
+    def get(self, key: Hashable):
+        """
+        Returns the cached control values for a key, or None if absent or
+        expired. Marks the key as most recently used.
+        """
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        timestamp, value = entry
+        if self.ttl is not None and self.clock() - timestamp > self.ttl:
+            del self._cache[key]
+            self.expirations += 1
+            return None
+        self._cache.move_to_end(key)
+        return value
+
+
+    def put(self, key: Hashable, value: np.ndarray):
+        """
+        Caches control values for a key, evicting the least recently used keys
+        if `maxsize` is exceeded.
+        """
+        self._cache[key] = (self.clock(), value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            if self.evictions == 0:
+                self.logger.info('Cache full at %d states.', self.maxsize)
+            self.evictions += 1
+
+
+    def _log_stats(self):
+        self._calls += 1
+        if self._calls % self.log_every == 0:
+            self.logger.info('Cache hits: %d, misses: %d, evictions: %d, expirations: %d, '
+                             'size: %d', self.hits, self.misses, self.evictions,
+                             self.expirations, len(self))
+
+
+    def predict(self, X: np.ndarray) -> Tuple[np.ndarray]:
+        """
+        Returns a tuple of a 2D array of control values of shape
+        (states, control variables).
+        """
+        X = np.atleast_2d(X)
+        keys = self.keys(X)
+        cached = [None if key is None else self.get(key) for key in keys]
+        hit = np.asarray([value is not None for value in cached], dtype=bool)
+        nhits = int(hit.sum())
+        self.hits += nhits
+        self.misses += len(X) - nhits
+
+        if self.mode == 'return':
+            run = ~hit
+        else:
+            run = np.ones(len(X), dtype=bool)
+            if nhits > 0:
+                X = X.copy()
+                X[np.ix_(hit, np.atleast_1d(self.vary_idx))] = \
+                    np.asarray([value for value in cached if value is not None])
+
+        ncontrols = len(np.atleast_1d(self.vary_idx))
+        control = np.empty((len(X), ncontrols))
+        if nhits > 0:
+            control[hit] = [value for value in cached if value is not None]
+        if np.any(run):
+            action, *_ = self.controller.predict(X[run])
+            control[run] = np.reshape(action, (-1, ncontrols))
+            for i in np.flatnonzero(run):
+                if keys[i] is not None:
+                    self.put(keys[i], control[i].copy())
+        self._log_stats()
+        return control,
+
+
+
+def wrap_controller(controller, **settings):
+    """
+    Wraps a model-based controller, i.e. one with control columns `vary_idx`
+    such as `GridSearchController`, in a `CachedController` if the
+    `cache_quantum` setting is given, using the `cache_ttl` (seconds) and
+    `cache_size` settings if present. Otherwise returns the controller
+    unchanged. Stateful controllers, e.g. feedback controllers, are not
+    cached and a warning is logged.
+    """
+    if settings.get('cache_quantum') in (None, ''):
+        return controller
+    if not hasattr(controller, 'vary_idx'):
+        get_logger(settings.get('controller_name', 'cache')).warning(
+            'Not caching %s: only model-based controllers with vary_idx can be cached.',
+            type(controller).__name__)
+        return controller
+    return CachedController(controller, quantum=settings['cache_quantum'],
+                            ttl=settings.get('cache_ttl'),
+                            maxsize=settings.get('cache_size', 1024),
+                            logger=settings.get('controller_name', 'cache'))
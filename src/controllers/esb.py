@@ -7,12 +7,19 @@ trends:
 """
 import numpy as np
 import pandas as pd
-import bdx
 
+from utils.trends import TrendCache
+from utils.fetch import TrendFetcher
 from .baseline_control import SimpleFeedbackController
 # from .rl_control import RLContinuousController
 
 
+# Requests to BDX, shared with other controllers to limit concurrent requests.
+fetcher = TrendFetcher()
+# Trend data downloaded so far. Only newer data is requested each time. The
+# backend can be replaced for offline use, e.g. with `utils.trends.FakeBackend`.
+trends = TrendCache(backend=fetcher)
+
 
 class Controller(SimpleFeedbackController):
 
@@ -64,12 +71,13 @@ def update_controller(ctrl: Controller, **settings):
 def get_current_state(start, end, **settings) -> pd.DataFrame:
     # This is hardcoded to match column names in the trends.
     uname, pwd = settings['username'], settings['password']
+    trend_ids = (settings['chiller_1_trend'], settings['chiller_2_trend'])
+    states = trends.fetch_many(trend_ids, start=start, end=end, username=uname,
+                               password=pwd, aggregation='Point')
     state = None
-    for trend_id in (settings['chiller_1_trend'], settings['chiller_2_trend']):
-        states = bdx.get_trend(trend_id=trend_id, username=uname, password=pwd,
-                               start=start, end=end, aggregation='Point')
-        if len(states) > 0:
-            state = states.iloc[-1]
+    for trend_id in trend_ids:
+        if len(states[trend_id]) > 0:
+            state = states[trend_id].iloc[-1]
             if state['RunChi'] != 0.:
                 break
-    return state
\ No newline at end of file
+    return state
@@ -1,17 +1,24 @@
 import os
 import warnings
-from typing import Tuple
+from typing import Tuple, TYPE_CHECKING
 from dataclasses import dataclass
 
 import numpy as np
 import pandas as pd
-from commonml import rl
-import torch
 
+# commonml and torch are slow to import, so they are imported when first used
+if TYPE_CHECKING:
+    from commonml import rl
+
+from utils.logs import get_logger
 from .rl_control import RLContinuousController
 from .esb import get_current_state
 
 
+# update_controller() trains the agent periodically, so controller.py should call
+# it every cycle and not only when settings change.
+UPDATE_EVERY_CYCLE = True
+
 
 @dataclass
 class DEFAULTS:
@@ -24,6 +31,8 @@ class DEFAULTS:
     gamma = 0.9
     epochs = 5
     update_interval = 12 * 3
+    # Train in a background thread, and swap in new weights when done
+    background_update = True
     # Other controller params
     window = 12 * 24 * 3
     local_storage_dir = 'esb_rl_storage'
@@ -35,7 +44,7 @@ class DEFAULTS:
 class Controller(RLContinuousController):
 
 
-    def __init__(self, bounds, window, agent: rl.PPO, save_interval: int, local_storage_dir: str):
+    def __init__(self, bounds, window, agent: 'rl.PPO', save_interval: int, local_storage_dir: str):
         super().__init__(agent, window=window, save_interval=save_interval, local_storage_dir=local_storage_dir)
         self.bounds = np.asarray(bounds)
         self.state_vars = ['TempWetBulb', 'TempAmbient', 'TempCondIn', 'TempCondOut', 'Tonnage', 'PressDiffCond']
@@ -54,7 +63,7 @@ class Controller(RLContinuousController):
         X_rl = X[self.state_vars].to_numpy(np.float32).reshape(1, -1)
         action, logprob = self.agent.predict(X_rl)
         if not (self._last_action is None or self._last_state is None or self._last_logprob is None):
-            self.memory.add(self._last_state, self._last_action, self._last_logprob, reward, False)
+            self.remember(self._last_state, self._last_action, self._last_logprob, reward, False)
         if self.t % self.save_interval == 0 and self.t > 0:
             self.save()
         self._last_state = X
@@ -66,6 +75,7 @@ class Controller(RLContinuousController):
 
 
 def get_controller(**settings) -> RLContinuousController:
+    from commonml import rl
     controller_args = dict(
         lr = settings.get('learning_rate', DEFAULTS.lr),
         policy = getattr(rl, settings.get('policy', DEFAULTS.policy)),
@@ -88,11 +98,25 @@ def get_controller(**settings) -> RLContinuousController:
 
 
 def update_controller(ctrl: Controller, **settings):
+    logger = get_logger(settings.get('controller_name'))
+    if ctrl.learner.swap():
+        ctrl.save(weights=True, memory=False)
+        metrics = ctrl.learner.metrics(step=ctrl.t)
+        logger.info(
+            'Swapped in weights trained for {duration:.2f}s (mean {mean_duration:.2f}s), '
+            '{staleness:.1f}s / {staleness_steps} steps stale, {skipped} updates skipped.'
+            .format(**metrics))
     memory = ctrl.memory
+    update_interval = settings.get('update_interval', DEFAULTS.update_interval)
     if len(memory) == 0:
         warnings.warn('No experiences stored in memory. Skipping controller update.')
-        return
-    update_interval = settings.get('update_interval', DEFAULTS.update_interval)
-    if ctrl.t % update_interval == 0:
-        ctrl.agent.update(ctrl.agent.policy, memory, ctrl.agent.epochs)
-        ctrl.save(weights=True, memory=False)
\ No newline at end of file
+    elif ctrl.t % update_interval == 0:
+        if settings.get('background_update', DEFAULTS.background_update):
+            ctrl.learner.submit(memory, step=ctrl.t)
+        else:
+            ctrl.agent.update(ctrl.agent.policy, memory, ctrl.agent.epochs)
+            ctrl.save(weights=True, memory=False)
+    # Skipped or failed updates are logged as they happen, not at the next swap
+    metrics = ctrl.learner.report(step=ctrl.t)
+    if metrics is not None:
+        logger.warning('Background updates skipped or failed: %s', metrics)
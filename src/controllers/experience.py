@@ -0,0 +1,343 @@
+"""
+An append-only, on-disk log of reinforcement learning experiences, so that
+controllers can persist their replay memory without rewriting it. Experiences
+are stored in fixed-size segment files, one structured NumPy array each, which
+are memory-mapped when read:
+
+```
+directory/
+    index.json              # fields and segments, rewritten atomically
+    segment-00000000.npy    # segment_size experiences
+    segment-00000001.npy    # ...the last segment may be partly filled
+```
+
+Appending copies an experience into an in-memory buffer. Full segments, and
+the partly filled segment on `commit()`, are written by a background thread to
+a temporary file which is renamed into place, so a crash never leaves a
+partial segment. Only the open segment is rewritten, so the cost of a commit
+is bounded by `segment_size` and not the length of the log.
+"""
+
+import json
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from utils.logs import get_logger
+
+
+# Fields of an experience, in the order of `rl.Memory.as_array()`
+FIELDS = ('states', 'actions', 'rewards', 'logprobs', 'is_terminals')
+# Incremented when the layout of the log changes
+_VERSION = 1
+
+
+
+def _fsync_replace(tmp: str, path: str):
+    os.replace(tmp, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        # Persist the rename itself
+        fd = os.open(os.path.dirname(path), os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+
+class ExperienceLog:
+    """
+    An append-only log of experiences `(state, action, logprob, reward,
+    is_terminal)`, the arguments of `rl.Memory.add()`. The shape and type of
+    each field are fixed by the first experience appended.
+
+    Methods other than `read()` should be called from one thread, e.g. the
+    control loop. If the writer thread fails, nothing more is written and
+    every later call to `append()`, `commit()` or `close()` raises the error.
+    Reopening the log recovers the experiences committed until then.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of segment files, created if needed.
+    segment_size : int, optional
+        Number of experiences per segment file, by default 288 (one day at 5
+        minute intervals).
+    logger : str, optional
+        Name of the logger for write errors, by default 'experience'.
+    """
+
+
+    def __init__(self, directory: str, segment_size: int=288, logger: str='experience'):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self.logger = get_logger(logger)
+        self._lock = threading.Lock()
+        self._error = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._dtype, self._segments = self._open()
+        # The open segment: its id, buffer, rows appended and rows committed
+        self._id = len(self._segments)
+        self._buffer = None
+        self._rows = self._committed = 0
+        if self._segments and self._segments[-1] < self.segment_size:
+            self._id -= 1
+            self._buffer = np.zeros(self.segment_size, dtype=self._dtype)
+            last = np.load(self._path(self._id), mmap_mode='r')
+            self._rows = self._committed = len(last)
+            self._buffer[:self._rows] = last
+            del last
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, name='ExperienceLog',
+                                        daemon=True)
+        self._thread.start()
+
+
+    def _path(self, segment: int) -> Path:
+        return self.directory / 'segment-{:08d}.npy'.format(segment)
+
+
+    def _open(self) -> Tuple[np.dtype, List[int]]:
+        # Reads the index, and adds segments whose index update was
+        # interrupted. Returns the dtype of experiences and the number of
+        # experiences in each segment.
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                os.remove(self.directory / name)
+        dtype, segments = None, []
+        try:
+            with open(self.directory / 'index.json', 'r') as f:
+                index = json.load(f)
+            if index['version'] == _VERSION:
+                dtype = np.dtype([(name, np.dtype(dt), tuple(shape))
+                                  for name, dt, shape in index['fields']])
+                segments = index['segments']
+        except (FileNotFoundError, ValueError):
+            pass
+        while os.path.exists(self._path(len(segments))):
+            rows = np.load(self._path(len(segments)), mmap_mode='r')
+            dtype = dtype or rows.dtype
+            segments.append(len(rows))
+            del rows
+        if len(segments) and os.path.exists(self._path(len(segments) - 1)):
+            # The last segment may have been rewritten after the index
+            rows = np.load(self._path(len(segments) - 1), mmap_mode='r')
+            segments[-1] = len(rows)
+            del rows
+        return dtype, segments
+
+
+    def _write_index(self):
+        fields = [(name, self._dtype[name].base.str, self._dtype[name].shape)
+                  for name in self._dtype.names]
+        tmp = self.directory / 'index.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(version=_VERSION, fields=fields, segments=self._segments), f)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_replace(tmp, self.directory / 'index.json')
+
+
+    def _write_segment(self, segment: int, rows: np.ndarray):
+        path = self._path(segment)
+        tmp = str(path) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, rows)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_replace(tmp, path)
+        with self._lock:
+            if segment < len(self._segments):
+                self._segments[segment] = len(rows)
+            else:
+                self._segments.append(len(rows))
+            self._write_index()
+
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                if self._error is None:
+                    self._write_segment(*item)
+            except Exception as e:
+                self.logger.error('Could not write experience segment %d: %s', item[0], e)
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+
+
+    def __len__(self) -> int:
+        """Number of experiences appended, committed or not."""
+        return self._id * self.segment_size + self._rows
+
+
+    @property
+    def committed(self) -> int:
+        """Number of experiences written to disk."""
+        with self._lock:
+            return sum(self._segments)
+
+
+    def append(self, state, action, logprob, reward, is_terminal):
+        """
+        Appends an experience. Only copies it to a buffer, unless the open
+        segment becomes full and is queued for writing.
+        """
+        self._raise()
+        values = dict(states=state, actions=action, logprobs=logprob, rewards=reward,
+                      is_terminals=is_terminal)
+        if self._dtype is None:
+            arrays = {name: np.asarray(value) for name, value in values.items()}
+            self._dtype = np.dtype([(name, arrays[name].dtype, arrays[name].shape)
+                                    for name in FIELDS])
+        if self._buffer is None:
+            self._buffer = np.zeros(self.segment_size, dtype=self._dtype)
+        row = self._buffer[self._rows]
+        for name, value in values.items():
+            # Values of the same size, e.g. a float or a 1 element array, are reshaped
+            row[name] = np.reshape(value, self._dtype[name].shape)
+        self._rows += 1
+        if self._rows == self.segment_size:
+            self.commit()
+            self._id += 1
+            self._buffer = None
+            self._rows = self._committed = 0
+
+
+    def commit(self, wait: bool=False):
+        """
+        Queues experiences appended since the last commit for writing.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Block until all queued experiences are written, by default False.
+        """
+        self._raise()
+        if self._rows > self._committed:
+            self._queue.put((self._id, self._buffer[:self._rows].copy()))
+            self._committed = self._rows
+        if wait:
+            self._queue.join()
+            self._raise()
+
+
+    def read(self, last: int=None) -> Tuple[np.ndarray, ...]:
+        """
+        Reads committed experiences. Only the segments needed are read, through
+        memory maps.
+
+        Parameters
+        ----------
+        last : int, optional
+            Number of most recent experiences to read, by default all.
+
+        Returns
+        -------
+        Tuple[np.ndarray, ...]
+            Arrays of `FIELDS`: states, actions, rewards, logprobs and
+            is_terminals, with one row per experience.
+        """
+        with self._lock:
+            segments = list(self._segments)
+        first, rows = len(segments), 0
+        while first > 0 and (last is None or rows < last):
+            first -= 1
+            rows += segments[first]
+        parts = [np.load(self._path(i), mmap_mode='r')[:segments[i]]
+                 for i in range(first, len(segments))]
+        if not parts:
+            return tuple(np.empty(0) for _ in FIELDS)
+        data = np.concatenate(parts)
+        if last is not None:
+            data = data[max(len(data) - last, 0):]
+        return tuple(np.array(data[name]) for name in FIELDS)
+
+
+    def close(self):
+        """
+        Commits appended experiences, and stops the writer thread after they
+        are written. Safe to call more than once.
+        """
+        if not self._thread.is_alive():
+            return
+        try:
+            self.commit()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+
+    def __enter__(self) -> 'ExperienceLog':
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+if __name__ == '__main__':
+    # Benchmark the time spent on the control thread saving a replay memory
+    # with np.savez every `interval` steps vs. appending to an ExperienceLog:
+    # python -m controllers.experience --help
+    from argparse import ArgumentParser
+    from collections import deque
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+
+    parser = ArgumentParser(description='Benchmark saving experiences with np.savez vs. ExperienceLog.')
+    parser.add_argument('-w', '--window', type=int, default=12 * 24 * 3,
+                        help='Experiences kept in memory, by default 3 days at 5 minutes.')
+    parser.add_argument('-s', '--steps', type=int, default=5000, help='Number of steps.')
+    parser.add_argument('-i', '--interval', type=int, default=12,
+                        help='Steps between saves.')
+    args = parser.parse_args()
+
+    random = np.random.RandomState(0)
+    experiences = [(random.rand(1, 6).astype(np.float32), random.rand(1, 1).astype(np.float32),
+                    random.rand(1).astype(np.float32), float(random.rand()), False)
+                   for _ in range(args.steps)]
+    with TemporaryDirectory() as directory:
+        memory = deque(maxlen=args.window)
+        start = perf_counter()
+        for t, experience in enumerate(experiences, 1):
+            memory.append(experience)
+            if t % args.interval == 0:
+                state, action, logprob, reward, is_terminal = zip(*memory)
+                np.savez(os.path.join(directory, 'memory.npz'), states=np.array(state),
+                         actions=np.array(action), rewards=np.array(reward),
+                         logprobs=np.array(logprob), is_terminals=np.array(is_terminal))
+        savez = perf_counter() - start
+
+        with ExperienceLog(os.path.join(directory, 'log')) as log:
+            start = perf_counter()
+            for t, experience in enumerate(experiences, 1):
+                log.append(*experience)
+                if t % args.interval == 0:
+                    log.commit()
+            append = perf_counter() - start
+            log.commit(wait=True)
+            written = perf_counter() - start
+        start = perf_counter()
+        with ExperienceLog(os.path.join(directory, 'log')) as log:
+            states, *_ = log.read(last=args.window)
+        load = perf_counter() - start
+        assert np.array_equal(states, np.array([e[0] for e in experiences[-args.window:]]))
+    print('{} steps, window {}, save every {} steps'.format(args.steps, args.window, args.interval))
+    print('np.savez:      {:7.1f} us/step on the control thread'.format(savez / args.steps * 1e6))
+    print('ExperienceLog: {:7.1f} us/step on the control thread, {:.2f}s until written, '
+          '{:.3f}s to load'.format(append / args.steps * 1e6, written, load))
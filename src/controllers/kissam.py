@@ -8,11 +8,15 @@ only one tower is active usually. Therefore, CT_1 is used to represent both towe
 """
 import pandas as pd
 import numpy as np
-import bdx
 
+from utils.trends import TrendCache
 # Same controller as ESB
 from .baseline_control import SimpleFeedbackController
-from .esb import update_controller
+from .esb import update_controller, fetcher
+
+
+# Trend data downloaded so far. Only newer data is requested each time.
+trends = TrendCache(backend=fetcher)
 
 
 class Controller(SimpleFeedbackController):
@@ -50,8 +54,8 @@ def get_current_state(start, end, **settings) -> pd.DataFrame:
     # This is hardcoded to match column names in the trends.
     uname, pwd = settings['username'], settings['password']
     state = None
-    states = bdx.get_trend(trend_id=settings['chiller_trend'], username=uname, password=pwd,
-                           start=start, end=end, aggregation='Point')
+    states = trends.fetch(settings['chiller_trend'], start=start, end=end, username=uname,
+                          password=pwd, aggregation='Point')
     if len(states) > 0:
         state = states.iloc[-1]
     return state
@@ -0,0 +1,168 @@
+"""
+Trains reinforcement learning agents in the background, so control actions are
+not delayed by training. `BackgroundLearner` trains a copy of the agent on a
+snapshot of the replay memory in a worker thread. The trained weights are
+loaded into the live agent by `swap()`, called from the control loop between
+actions, so the policy never changes during a prediction.
+"""
+
+import copy
+import threading
+import time
+from typing import Any, Dict
+
+from utils.logs import get_logger
+
+
+
+class BackgroundLearner:
+    """
+    Trains a shadow copy of an agent with `agent.update(policy, memory,
+    epochs)`, e.g. `rl.PPO`, in a worker thread. The shadow keeps its own
+    optimizer state across updates, and is created from the agent on the
+    first `submit()`. At most one update runs at a time.
+
+    Parameters
+    ----------
+    agent : rl.PPO
+        The live agent, whose `policy` weights are replaced by `swap()`.
+    logger : str, optional
+        Name of the logger for updates and errors, by default 'learner'.
+    clock : Callable[[], float], optional
+        Function returning the current time in seconds, by default
+        `time.monotonic`.
+
+    Attributes
+    ----------
+    duration : float
+        Seconds taken by the last update, None until one finishes.
+    updates, swaps, skipped, errors : int
+        Numbers of updates finished, weights swapped in, submissions skipped
+        because an update was running, and updates which raised an exception.
+    """
+
+
+    def __init__(self, agent, logger: str='learner', clock=time.monotonic):
+        self.agent = agent
+        self.logger = get_logger(logger)
+        self.clock = clock
+        self._shadow = None
+        self._thread = None
+        self._lock = threading.Lock()
+        # Weights ready to swap in, with the time and step of their memory snapshot
+        self._pending = None
+        self._live = None
+        self.duration, self._total_duration = None, 0.
+        self.updates, self.swaps, self.skipped, self.errors = 0, 0, 0, 0
+        # Counts of skipped submissions and errors at the last report()
+        self._reported = (0, 0)
+
+
+    @property
+    def busy(self) -> bool:
+        """Whether an update is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+
+    def submit(self, memory, step: int=None) -> bool:
+        """
+        Starts training on a snapshot of `memory`, unless an update is already
+        running. Returns whether training was started.
+
+        Parameters
+        ----------
+        memory : rl.Memory
+            Replay memory. It is copied, so it can be changed while training.
+        step : int, optional
+            The controller's step, to measure staleness in steps.
+        """
+        if self.busy:
+            with self._lock:
+                self.skipped += 1
+            return False
+        if self._shadow is None:
+            self._shadow = copy.deepcopy(self.agent)
+        snapshot = type(memory)(*memory.as_array())
+        self._thread = threading.Thread(target=self._train, name='BackgroundLearner',
+                                        args=(snapshot, self.clock(), step), daemon=True)
+        self._thread.start()
+        return True
+
+
+    def _train(self, memory, snapshot_time: float, step: int):
+        start = self.clock()
+        try:
+            self._shadow.update(self._shadow.policy, memory, self._shadow.epochs)
+            weights = copy.deepcopy(self._shadow.policy.state_dict())
+        except Exception as exc:
+            with self._lock:
+                self.errors += 1
+            self.logger.error('Background update failed: %s', exc, exc_info=True)
+            return
+        duration = self.clock() - start
+        with self._lock:
+            self._pending = (weights, snapshot_time, step)
+            self.duration = duration
+            self._total_duration += duration
+            self.updates += 1
+        self.logger.info('Background update on %d experiences took %.2fs.', len(memory), duration)
+
+
+    def swap(self) -> bool:
+        """
+        Loads the weights of the last finished update into the live agent's
+        policy, if there are new ones. Returns whether weights were swapped.
+        Call from the thread which uses the agent for predictions.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None:
+            return False
+        weights, snapshot_time, step = pending
+        self.agent.policy.load_state_dict(weights)
+        self._live = (snapshot_time, step)
+        self.swaps += 1
+        return True
+
+
+    def metrics(self, step: int=None) -> Dict[str, Any]:
+        """
+        Returns statistics of background updates:
+
+        * `duration`, `mean_duration`: seconds of the last and all updates,
+        * `staleness`: seconds since the memory snapshot which the live
+          weights were trained on was taken,
+        * `staleness_steps`: steps since that snapshot, if `step` is given,
+        * `busy`, `updates`, `swaps`, `skipped`, `errors`.
+
+        Durations and staleness are None until there is an update or swap.
+        """
+        with self._lock:
+            duration, total, updates = self.duration, self._total_duration, self.updates
+        snapshot_time, snapshot_step = self._live or (None, None)
+        return dict(
+            duration=duration, mean_duration=total / updates if updates else None,
+            staleness=None if snapshot_time is None else self.clock() - snapshot_time,
+            staleness_steps=None if step is None or snapshot_step is None \
+                            else step - snapshot_step,
+            busy=self.busy, updates=updates, swaps=self.swaps,
+            skipped=self.skipped, errors=self.errors)
+
+
+    def report(self, step: int=None) -> Dict[str, Any]:
+        """
+        Returns `metrics(step)` if submissions were skipped or updates failed
+        since the last call, otherwise None.
+        """
+        with self._lock:
+            counts = (self.skipped, self.errors)
+            if counts == self._reported:
+                return None
+            self._reported = counts
+        return self.metrics(step)
+
+
+    def join(self, timeout: float=None):
+        """Waits for a running update to finish."""
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -2,24 +2,38 @@
 Reinforcement learning-based controllers.
 """
 
-from typing import Tuple
+from typing import Tuple, TYPE_CHECKING
 from pathlib import Path
 import os
 
 import numpy as np
-import torch
 import pandas as pd
 from sklearn.base import BaseEstimator
-from commonml import rl
 
+# torch and commonml are slow to import, so they are imported when first used
+if TYPE_CHECKING:
+    from commonml import rl
 
+from .experience import ExperienceLog
+from .learner import BackgroundLearner
 
-class RLContinuousController(BaseEstimator):
 
 
-    def __init__(self, agent: rl.PPO, window, save_interval, local_storage_dir):
+class RLContinuousController(BaseEstimator):
+    """
+    Base class of reinforcement learning controllers. Experiences are kept in
+    `memory`, the replay memory of the last `window` steps, and in an
+    `ExperienceLog` under `local_storage_dir/experience`, to which they are
+    committed every `save_interval` steps by a background thread. On startup,
+    `memory` is loaded lazily from the log when it is first used. A
+    `memory.npz` file saved by earlier versions is moved to the log. The
+    agent can be trained without blocking predictions with `learner`, a
+    `BackgroundLearner`.
+    """
+
+
+    def __init__(self, agent: 'rl.PPO', window, save_interval, local_storage_dir):
         self.agent = agent
-        self.memory = rl.Memory(maxlen=window)
         self.window = window
         self.local_storage_dir = Path(local_storage_dir)
         self._last_state = None
@@ -27,47 +41,97 @@ class RLContinuousController(BaseEstimator):
         self._last_logprob = None
         self.t = 0
         self.save_interval = save_interval
+        self.log = ExperienceLog(self.local_storage_dir / 'experience')
+        self.learner = BackgroundLearner(agent)
+        self._memory = None
 
         if os.path.isfile(self.local_storage_dir / 'memory.npz'):
-            self.load(weights=False, memory=True)
+            self._import_npz(self.local_storage_dir / 'memory.npz')
         if os.path.isfile(self.local_storage_dir / 'weights.pt'):
             self.load(weights=True, memory=False)
 
 
+    @property
+    def memory(self) -> 'rl.Memory':
+        if self._memory is None:
+            self.load(weights=False, memory=True)
+        return self._memory
+
+
+    @memory.setter
+    def memory(self, memory: 'rl.Memory'):
+        self._memory = memory
+
+
+    def _import_npz(self, path: Path):
+        if len(self.log) == 0:
+            with np.load(path) as data:
+                arrays = [data[name] for name in ('states', 'actions', 'logprobs', 'rewards',
+                                                  'is_terminals')]
+            for experience in zip(*arrays):
+                self.log.append(*experience)
+            self.log.commit(wait=True)
+        os.replace(path, str(path) + '.imported')
+
+
+    def remember(self, state, action, logprob, reward, is_terminal):
+        """
+        Adds an experience to `memory` and to the log.
+        """
+        self.memory.add(state, action, logprob, reward, is_terminal)
+        self.log.append(state, action, logprob, reward, is_terminal)
+
+
     def reward(self, *args, **kwargs) -> float:
         raise NotImplementedError
 
 
     def save(self, weights=True, memory=True):
-        if memory or weights:
-            os.makedirs(self.local_storage_dir, exist_ok=True)
+        """
+        Saves policy weights, and commits experiences to the log in the
+        background.
+        """
         if memory:
-            states, actions, rewards, logprobs, is_terminals = self.memory.as_array()
-            np.savez(self.local_storage_dir / 'memory.npz', states=states, actions=actions, rewards=rewards,
-                    logprobs=logprobs, is_terminals=is_terminals)
+            self.log.commit()
         if weights:
+            import torch
+            os.makedirs(self.local_storage_dir, exist_ok=True)
             torch.save(self.agent.policy.state_dict(), self.local_storage_dir / 'weights.pt')
 
 
     def load(self, weights=True, memory=True):
+        """
+        Loads policy weights, and the last `window` experiences in the log.
+        """
         if memory:
-            with np.load(self.local_storage_dir / 'memory.npz') as data:
-                states = data['states']
-                actions = data['actions']
-                rewards = data['rewards']
-                logprobs = data['logprobs']
-                is_terminals = data['is_terminals']
-            self.memory = rl.Memory(states, actions, rewards, logprobs, is_terminals)
+            from commonml import rl
+            if self.log.committed > 0:
+                states, actions, rewards, logprobs, is_terminals = self.log.read(last=self.window)
+                self.memory = rl.Memory(states, actions, rewards, logprobs, is_terminals)
+            else:
+                self.memory = rl.Memory(maxlen=self.window)
         if weights:
+            import torch
             self.agent.policy.load_state_dict(torch.load(self.local_storage_dir / 'weights.pt'))
 
 
+    def close(self):
+        """
+        Commits experiences and waits until they are written, and for a
+        background update to finish, whose weights are then loaded and saved.
+        """
+        self.log.close()
+        self.learner.join()
+        if self.learner.swap():
+            self.save(weights=True, memory=False)
+
+
     def predict(self, X: pd.DataFrame) -> Tuple[np.ndarray, ...]:
         self.t += 1
         reward = self.reward(X)
         action, logprob = self.agent.predict(X.to_numpy().reshape(1, -1))
         if not (self._last_action is None or self._last_state is None or self._last_logprob is None):
-            self.memory.add(self._last_state, self._last_action, self._last_logprob, reward, False)
+            self.remember(self._last_state, self._last_action, self._last_logprob, reward, False)
         if self.t % self.save_interval == 0 and self.t > 0:
             self.save(memory=True, weights=False)
         self._last_state = X
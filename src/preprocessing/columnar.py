@@ -0,0 +1,329 @@
+"""
+Columnar binary datasets, as an alternative to CSV files which are slow to
+parse. A dataset is a directory of Parquet (or Feather) files partitioned by
+month of a UTC timestamp index, with float32 columns:
+
+```
+dataset/
+    month=2018-01/part-00000.parquet
+    month=2018-02/part-00000.parquet
+    ...
+```
+
+Reading supports selecting columns, and a time range which only reads the
+needed months (and row groups, for Parquet). Requires `pyarrow`.
+
+Usage:
+
+* Import to use functions, e.g. `load()` instead of `pd.read_csv`:
+
+```
+df = load('Chillers', columns=['TempCondIn', 'PowChi'], start='2019-06-01')
+```
+
+* Call from command line to convert CSV files, or benchmark against CSV:
+
+```
+python -m preprocessing.columnar --help
+python -m preprocessing.columnar [CSV, [CSV,...]] [--format feather]
+python -m preprocessing.columnar --benchmark
+```
+"""
+
+import os
+import shutil
+from typing import Iterable, Union
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# File extension for each format of dataset files
+FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+# Name of the partitioning field, in directory names as month=YYYY-MM
+PARTITION = 'month'
+
+
+
+def _utc(t: Union[str, datetime, pd.Timestamp]) -> pd.Timestamp:
+    # Timestamps without timezone are taken to be UTC
+    t = pd.Timestamp(t)
+    return t.tz_localize('UTC') if t.tzinfo is None else t.tz_convert('UTC')
+
+
+
+def to_columnar(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts a dataframe to the types stored in datasets: a UTC `DatetimeIndex`
+    (timestamps without timezone are taken to be UTC) named `Time` if
+    unnamed, and float32 columns. Values that are not numbers become NaN.
+    """
+    index = pd.to_datetime(df.index, utc=True)
+    columns = {c: pd.to_numeric(df[c], errors='coerce').to_numpy(dtype=np.float32)
+               for c in df.columns}
+    return pd.DataFrame(columns, index=index.rename(df.index.name or 'Time'))
+
+
+
+class DatasetWriter:
+    """
+    Writes dataframes to a new dataset, in one or more calls to `write()`, e.g.
+    one per chunk of a large file. Files are written to a temporary directory
+    which replaces `path` on `close()`, so readers never see a partial dataset.
+    Use as a context manager to close automatically, or discard the files if
+    an exception is raised.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the dataset.
+    format : str, optional
+        'parquet' or 'feather', by default 'parquet'.
+    append : bool, optional
+        Add files to the existing dataset at `path`, if any, instead of
+        replacing it. Readers may see the files of a partial write, which are
+        removed if it is discarded. By default False.
+    """
+
+
+    def __init__(self, path: str, format: str='parquet', append: bool=False):
+        if format not in FORMATS:
+            raise ValueError('format must be one of {}.'.format(', '.join(FORMATS)))
+        self.path = os.path.abspath(path)
+        self.format = format
+        self.append = append and os.path.isdir(self.path)
+        self.parts = 0
+        self.rows = 0
+        self._files = []
+        if self.append:
+            self._dir = self.path
+            self._first = 1 + max((int(name[5:10]) for _, _, files in os.walk(self.path)
+                                   for name in files if name.startswith('part-')), default=-1)
+        else:
+            self._dir = self.path + '.tmp'
+            self._first = 0
+            shutil.rmtree(self._dir, ignore_errors=True)
+            os.makedirs(self._dir)
+
+
+    def write(self, df: pd.DataFrame):
+        """
+        Writes rows of a dataframe to the month partitions of the dataset. The
+        columns should be the same in every call.
+        """
+        import pyarrow as pa
+        df = to_columnar(df)
+        months = df.index.strftime('%Y-%m')
+        for month in np.unique(months):
+            directory = os.path.join(self._dir, '{}={}'.format(PARTITION, month))
+            os.makedirs(directory, exist_ok=True)
+            name = os.path.join(directory, 'part-{:05d}{}'.format(self._first + self.parts,
+                                                                  FORMATS[self.format]))
+            table = pa.Table.from_pandas(df[months == month], preserve_index=True)
+            self._files.append(name)
+            if self.format == 'parquet':
+                import pyarrow.parquet as pq
+                pq.write_table(table, name)
+            else:
+                import pyarrow.feather as feather
+                feather.write_feather(table, name)
+        self.parts += 1
+        self.rows += len(df)
+
+
+    def close(self):
+        """
+        Replaces the dataset at `path`, if any, with the written files.
+        """
+        if self._dir is None:
+            return
+        if not self.append:
+            old = self.path + '.old'
+            shutil.rmtree(old, ignore_errors=True)
+            if os.path.exists(self.path):
+                os.replace(self.path, old)
+            os.replace(self._dir, self.path)
+            shutil.rmtree(old, ignore_errors=True)
+        self._dir = None
+
+
+    def discard(self):
+        """
+        Removes the written files, leaving any existing dataset unchanged.
+        """
+        if self._dir is None:
+            return
+        if self.append:
+            for name in self._files:
+                if os.path.exists(name):
+                    os.remove(name)
+        else:
+            shutil.rmtree(self._dir, ignore_errors=True)
+        self._dir = None
+
+
+    def __enter__(self) -> 'DatasetWriter':
+        return self
+
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+
+def write_dataset(df: pd.DataFrame, path: str, format: str='parquet'):
+    """
+    Writes a dataframe to a dataset directory, replacing any existing one.
+    See `DatasetWriter`.
+    """
+    with DatasetWriter(path, format=format) as writer:
+        writer.write(df)
+
+
+
+def _dataset_format(path: str) -> str:
+    for _, _, files in os.walk(path):
+        for name in files:
+            for format, ext in FORMATS.items():
+                if name.endswith(ext):
+                    return format
+    raise FileNotFoundError('No dataset files in {}'.format(path))
+
+
+
+def read_dataset(path: str, columns: Iterable[str]=None, start: Union[str, datetime]=None,
+                 end: Union[str, datetime]=None) -> pd.DataFrame:
+    """
+    Reads a dataset written by `DatasetWriter`. Only the months, and for
+    Parquet the row groups, which overlap the time range are read.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the dataset.
+    columns : Iterable[str], optional
+        Columns to read, by default all.
+    start, end : Union[str, datetime], optional
+        Inclusive time range of rows to read, by default all. Timestamps
+        without timezone are taken to be UTC.
+
+    Returns
+    -------
+    pd.DataFrame
+        Rows in time order, indexed by UTC time.
+    """
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format=_dataset_format(path), partitioning='hive')
+    index = dataset.schema.pandas_metadata['index_columns'][0]
+    expr = None
+    for bound, op in ((start, '__ge__'), (end, '__le__')):
+        if bound is None:
+            continue
+        bound = _utc(bound)
+        # Prune month directories, then rows
+        cond = getattr(ds.field(PARTITION), op)(bound.strftime('%Y-%m')) & \
+               getattr(ds.field(index), op)(bound)
+        expr = cond if expr is None else expr & cond
+    if columns is not None:
+        columns = [index] + [c for c in columns if c != index]
+    else:
+        columns = [c for c in dataset.schema.names if c != PARTITION]
+    df = dataset.to_table(columns=columns, filter=expr).to_pandas()
+    return df.sort_index()
+
+
+
+def load(path: str, columns: Iterable[str]=None, start: Union[str, datetime]=None,
+         end: Union[str, datetime]=None) -> pd.DataFrame:
+    """
+    Loads a time-indexed table from a dataset directory (see `read_dataset()`),
+    a single Parquet/Feather file, or a CSV file with timestamps in the first
+    column. Use instead of `pd.read_csv(path, index_col=0, parse_dates=True)`
+    so the same code works with all formats. See `read_dataset()` for
+    arguments. The index is always UTC.
+    """
+    if os.path.isdir(path):
+        return read_dataset(path, columns=columns, start=start, end=end)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == FORMATS['parquet']:
+        df = pd.read_parquet(path, columns=None if columns is None else list(columns))
+    elif ext == FORMATS['feather']:
+        import pyarrow.feather as feather
+        df = feather.read_table(path).to_pandas()
+        df = df if columns is None else df[list(columns)]
+    else:
+        usecols = None
+        if columns is not None:
+            index = pd.read_csv(path, nrows=0).columns[0]
+            usecols = [index] + [c for c in columns if c != index]
+        df = pd.read_csv(path, index_col=0, parse_dates=True, usecols=usecols)
+    # Timestamps may have mixed UTC offsets, e.g. CST and CDT
+    df.index = pd.to_datetime(df.index, utc=True)
+    if start is not None:
+        df = df[df.index >= _utc(start)]
+    if end is not None:
+        df = df[df.index <= _utc(end)]
+    return df
+
+
+
+def _benchmark(rows: int, columns: int, directory: str):
+    from time import perf_counter
+
+    def size(path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(path) for f in fs)
+
+    random = np.random.RandomState(0)
+    index = pd.date_range('2018-01-01', periods=rows, freq='5min', tz='UTC', name='Time')
+    names = ['Col{}'.format(i) for i in range(columns)]
+    df = pd.DataFrame(random.uniform(0, 100, (rows, columns)), index=index, columns=names)
+    csv = os.path.join(directory, 'data.csv')
+    df.to_csv(csv)
+    paths = {'csv': csv}
+    for format in FORMATS:
+        paths[format] = os.path.join(directory, format)
+        write_dataset(df, paths[format], format=format)
+
+    month = pd.Period(index[len(index) // 2].tz_localize(None), 'M')
+    queries = (('all', {}), ('2 columns', dict(columns=names[:2])),
+               ('1 month', dict(start=month.start_time, end=month.end_time)))
+    print('{} rows x {} columns'.format(rows, columns))
+    for format, path in paths.items():
+        line = '{:>8}: {:6.1f} MB'.format(format, size(path) / 1e6)
+        for name, kwargs in queries:
+            start = perf_counter()
+            load(path, **kwargs)
+            line += ', {} {:.3f}s'.format(name, perf_counter() - start)
+        print(line)
+
+
+
+if __name__ == '__main__':
+    from glob import glob
+    from argparse import ArgumentParser
+    from tempfile import TemporaryDirectory
+
+    parser = ArgumentParser(description='Convert CSV files to columnar datasets.')
+    parser.add_argument('paths', help='CSV files to convert. Datasets are written to '
+                        'directories with the same name without extension.', nargs='*')
+    parser.add_argument('--format', choices=list(FORMATS), default='parquet',
+                        help='Format of dataset files.')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+                        help='Compare load times and sizes of CSV and datasets.')
+    parser.add_argument('--rows', type=int, default=3 * 365 * 288,
+                        help='Rows of benchmark data, by default 3 years at 5 minute intervals.')
+    parser.add_argument('--columns', type=int, default=20, help='Columns of benchmark data.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        with TemporaryDirectory() as directory:
+            _benchmark(args.rows, args.columns, directory)
+    for path in args.paths:
+        for csv in glob(path):
+            write_dataset(load(csv), os.path.splitext(csv)[0], format=args.format)
@@ -0,0 +1,198 @@
+"""
+Table-backed psychrometric functions. `PsychrometricTables` precomputes the
+iterative `thermo.ambient` solver over a grid of wet bulb temperature and
+relative humidity, and evaluates it by interpolation at a fixed cost per
+sample, several times faster than the solver. The closed form formulas
+(`wetbulb`, `dewpoint`, `vaporpressure`) are faster than a table lookup, so
+they are evaluated exactly. Tables are cached to disk.
+
+Usage:
+
+```
+from preprocessing.psychrometrics import PsychrometricTables
+psy = PsychrometricTables()
+psy.ambient(tw, rh)     # same arguments as thermo.ambient
+psy.errors['ambient']   # interpolation error bound, Kelvin
+```
+"""
+
+import hashlib
+import os
+from tempfile import gettempdir
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+from .thermo import wetbulb, dewpoint, ambient, vaporpressure, c2k
+
+
+# Incremented when the formulas change, to invalidate cached tables
+_VERSION = 2
+# Default directory for cached tables
+DEFAULT_CACHE_DIR = os.environ.get('PSYCHROMETRICS_CACHE',
+                                   os.path.join(gettempdir(), 'psychrometrics'))
+
+
+
+class PsychrometricTables:
+    """
+    Psychrometric functions with the interface of `thermo`, in Kelvin and
+    fractions [0-1]. `ambient` is evaluated by bilinear interpolation over a
+    uniform grid. Inputs outside the grid are evaluated with the exact solver.
+    NaN inputs give NaN. `wetbulb`, `dewpoint` and `vaporpressure` are the
+    exact formulas, which are faster than interpolation.
+
+    Error bound: within a cell of size `h_t` x `h_rh`, the error of bilinear
+    interpolation of `f` is at most
+    `(h_t^2 max|d2f/dt2| + h_rh^2 max|d2f/drh2|) / 8`, which is largest near
+    cell centers. The error of the table is measured at the center of every
+    cell when it is built, and is available in `errors`. For the default
+    grid the measured error is under 0.007K.
+
+    Parameters
+    ----------
+    t_range : Tuple[float, float], optional
+        Range of wet bulb temperature in Kelvin, by default -30C to 60C.
+    rh_range : Tuple[float, float], optional
+        Range of relative humidity, by default 0.05 to 1.
+    t_step : float, optional
+        Grid spacing of temperature in Kelvin, by default 0.25.
+    rh_step : float, optional
+        Grid spacing of relative humidity, by default 0.0025.
+    cache_dir : str, optional
+        Directory where tables are saved and loaded from, by default
+        `DEFAULT_CACHE_DIR` (the `PSYCHROMETRICS_CACHE` environment variable,
+        or a temporary directory). None to not cache.
+
+    Attributes
+    ----------
+    errors : Dict[str, float]
+        Maximum absolute interpolation error at cell centers of each table,
+        i.e. 'ambient', in Kelvin.
+    """
+
+
+    def __init__(self, t_range: Tuple[float, float]=(c2k(-30.), c2k(60.)),
+                 rh_range: Tuple[float, float]=(0.05, 1.), t_step: float=0.25,
+                 rh_step: float=0.0025, cache_dir: str=DEFAULT_CACHE_DIR):
+        nt = int(round((t_range[1] - t_range[0]) / t_step)) + 1
+        nrh = int(round((rh_range[1] - rh_range[0]) / rh_step)) + 1
+        self.t = np.linspace(t_range[0], t_range[1], nt)
+        self.rh = np.linspace(rh_range[0], rh_range[1], nrh)
+        self._t0, self._dt = self.t[0], self.t[1] - self.t[0]
+        self._rh0, self._drh = self.rh[0], self.rh[1] - self.rh[0]
+        self.cache_dir = cache_dir
+        self.tables, self.errors = self._load_or_build()
+
+
+    @property
+    def path(self) -> str:
+        """Path of the cached tables file for this grid."""
+        key = repr((_VERSION, self.t[0], self.t[-1], len(self.t),
+                    self.rh[0], self.rh[-1], len(self.rh)))
+        name = 'psychrometrics-{}.npz'.format(hashlib.sha1(key.encode()).hexdigest()[:12])
+        return os.path.join(self.cache_dir, name)
+
+
+    def _load_or_build(self) -> Tuple[Dict[str, np.ndarray], Dict[str, float]]:
+        if self.cache_dir is not None and os.path.exists(self.path):
+            with np.load(self.path) as f:
+                tables = {k[6:]: f[k] for k in f.files if k.startswith('table_')}
+                errors = {k[6:]: float(f[k]) for k in f.files if k.startswith('error_')}
+            return tables, errors
+        tables, errors = self.build()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Written to a temporary file first so concurrent readers never
+            # see a partial file.
+            tmp = '{}.{}.tmp.npz'.format(self.path[:-4], os.getpid())
+            np.savez(tmp, **{'table_' + k: v for k, v in tables.items()},
+                     **{'error_' + k: v for k, v in errors.items()})
+            os.replace(tmp, self.path)
+        return tables, errors
+
+
+    def build(self) -> Tuple[Dict[str, np.ndarray], Dict[str, float]]:
+        """
+        Evaluates the exact formulas over the grid, and measures the
+        interpolation error at cell centers. Returns dictionaries of tables and
+        errors.
+        """
+        T, RH = np.meshgrid(self.t, self.rh, indexing='ij')
+        tables = dict(ambient=ambient(T, RH))
+        self.tables = tables
+        tc = 0.5 * (self.t[1:] + self.t[:-1])
+        rhc = 0.5 * (self.rh[1:] + self.rh[:-1])
+        TC, RHC = np.meshgrid(tc, rhc, indexing='ij')
+        errors = dict(ambient=float(np.nanmax(np.abs(self.ambient(TC, RHC) - ambient(TC, RHC)))))
+        return tables, errors
+
+
+    def _bilinear(self, name: str, exact: Callable, t, rh) -> np.ndarray:
+        scalar = np.ndim(t) == 0 and np.ndim(rh) == 0
+        t, rh = np.broadcast_arrays(np.asarray(t, dtype=float), np.asarray(rh, dtype=float))
+        x = (t - self._t0) / self._dt
+        y = (rh - self._rh0) / self._drh
+        nt, nrh = len(self.t), len(self.rh)
+        inside = (x >= 0) & (x <= nt - 1) & (y >= 0) & (y <= nrh - 1)
+        x, y = np.where(inside, x, 0.), np.where(inside, y, 0.)
+        i = np.minimum(x.astype(np.intp), nt - 2)
+        j = np.minimum(y.astype(np.intp), nrh - 2)
+        fx, fy = x - i, y - j
+        table = self.tables[name].ravel()
+        k = i * nrh + j
+        # Interpolate along t at rh[j] and rh[j+1], then along rh
+        value = table.take(k)
+        value += (table.take(k + nrh) - value) * fx
+        upper = table.take(k + 1)
+        upper += (table.take(k + nrh + 1) - upper) * fx
+        value += (upper - value) * fy
+        outside = ~inside
+        if np.any(outside):
+            value = np.asarray(value)
+            value[outside] = exact(t[outside], rh[outside])
+        return float(value) if scalar else value
+
+
+    def ambient(self, tw: float, rh: float) -> float:
+        """Interpolated `thermo.ambient`."""
+        return self._bilinear('ambient', ambient, tw, rh)
+
+
+    # Exact closed form formulas, faster than interpolation
+    wetbulb = staticmethod(wetbulb)
+    dewpoint = staticmethod(dewpoint)
+    vaporpressure = staticmethod(vaporpressure)
+
+
+
+if __name__ == '__main__':
+    # Benchmark the table against the exact solver:
+    # python -m preprocessing.psychrometrics --help
+    from argparse import ArgumentParser
+    from time import perf_counter
+    from .thermo import f2k
+
+    parser = ArgumentParser(description='Benchmark psychrometric tables vs. exact solver.')
+    parser.add_argument('-n', '--rows', type=int, default=3 * 365 * 288,
+                        help='Number of samples, by default 3 years at 5 minute intervals.')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='Build tables without reading or writing the disk cache.')
+    args = parser.parse_args()
+
+    start = perf_counter()
+    psy = PsychrometricTables(cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR)
+    print('Tables ready in {:.3f}s. Cell center errors: {}'.format(
+          perf_counter() - start, ', '.join('{} {:.1e}'.format(k, v) for k, v in psy.errors.items())))
+
+    random = np.random.RandomState(0)
+    t = f2k(random.uniform(10, 110, args.rows))
+    rh = random.uniform(0.05, 0.99, args.rows)
+    times = []
+    for fn in (ambient, psy.ambient):
+        start = perf_counter()
+        value = fn(t, rh)
+        times.append(perf_counter() - start)
+    error = np.nanmax(np.abs(value - ambient(t, rh)))
+    print('ambient: exact {:.3f}s, table {:.3f}s, max error {:.1e}K'.format(
+          times[0], times[1], error))
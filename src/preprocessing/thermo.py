@@ -3,10 +3,9 @@ Contains formulae for thermodynamics operations.
 """
 
 from collections import namedtuple
-from numbers import Number
+import warnings
 
 import numpy as np
-from scipy.optimize import newton
 
 # physics constants
 _Constants = namedtuple('Constants', field_names = (
@@ -142,7 +141,7 @@ def wetbulb(t: float, rh: float) -> float:
         The wet bulb temperature in Kelvin.
     """
     t = k2c(t)
-    rh *= 100   # convert from fraction to percentage
+    rh = rh * 100   # convert from fraction to percentage
     return c2k(
             t * np.arctan(0.151977 * np.sqrt(rh + 8.313659))
             + np.arctan(t + rh) - np.arctan(rh - 1.676331)
@@ -164,18 +163,36 @@ def _stull_eq(t, rh, tw):
     The root of `g(t)` is the ambient temperature. Used by `tambient()`. All
     temperatues in the equation are Celsius.
     """
-    rh *= 100   # convert from fraction to percentage
-    return - tw + (t * np.arctan(0.151977 * np.sqrt(rh + 8.313659))
-              + np.arctan(t + rh) - np.arctan(rh - 1.676331)
+    rh = rh * 100   # convert from fraction to percentage
+    slope, offset = _stull_terms(rh)
+    return - tw + t * slope + np.arctan(t + rh) + offset
+
+
+
+def _stull_terms(rh):
+    """
+    Terms of the Stull equation which only depend on relative humidity (in
+    percent), such that `f(t, rh) = t * slope + arctan(t + rh) + offset`.
+    """
+    slope = np.arctan(0.151977 * np.sqrt(rh + 8.313659))
+    offset = (- np.arctan(rh - 1.676331)
               + 0.00391838 * np.power(rh, 1.5) * np.arctan(0.023101 * rh)
               - 4.686035)
+    return slope, offset
 
 
 
-def ambient(tw: float, rh: float) -> float:
+def ambient(tw: float, rh: float, tol: float=1.48e-8, maxiter: int=50,
+            full_output: bool=False) -> float:
     """
-    Uses Roland Stull's formula and Newton's method to calculate ambient
-    temperature from wet bulb temperature and relative humidity.
+    Uses Roland Stull's formula and Halley's method to calculate ambient
+    temperature from wet bulb temperature and relative humidity. Arrays are
+    solved element-wise in one vectorized iteration.
+
+    `g(t) = f(t, rh) - tw` is strictly increasing in `t`, with slope between
+    `s = arctan(0.151977 * sqrt(rh + 8.313659))` and `s + 1`. So the root is
+    unique and within `|g(tw)| / s` of `tw`. Elements for which Halley's method
+    does not converge in `maxiter` iterations are bisected within that bracket.
 
     Parameters
     ----------
@@ -183,17 +200,111 @@ def ambient(tw: float, rh: float) -> float:
         Temperature in Kelvin.
     rh: float
         Relative humidity [0-1].
+    tol: float, optional
+        Absolute tolerance of the temperature, by default 1.48e-8.
+    maxiter: int, optional
+        Maximum number of Halley iterations, by default 50.
+    full_output: bool, optional
+        Whether to also return the number of elements which failed to
+        converge, by default False.
 
     Returns
     -------
     float
-        The ambient temperature in Kelvin.
+        The ambient temperature in Kelvin. NaN where inputs are missing or
+        the solution did not converge. If `full_output`, a tuple of the
+        temperature and the number of elements which failed to converge.
+
+    Warns
+    -----
+    RuntimeWarning
+        If any element with valid inputs failed to converge.
     """
-    tw = k2c(tw)
-    if isinstance(tw, Number) and isinstance(rh, Number):
-        return c2k(newton(_stull_eq, x0=tw, args=(rh, tw)))
-    else:
-        t = np.zeros(len(tw))
-        for i, (tw_, rh_) in enumerate(zip(tw, rh)):
-            t[i] = newton(_stull_eq, x0=tw_, args=(rh_, tw_))
-        return c2k(t)
+    scalar = np.ndim(tw) == 0 and np.ndim(rh) == 0
+    tw, rh = np.broadcast_arrays(k2c(np.asarray(tw, dtype=float)),
+                                 np.asarray(rh, dtype=float) * 100)
+    shape = tw.shape
+    tw, rh = tw.ravel(), rh.ravel()
+    with np.errstate(invalid='ignore'):
+        slope, offset = _stull_terms(rh)
+    valid = np.isfinite(tw) & np.isfinite(slope) & np.isfinite(offset) & (slope > 0)
+    t = np.where(valid, tw, np.nan)     # initial guess is the wet bulb temperature
+
+    # Halley's iterations, only on elements which have not converged
+    idx = np.flatnonzero(valid)
+    diverged = []
+    with np.errstate(all='ignore'):
+        for _ in range(maxiter):
+            if len(idx) == 0:
+                break
+            ti, ri = t[idx], rh[idx]
+            s = ti + ri
+            q = 1. / (1. + s * s)
+            g = ti * slope[idx] + np.arctan(s) + offset[idx] - tw[idx]
+            d1 = slope[idx] + q             # g'(t)
+            d2 = -2. * s * q * q            # g''(t)
+            step = 2. * g * d1 / (2. * d1 * d1 - g * d2)
+            ok = np.isfinite(step)
+            t[idx[ok]] = ti[ok] - step[ok]
+            diverged.append(idx[~ok])
+            idx = idx[ok & (np.abs(step) > tol)]
+        idx = np.concatenate([idx] + diverged)
+
+        # Bisection for the rest, within the bracket around the wet bulb temperature
+        if len(idx) > 0:
+            ri, si, oi, twi = rh[idx], slope[idx], offset[idx], tw[idx]
+            g0 = twi * si + np.arctan(twi + ri) + oi - twi
+            lo = np.where(g0 > 0, twi - g0 / si, twi)
+            hi = np.where(g0 > 0, twi, twi - g0 / si)
+            for _ in range(200):
+                mid = 0.5 * (lo + hi)
+                gm = mid * si + np.arctan(mid + ri) + oi - twi
+                lo = np.where(gm < 0, mid, lo)
+                hi = np.where(gm < 0, hi, mid)
+                if np.all(hi - lo <= tol):
+                    break
+            t[idx] = np.where(hi - lo <= tol, 0.5 * (lo + hi), np.nan)
+
+    failed = int(np.count_nonzero(valid & ~np.isfinite(t)))
+    if failed > 0:
+        warnings.warn('ambient() failed to converge for {} of {} elements.'.format(
+                      failed, int(valid.sum())), RuntimeWarning)
+    t = c2k(t).reshape(shape)
+    if scalar:
+        t = float(t)
+    return (t, failed) if full_output else t
+
+
+
+if __name__ == '__main__':
+    # Benchmark ambient() against scipy's newton per element:
+    # python -m preprocessing.thermo --help
+    from argparse import ArgumentParser
+    from time import perf_counter
+    from scipy.optimize import newton
+
+    parser = ArgumentParser(description='Benchmark vectorized ambient temperature solver.')
+    parser.add_argument('-n', '--rows', type=int, default=3 * 365 * 288,
+                        help='Number of samples, by default 3 years at 5 minute intervals.')
+    parser.add_argument('--loop-rows', type=int, default=2000,
+                        help='Number of samples for the per-element newton loop.')
+    args = parser.parse_args()
+
+    random = np.random.RandomState(0)
+    rh = random.uniform(0.05, 0.99, args.rows)
+    tw = wetbulb(f2k(random.uniform(10, 110, args.rows)), rh)
+
+    start = perf_counter()
+    t, failed = ambient(tw, rh, full_output=True)
+    elapsed = perf_counter() - start
+    print('ambient(): {} rows in {:.3f}s, {} failed to converge, max error {:.1e}K'.format(
+          args.rows, elapsed, failed, np.abs(wetbulb(t, rh) - tw).max()))
+
+    n = min(args.loop_rows, args.rows)
+    twc = k2c(tw[:n])
+    start = perf_counter()
+    for tw_, rh_ in zip(twc, rh[:n]):
+        newton(_stull_eq, x0=tw_, args=(rh_, tw_))
+    elapsed = perf_counter() - start
+    print('newton loop: {} rows in {:.3f}s, {:.1f}s estimated for {} rows'.format(
+          n, elapsed, elapsed * args.rows / n, args.rows))
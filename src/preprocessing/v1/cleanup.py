@@ -9,17 +9,32 @@ Usage:
 
 ```
 python -m cleanup --help
-python -m cleanup [CSV, [CSV,...]] [--keep_zeros]
+python -m cleanup [CSV, [CSV,...]] [--keep_zeros] [--tables] [--chunksize N]
+    [--format {csv,parquet,feather}] [--jobs N] [--incremental]
 ```
 
-To preprocess CSV files.
+To preprocess CSV files. Files are processed in chunks of rows and replaced
+only when complete. With `--incremental`, cleaned files are written next to
+the input (`NAME.clean.csv`) and later runs only append rows added since.
 """
-from typing import Any, List
+from contextlib import contextmanager
+from multiprocessing import Pool
+from typing import Any, BinaryIO, Callable, Dict, List, Tuple
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
 
 import numpy as np
 import pandas as pd
 
 from ..thermo import wetbulb, ambient, f2k, ton2w, gph2m3s, CONSTANTS
+from ..psychrometrics import PsychrometricTables
+from ..columnar import DatasetWriter, FORMATS
 
 
 # Temperature fields to convert to Kelvins
@@ -60,6 +75,12 @@ POW_FIELDS = (
     'PowChiP',
     'PowConP'
 )
+# Incremented when cleanup changes, so incremental outputs are rebuilt
+_MANIFEST_VERSION = 3
+# Bytes at the start and end of output files read to check if they changed
+_SAMPLE = 1 << 20
+# Bytes read at a time when hashing files
+_BLOCK = 1 << 20
 
 
 
@@ -96,23 +117,26 @@ def standardize(df: pd.DataFrame, temp_fields=TEMP_FIELDS, kwatts_fields=KWATTS_
 
 
 
-def fill_missing_temperatures(df: pd.DataFrame) -> pd.DataFrame:
+def fill_missing_temperatures(df: pd.DataFrame, psychrometrics=None) -> pd.DataFrame:
     """
     Fills missing values for TempAmbient and TempWetBulb
-    temperature.
+    temperature. `psychrometrics` is an object with `wetbulb()` and `ambient()`
+    methods, e.g. `PsychrometricTables`, by default the exact formulas.
     """
+    wetbulb_fn = wetbulb if psychrometrics is None else psychrometrics.wetbulb
+    ambient_fn = ambient if psychrometrics is None else psychrometrics.ambient
     # Filling in estimates of Wet-Bulb temperature where absent.
     # Requires Ambient temperature and humidity values.
     if 'TempAmbient' in df.columns:
         sel = df['TempWetBulb'].isna()
-        df.loc[sel, 'TempWetBulb'] = wetbulb(df.loc[sel, 'TempAmbient'],
-                                             df.loc[sel, 'PerHumidity'])
+        df.loc[sel, 'TempWetBulb'] = wetbulb_fn(df.loc[sel, 'TempAmbient'],
+                                                df.loc[sel, 'PerHumidity'])
     # Filling in estimates of Ambient temperature where absent.
     # Requires wet-bulb temperature and relative humidity values.
     if 'TempAmbient' in df.columns:
         sel = df['TempAmbient'].isna() & ~df['TempWetBulb'].isna()
-        df.loc[sel, 'TempAmbient'] = ambient(df.loc[sel, 'TempWetBulb'],
-                                             df.loc[sel, 'PerHumidity'])
+        df.loc[sel, 'TempAmbient'] = ambient_fn(df.loc[sel, 'TempWetBulb'],
+                                                df.loc[sel, 'PerHumidity'])
     return df
 
 
@@ -145,8 +169,382 @@ def calculate_derivative_fields(df: pd.DataFrame) -> pd.DataFrame:
 
 
 
+def cleanup(df: pd.DataFrame, keep_zeros: bool=False, psychrometrics=None) -> pd.DataFrame:
+    """
+    Runs all cleanup stages on a dataframe: `drop_missing_rows` (unless
+    `keep_zeros`), `standardize`, `fill_missing_temperatures`,
+    `calculate_derivative_fields`, and drops rows with missing values. Each
+    row is processed independently, so chunks of a file can be cleaned
+    separately.
+    """
+    if not keep_zeros:
+        df = drop_missing_rows(df)
+    df = standardize(df)
+    df = fill_missing_temperatures(df, psychrometrics)
+    df = calculate_derivative_fields(df)
+    df.dropna(inplace=True)
+    return df.sort_index(axis=1)
+
+
+
+def _copy_mode(output: str, tmp: str):
+    # Temporary files are only readable by their owner. They get the mode of
+    # the file they replace, or the default mode of new files.
+    if os.path.exists(output):
+        shutil.copymode(output, tmp)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+
+
+
+@contextmanager
+def _csv_writer(output: str):
+    # Yields a function to write chunks to a temporary file, which replaces
+    # `output` when all chunks are written.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)),
+                               prefix='.' + os.path.basename(output), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='') as dst:
+            yield lambda i, chunk: chunk.to_csv(dst, header=(i == 0))
+        _copy_mode(output, tmp)
+        os.replace(tmp, output)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+
+@contextmanager
+def _csv_appender(output: str):
+    # Yields a function to append chunks to `output`, which is truncated to
+    # its original size if not all chunks are written.
+    with open(output, 'a', newline='') as dst:
+        size = dst.tell()
+        try:
+            yield lambda i, chunk: chunk.to_csv(dst, header=False)
+        except BaseException:
+            dst.truncate(size)
+            raise
+
+
+
+@contextmanager
+def _dataset_writer(output: str, format: str, append: bool=False):
+    with DatasetWriter(output, format=format, append=append) as writer:
+        yield lambda i, chunk: writer.write(chunk)
+
+
+
+class _ByteRange(io.RawIOBase):
+    # Reads bytes [start, end) of a file, counts the lines read and adds the
+    # bytes read to `digest`, if given
+    def __init__(self, f: BinaryIO, start: int, end: int, digest=None):
+        f.seek(start)
+        self._f, self.start, self.position, self.end = f, start, start, end
+        self.lines = 0
+        self.digest = digest
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        view = memoryview(b)[:max(min(len(b), self.end - self.position), 0)]
+        n = self._f.readinto(view)
+        self.position += n
+        self.lines += bytes(view[:n]).count(b'\n')
+        if self.digest is not None:
+            self.digest.update(view[:n])
+        return n
+
+    def consumed(self, lines: int) -> int:
+        # Position after the first `lines` lines, estimated from the mean
+        # length of lines read, which include the reader's read-ahead
+        if lines >= self.lines:
+            return self.position
+        return self.start + (self.position - self.start) * lines // self.lines
+
+
+
+def _complete_size(f: BinaryIO) -> int:
+    # Size of the complete lines of a file. A partly written last line is
+    # ignored.
+    end = f.seek(0, os.SEEK_END)
+    while end > 0:
+        f.seek(max(end - 65536, 0))
+        block = f.read(end - max(end - 65536, 0))
+        if b'\n' in block:
+            return end - (len(block) - block.rindex(b'\n') - 1)
+        end -= len(block)
+    return end
+
+
+
+def _prefix_digest(f: BinaryIO, end: int):
+    # SHA-256 hash of the first `end` bytes of a file. Returned unfinished, so
+    # bytes after `end` can be added to it as they are read.
+    digest = hashlib.sha256()
+    f.seek(0)
+    position = 0
+    while position < end:
+        block = f.read(min(_BLOCK, end - position))
+        if not block:
+            break
+        digest.update(block)
+        position += len(block)
+    return digest
+
+
+
+def _sample_digest(f: BinaryIO, end: int) -> str:
+    # SHA-256 digest of the first and last _SAMPLE bytes before `end`, so
+    # changes near the start and end of a file are found without reading it
+    # all.
+    digest = hashlib.sha256(str(end).encode())
+    for start, stop in ((0, min(_SAMPLE, end)), (max(end - _SAMPLE, _SAMPLE), end)):
+        f.seek(start)
+        digest.update(f.read(max(stop - start, 0)))
+    return digest.hexdigest()
+
+
+
+def _stat_output(output: str) -> List[List]:
+    # Relative path, size and modification time of an output file, or of the
+    # files in an output directory. None if it does not exist.
+    if not os.path.exists(output):
+        return None
+    if os.path.isfile(output):
+        names = [output]
+    else:
+        names = sorted(os.path.join(d, f) for d, _, files in os.walk(output) for f in files)
+    stats = []
+    for name in names:
+        st = os.stat(name)
+        stats.append([os.path.relpath(name, output), st.st_size, st.st_mtime_ns])
+    return stats
+
+
+
+def _output_sample(output: str) -> str:
+    # Sample digest of an output file, None for directories
+    if not os.path.isfile(output):
+        return None
+    with open(output, 'rb') as f:
+        return _sample_digest(f, f.seek(0, os.SEEK_END))
+
+
+
+def _output_unchanged(output: str, manifest: Dict[str, Any]) -> bool:
+    stats = _stat_output(output)
+    if stats == manifest['output_stat']:
+        return True
+    # A copied or touched file has another modification time, but the same
+    # size and contents
+    return stats is not None and [s[:2] for s in stats] == \
+           [s[:2] for s in manifest['output_stat']] and \
+           _output_sample(output) == manifest['output_sample']
+
+
+
+def manifest_path(output: str) -> str:
+    """Path of the manifest of an output of incremental `cleanup_csv()`."""
+    return os.path.abspath(output) + '.manifest.json'
+
+
+
+def read_manifest(output: str) -> Dict[str, Any]:
+    """
+    Reads the manifest of an output of incremental `cleanup_csv()`. Returns
+    None if there is none. The manifest records the `source` file, its
+    `header`, the number of bytes processed (`source_bytes`) and their SHA-256
+    digest (`source_digest`), the latest
+    timestamp processed (`last_time`), total `rows_in` and `rows_out`, the
+    relative path, size and modification time of each output file
+    (`output_stat`), the digest of the first and last MB of an output file
+    (`output_sample`) and the `options` used.
+    """
+    try:
+        with open(manifest_path(output), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+
+def _write_manifest(output: str, manifest: Dict[str, Any]):
+    path = manifest_path(output)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    _copy_mode(path, tmp)
+    os.replace(tmp, path)
+
+
+
+def cleanup_csv(path: str, output: str=None, chunksize: int=100000, keep_zeros: bool=False,
+                psychrometrics=None, progress: Callable[[Dict[str, float]], None]=None,
+                format: str='csv', incremental: bool=False) -> Dict[str, float]:
+    """
+    Cleans a CSV file (see `cleanup()`) in chunks of `chunksize` rows, so memory
+    use is bounded regardless of file size. Output is written to a temporary
+    file in the same directory, which replaces `output` only when complete.
+
+    If `incremental`, a manifest saved next to `output` (see `read_manifest()`)
+    records how much of `path` was processed. On later calls only rows added to
+    the end of `path` since, and later than the last processed timestamp, are
+    cleaned and appended to `output`. The output is rebuilt from scratch if
+    the processed part of `path` was edited, `output` was changed, or the
+    options differ. An append which fails is undone, so `output` always
+    matches the manifest. Edits are found from a digest of the processed part
+    of `path`, which is read again but only the new rows are parsed. Changes
+    to `output` are found from its size and modification time, or its first
+    and last MB if only the time changed.
+
+    Parameters
+    ----------
+    path : str
+        CSV file with a `Time` column.
+    output : str, optional
+        Path of the cleaned CSV, by default `path` (overwritten), or
+        `NAME.clean.csv` for `path` `NAME.csv` if `incremental`. For datasets,
+        by default `path` without extension.
+    chunksize : int, optional
+        Rows per chunk, by default 100000. None to read the whole file at once.
+    keep_zeros : bool, optional
+        Keep rows with 0 power values, by default False.
+    psychrometrics : Any, optional
+        See `fill_missing_temperatures()`.
+    progress : Callable[[Dict[str, float]], None], optional
+        Called after each chunk with the statistics so far (see Returns).
+    format : str, optional
+        'csv', or 'parquet'/'feather' to write a columnar dataset directory
+        (see `preprocessing.columnar`). By default 'csv'.
+    incremental : bool, optional
+        Only process rows added since the last incremental call, by default
+        False.
+
+    Returns
+    -------
+    Dict[str, float]
+        `rows_in`, `rows_out`, `bytes_read` (position in `path` of the last
+        row read, estimated during the call), `bytes_total`, `seconds`, and
+        `rows_per_second` of this call, and whether the output was `rebuilt`
+        from scratch (always True if not `incremental`).
+    """
+    if output is None:
+        if format != 'csv':
+            output = os.path.splitext(path)[0]
+        else:
+            output = os.path.splitext(path)[0] + '.clean.csv' if incremental else path
+    if incremental and os.path.abspath(output) == os.path.abspath(path):
+        raise ValueError('Incremental cleanup needs an output other than the input file.')
+    start = time.perf_counter()
+    begin, header, last_time, digest = 0, None, None, None
+    end = os.path.getsize(path)
+    if incremental:
+        options = dict(keep_zeros=keep_zeros, format=format,
+                       psychrometrics=None if psychrometrics is None else
+                                      type(psychrometrics).__name__)
+        manifest = read_manifest(output)
+        with open(path, 'rb') as f:
+            end = _complete_size(f)
+            if manifest is not None and manifest.get('version') == _MANIFEST_VERSION \
+                and manifest['options'] == options and manifest['source_bytes'] <= end \
+                and _output_unchanged(output, manifest):
+                digest = _prefix_digest(f, manifest['source_bytes'])
+                if digest.hexdigest() == manifest['source_digest']:
+                    begin, header = manifest['source_bytes'], manifest['header']
+                    last_time = pd.Timestamp(manifest['last_time'])
+                else:
+                    digest = None
+            if digest is None:
+                digest = hashlib.sha256()
+    stats = dict(rows_in=0, rows_out=0, bytes_read=begin, bytes_total=end,
+                 seconds=0., rows_per_second=0., rebuilt=header is None)
+    if begin == end:
+        return stats
+    if header is None:
+        writer = _csv_writer(output) if format == 'csv' else _dataset_writer(output, format)
+    else:
+        writer = _csv_appender(output) if format == 'csv' else \
+                 _dataset_writer(output, format, append=True)
+    with open(path, 'rb') as f, writer as write:
+        src = _ByteRange(f, begin, end, digest)
+        chunks = pd.read_csv(io.BufferedReader(src), index_col='Time', parse_dates=True,
+                             dtype=float, chunksize=chunksize, header=None if header else 'infer',
+                             names=header)
+        for i, chunk in enumerate([chunks] if chunksize is None else chunks):
+            if header is None:
+                header = [chunk.index.name] + list(chunk.columns)
+            stats['rows_in'] += len(chunk)
+            if incremental and len(chunk):
+                # Timestamps may have mixed UTC offsets, e.g. CST and CDT
+                times = pd.to_datetime(chunk.index, utc=True)
+                if last_time is not None:
+                    chunk = chunk[times > last_time]
+                last_time = max(times.max(), last_time or times.max())
+            chunk = cleanup(chunk, keep_zeros=keep_zeros, psychrometrics=psychrometrics)
+            write(i if stats['rebuilt'] else i + 1, chunk)
+            stats['rows_out'] += len(chunk)
+            stats['bytes_read'] = src.consumed(stats['rows_in'] + (1 if stats['rebuilt'] else 0))
+            stats['seconds'] = time.perf_counter() - start
+            stats['rows_per_second'] = stats['rows_in'] / max(stats['seconds'], 1e-9)
+            if progress is not None:
+                progress(stats)
+        if digest is not None:
+            # Bytes the reader did not ask for, if any, are still hashed
+            src.readall()
+    if incremental:
+        previous = dict(rows_in=0, rows_out=0) if stats['rebuilt'] else manifest
+        _write_manifest(output, dict(
+            version=_MANIFEST_VERSION, source=os.path.abspath(path), header=header,
+            source_bytes=end, source_digest=digest.hexdigest(),
+            last_time=None if last_time is None else last_time.isoformat(),
+            rows_in=previous['rows_in'] + stats['rows_in'],
+            rows_out=previous['rows_out'] + stats['rows_out'],
+            output_stat=_stat_output(output), output_sample=_output_sample(output),
+            options=options))
+    return stats
+
+
+
+def _cleanup_file(args: Tuple[str, Dict[str, Any]]) -> Dict[str, float]:
+    """Multi-processing payload function used by cleanup_files"""
+    path, kwargs = args
+    return cleanup_csv(path, **kwargs)
+
+
+
+def cleanup_files(paths: List[str], jobs: int=1, **kwargs) -> List[Dict[str, float]]:
+    """
+    Cleans CSV files with `cleanup_csv()` in a pool of `jobs` processes, one
+    file per process at a time. Keyword arguments are passed to
+    `cleanup_csv()`, except `progress` which is not supported with more than
+    one job. Returns statistics for each file in the order of `paths`, with
+    `path` added.
+    """
+    if jobs > 1 and kwargs.get('progress') is not None:
+        raise ValueError('progress is not supported with more than one job.')
+    tasks = [(path, kwargs) for path in paths]
+    if jobs <= 1:
+        results = [_cleanup_file(task) for task in tasks]
+    else:
+        with Pool(min(jobs, len(tasks))) as pool:
+            results = pool.map(_cleanup_file, tasks, chunksize=1)
+    return [dict(stats, path=path) for path, stats in zip(paths, results)]
+
+
+
+def print_progress(stats: Dict[str, float]):
+    """Prints statistics from `cleanup_csv()` on one updating line."""
+    print('\r{:5.1f}% {:>10d} rows in {:>10d} rows out {:>10.0f} rows/s'.format(
+          100 * stats['bytes_read'] / max(stats['bytes_total'], 1), stats['rows_in'],
+          stats['rows_out'], stats['rows_per_second']), end='', file=sys.stderr, flush=True)
+
+
+
 if __name__ == '__main__':
-    import os
     from os.path import abspath, join
     from glob import glob
     from argparse import ArgumentParser
@@ -158,15 +556,44 @@ if __name__ == '__main__':
                         nargs='*')
     parser.add_argument('--keep_zeros', help='Keep rows with 0 power values.',
                         action='store_true', default=False)
+    parser.add_argument('--tables', help='Use an interpolated table for ambient temperature.',
+                        action='store_true', default=False)
+    parser.add_argument('--chunksize', help='Rows processed at a time. 0 for whole file.',
+                        type=int, default=100000)
+    parser.add_argument('--quiet', help='Do not report progress.',
+                        action='store_true', default=False)
+    parser.add_argument('--format', help='Output format. Datasets are written to a directory '
+                        'with the name of the file without extension.', default='csv',
+                        choices=['csv'] + list(FORMATS))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of files cleaned in parallel. If more than 1, per-file '
+                             'timings are printed when all files are done.')
+    parser.add_argument('--incremental', help='Only clean rows added since the last '
+                        'incremental run. CSVs are written to NAME.clean.csv.',
+                        action='store_true', default=False)
     args = parser.parse_args()
+    psychrometrics = PsychrometricTables() if args.tables else None
+    paths = [csv for path in args.paths for csv in sorted(glob(path))
+             # Outputs of earlier incremental runs
+             if not (args.incremental and csv.endswith('.clean.csv'))]
 
-    for path in args.paths:
-        for csv in glob(path):
-            df = pd.read_csv(csv, index_col='Time', parse_dates=True, dtype=float)
-            if not args.keep_zeros:
-                df = drop_missing_rows(df)
-            df = standardize(df)
-            df = fill_missing_temperatures(df)
-            df = calculate_derivative_fields(df)
-            df.dropna(inplace=True)
-            df.sort_index(axis=1).to_csv(csv)
+    if args.jobs > 1:
+        for stats in cleanup_files(paths, jobs=args.jobs, chunksize=args.chunksize or None,
+                                   keep_zeros=args.keep_zeros, psychrometrics=psychrometrics,
+                                   format=args.format, incremental=args.incremental):
+            if not args.quiet:
+                print('{}: {} rows in, {} rows out in {:.1f}s ({:.0f} rows/s)'.format(
+                      stats['path'], stats['rows_in'], stats['rows_out'], stats['seconds'],
+                      stats['rows_per_second']), file=sys.stderr)
+    else:
+        for csv in paths:
+            if not args.quiet:
+                print(csv, file=sys.stderr)
+            stats = cleanup_csv(csv, chunksize=args.chunksize or None,
+                                keep_zeros=args.keep_zeros, psychrometrics=psychrometrics,
+                                progress=None if args.quiet else print_progress,
+                                format=args.format, incremental=args.incremental)
+            if not args.quiet:
+                print('\n{} rows in, {} rows out in {:.1f}s{}'.format(
+                      stats['rows_in'], stats['rows_out'], stats['seconds'],
+                      ' (appended)' if not stats['rebuilt'] else ''), file=sys.stderr)
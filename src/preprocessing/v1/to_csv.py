@@ -11,18 +11,25 @@ Usage:
 
 ```
 python -m to_csv --help
-python -m to_csv [FILE, [FILE,...]]
+python -m to_csv [FILE, [FILE,...]] [--format {csv,parquet,feather}] [--jobs N]
+python -m to_csv --benchmark
 ```
 
 To carry out excel to csv conversion.
 """
 import os
+import re
+import time
+from multiprocessing import Pool
 from os.path import abspath, join, dirname, splitext, basename
+from typing import Any, Dict, List, Tuple
 
 import pandas as pd
 from dateutil.parser import parse
 from dateutil.tz import UTC
 
+from ..columnar import write_dataset, FORMATS
+
 # Timezones: a dict of TZ-code with offset from UTC in seconds
 # To make data timezone-aware, add keyword argument tzinfos=TZINFOS to `parse`
 # in the lambda function in ESB_SCHEMA['converters']['Time'], and remove ignoretz=True
@@ -37,7 +44,112 @@ ESB_SCHEMA = {
 }
 
 
-def xlsx_to_csv(xlsx: str):
+# Prefix of some cells, which is removed to allow for numeric conversion
+ARTIFACT = '???'
+# Formats of timestamps without timezone, tried in order before letting pandas
+# infer the format
+TIME_FORMATS = ('%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S')
+# Matches a trailing timezone code in TZINFOS
+_TZ_PATTERN = r'\s+({})$'.format('|'.join(re.escape(tz) for tz in TZINFOS))
+
+
+
+def _to_datetime(text: pd.Series) -> pd.Series:
+    for format in TIME_FORMATS:
+        try:
+            return pd.to_datetime(text, format=format)
+        except ValueError:
+            pass
+    return pd.to_datetime(text)
+
+
+
+def parse_times(times: pd.Series) -> pd.DatetimeIndex:
+    """
+    Converts timestamp strings ending in a timezone code of `TZINFOS`, e.g.
+    `6/1/2018 12:05:00 AM CDT`, to UTC. The timezone codes are mapped to
+    offsets, and the rest is parsed at once with the first of `TIME_FORMATS`
+    that matches all timestamps, or else a format inferred by pandas.
+    Timestamps without a known code are parsed one by one with `dateutil`,
+    as in `ESB_SCHEMA`.
+    """
+    text = pd.Series(times, dtype=object).astype(str).str.strip()
+    codes = text.str.extract(_TZ_PATTERN, expand=False)
+    known = codes.notna().to_numpy()
+    utc = pd.Series(pd.NaT, index=text.index, dtype='datetime64[ns, UTC]')
+    if known.any():
+        local = _to_datetime(text[known].str.replace(_TZ_PATTERN, '', regex=True))
+        offsets = pd.to_timedelta(codes[known].map(TZINFOS).astype(float), unit='s')
+        utc[known] = (local - offsets).dt.tz_localize('UTC')
+    if not known.all():
+        convert = ESB_SCHEMA['converters']['Time']
+        utc[~known] = pd.to_datetime([convert(t) for t in text[~known]], utc=True)
+    return pd.DatetimeIndex(utc, name='Time')
+
+
+
+def to_numbers(column: pd.Series) -> pd.Series:
+    """
+    Converts a column to numbers, removing `???` artifacts. Only cells which
+    are not already numbers are searched for artifacts. Cells which are not
+    numbers without artifacts keep their (stripped) text.
+    """
+    values = pd.to_numeric(column, errors='coerce')
+    failed = (values.isna() & column.notna()).to_numpy()
+    if not failed.any():
+        return values
+    text = column[failed].astype(str).str.replace(ARTIFACT, '', regex=False).str.strip()
+    stripped = pd.to_numeric(text, errors='coerce')
+    if stripped.isna().any():
+        values = values.astype(object)
+        stripped = stripped.astype(object).where(stripped.notna(), text)
+    values[failed] = stripped
+    return values
+
+
+
+def clean_sheet(sheet: pd.DataFrame) -> pd.DataFrame:
+    """
+    Indexes a sheet read without `ESB_SCHEMA` by UTC `Time` (see
+    `parse_times()`), and converts cells to numbers removing `???` artifacts
+    (see `to_numbers()`). Rows are sorted by time.
+    """
+    index = parse_times(sheet['Time'])
+    sheet = pd.DataFrame({col: to_numbers(sheet[col]).to_numpy()
+                          for col in sheet.columns if col != 'Time'}, index=index)
+    return sheet if index.is_monotonic_increasing else sheet.sort_index(kind='mergesort')
+
+
+
+def join_sheets(sheets: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Inner joins sheets on `Time`. Sheets indexed in sorted order are joined
+    by a single merge pass over both indexes.
+    """
+    aggregate = sheets[0]
+    for sheet in sheets[1:]:
+        aggregate = aggregate.join(sheet, how='inner')
+    return aggregate
+
+
+
+def write_output(aggregate: pd.DataFrame, xlsx: str, format: str='csv') -> str:
+    """
+    Writes joined sheets next to the excel file, as `NAME.csv` or a `NAME`
+    dataset directory. Returns the output path.
+    """
+    xl_name = splitext(basename(xlsx))[0]
+    if format == 'csv':
+        output = abspath(join(dirname(xlsx), xl_name + '.csv'))
+        aggregate.to_csv(output)
+    else:
+        output = abspath(join(dirname(xlsx), xl_name))
+        write_dataset(aggregate, output, format=format)
+    return output
+
+
+
+def xlsx_to_csv(xlsx: str, format: str='csv'):
     """
     Convert an XLSX file to a csv file with proper date-time conversion for faster
     read operations later on.
@@ -49,35 +161,167 @@ def xlsx_to_csv(xlsx: str):
 
     * `xlsx (str)`: The path to the excel file. All sheets are converted to separate
     csvs in the same directory as the excel document.
+    * `format (str)`: 'csv', or 'parquet'/'feather' to write a columnar dataset
+    directory instead (see `preprocessing.columnar`).
     """
-    xl_name = splitext(basename(xlsx))[0]
-    xl = pd.read_excel(xlsx, sheet_name=None, **ESB_SCHEMA)
-    sheets = [s for _, s in xl.items()]
-    for sheet in sheets:
-        sheet.set_index('Time', inplace=True)
-        # Some cells have '??? ' which is removed to allow for numeric conversion
-        for col in sheet.columns:
-            sheet[col] = sheet[col].astype(str).str.replace('\?\?\? ', '')
+    xl = pd.read_excel(xlsx, sheet_name=None)
+    sheets = [clean_sheet(s) for _, s in xl.items()]
+    write_output(join_sheets(sheets), xlsx, format=format)
 
-    aggregate = sheets[0]
-    for sheet in sheets[1:]:
-        aggregate = aggregate.join(sheet, on='Time', how='inner')
 
-    aggregate.to_csv(abspath(join(dirname(xlsx), xl_name + '.csv')))
 
+def _read_sheet(xlsx: str, sheet_name: str) -> Tuple[pd.DataFrame, float]:
+    """Multi-processing payload function used by convert_files"""
+    start = time.perf_counter()
+    sheet = pd.read_excel(xlsx, sheet_name=sheet_name)
+    return clean_sheet(sheet), time.perf_counter() - start
+
+
+
+def _read_sheet_task(task: Tuple[str, str]) -> Tuple[pd.DataFrame, float]:
+    return _read_sheet(*task)
+
+
+
+def _join_and_write(xlsx: str, sheets: List[pd.DataFrame], format: str) -> Tuple[str, float]:
+    """Multi-processing payload function used by convert_files"""
+    start = time.perf_counter()
+    output = write_output(join_sheets(sheets), xlsx, format=format)
+    return output, time.perf_counter() - start
+
+
+
+def convert_files(paths: List[str], jobs: int=1, format: str='csv') -> List[Dict[str, Any]]:
+    """
+    Converts excel files in parallel, see `xlsx_to_csv()`. The sheets of all
+    files are read by a pool of `jobs` processes, and each file's sheets are
+    joined and written by the pool as soon as all of them are read.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        For each file, in the order of `paths`: the `path`, `output`, number
+        of `sheets`, total seconds spent reading sheets (`read`), seconds
+        spent joining and writing (`write`), and seconds since the start
+        until it was written (`elapsed`).
+    """
+    start = time.perf_counter()
+    names = []
+    for path in paths:
+        with pd.ExcelFile(path) as xl:
+            names.append(xl.sheet_names)
+    tasks = [(path, name) for path, sheet_names in zip(paths, names) for name in sheet_names]
+    timings = []
+    if jobs <= 1:
+        reads = iter(_read_sheet(*task) for task in tasks)
+        for path, sheet_names in zip(paths, names):
+            sheets, seconds = zip(*[next(reads) for _ in sheet_names])
+            output, write = _join_and_write(path, list(sheets), format)
+            timings.append(dict(path=path, output=output, sheets=len(sheets), read=sum(seconds),
+                                write=write, elapsed=time.perf_counter() - start))
+        return timings
+    with Pool(min(jobs, len(tasks))) as pool:
+        # Sheets arrive in order of tasks, so files are complete one after another
+        reads = pool.imap(_read_sheet_task, tasks, chunksize=1)
+        pending = []
+        for path, sheet_names in zip(paths, names):
+            sheets, seconds = zip(*[next(reads) for _ in sheet_names])
+            pending.append((path, len(sheets), sum(seconds),
+                            pool.apply_async(_join_and_write, (path, list(sheets), format))))
+        for path, nsheets, read, result in pending:
+            output, write = result.get()
+            timings.append(dict(path=path, output=output, sheets=nsheets, read=read,
+                                write=write, elapsed=time.perf_counter() - start))
+    return timings
+
+
+
+def print_timings(timings: List[Dict[str, Any]]):
+    """
+    Prints the timings returned by `convert_files()`, one line per file.
+    """
+    for t in timings:
+        print('{path}: {sheets} sheets read in {read:.2f}s, joined and written in '
+              '{write:.2f}s, done at {elapsed:.2f}s -> {output}'.format(**t))
+
+
+
+def _benchmark(rows: int, sheets: int, columns: int, directory: str):
+    import numpy as np
+
+    random = np.random.RandomState(0)
+    times = pd.date_range('2018-11-01', periods=rows, freq='5min', tz='America/Chicago')
+    text = times.strftime('%m/%d/%Y %I:%M:%S %p ') + [t.tzname() for t in times]
+    xlsx = join(directory, 'Benchmark.xlsx')
+    with pd.ExcelWriter(xlsx) as writer:
+        for i in range(sheets):
+            sheet = pd.DataFrame({'Col{}-{}'.format(i, j): random.uniform(0, 100, rows).round(3)
+                                  for j in range(columns)}).astype(object)
+            artifacts = random.rand(rows) < 0.02
+            sheet.iloc[artifacts, 0] = ['{} {}'.format(ARTIFACT, v) for v in sheet.iloc[artifacts, 0]]
+            sheet.insert(0, 'Time', text)
+            # Sheets cover slightly different times
+            sheet.drop(index=random.choice(rows, rows // 100, replace=False)) \
+                 .to_excel(writer, sheet_name='Sheet{}'.format(i), index=False)
+
+    def legacy():
+        sheets = list(pd.read_excel(xlsx, sheet_name=None, **ESB_SCHEMA).values())
+        for sheet in sheets:
+            sheet.set_index('Time', inplace=True)
+            for col in sheet.columns:
+                sheet[col] = sheet[col].astype(str).str.replace('??? ', '', regex=False)
+        aggregate = sheets[0]
+        for sheet in sheets[1:]:
+            aggregate = aggregate.join(sheet, on='Time', how='inner')
+        return aggregate
+
+    start = time.perf_counter()
+    expected = legacy()
+    total = time.perf_counter() - start
+    start = time.perf_counter()
+    xl = pd.read_excel(xlsx, sheet_name=None)
+    read = time.perf_counter() - start
+    start = time.perf_counter()
+    result = join_sheets([clean_sheet(s) for s in xl.values()])
+    convert = time.perf_counter() - start
+    print('{} sheets x {} rows x {} columns, reading cells: {:.2f}s'.format(
+          sheets, rows, columns, read))
+    print('  per-cell: {:.2f}s converting and joining'.format(total - read))
+    print('vectorized: {:.2f}s converting and joining'.format(convert))
+    expected = expected.apply(pd.to_numeric)
+    print('Same result:', np.array_equal(expected.index, result.index) and
+          np.array_equal(expected.to_numpy(), result.to_numpy()))
 
 
 if __name__ == '__main__':
     import sys
     from glob import glob
     from argparse import ArgumentParser
+    from tempfile import TemporaryDirectory
 
     default = [abspath(join(os.environ.get('DATADIR', './'),
                             'EngineeringScienceBuilding', 'Chillers.xlsx'))]
     parser = ArgumentParser()
     parser.add_argument("paths", help="Excel files to convert.", default=default,
                         nargs='*')
+    parser.add_argument('--format', help='Output format.', default='csv',
+                        choices=['csv'] + list(FORMATS))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes reading sheets in parallel. If more than '
+                             '1, per-file timings are printed.')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+                        help='Compare per-cell and vectorized conversion on a synthetic '
+                             'workbook.')
+    parser.add_argument('--rows', type=int, default=20000,
+                        help='Rows per sheet of the benchmark workbook.')
     args = parser.parse_args()
-    for path in args.paths:
-        for xl in glob(path):
-            xlsx_to_csv(xl)
+    if args.benchmark:
+        with TemporaryDirectory() as directory:
+            _benchmark(args.rows, 3, 8, directory)
+        sys.exit()
+    paths = [xl for path in args.paths for xl in sorted(glob(path))]
+    if args.jobs > 1:
+        print_timings(convert_files(paths, jobs=args.jobs, format=args.format))
+    else:
+        for xl in paths:
+            xlsx_to_csv(xl, format=args.format)
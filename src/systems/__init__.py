@@ -1 +1,3 @@
-from .cooling_tower import CoolingTowerEnv, CoolingTowerIOEnv
+from .cooling_tower import CoolingTowerEnv, CoolingTowerIOEnv, CoolingTowerPhysics, \
+                           VectorCoolingTowerEnv, save_ticker_arrays, load_ticker_arrays
+from .parallel import SubprocVectorEnv
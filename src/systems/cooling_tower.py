@@ -3,6 +3,7 @@ Defines the cooling tower environment. In this environment the action variables
 are the tower fan speed and the condenser pump power.
 """
 
+import os
 import warnings
 from typing import Union, List, Callable, Any, Tuple
 
@@ -42,7 +43,7 @@ class CoolingTowerEnv(gym.Env):
     """
 
 
-    def __init__(self, model_fn: Callable, ticker_vars: List[pd.DataFrame],
+    def __init__(self, model_fn: Callable, ticker_vars: Union[List[pd.DataFrame], str],
                  seed=None, scaler_fn: Callable=None):
         """
         Parameters
@@ -51,9 +52,10 @@ class CoolingTowerEnv(gym.Env):
             A function that models the behavior of the cooling tower.
             It takes a 2D ndarray of [[state, action]],
             and returns a 2D ndarray with the [[output]] variables.
-        ticker_vars : pd.DataFrame
+        ticker_vars : Union[List[pd.DataFrame], str]
             A list of dataframes containing independent variables that define
-            each episode.
+            each episode. Or, a directory written by `save_ticker_arrays()`
+            which is memory-mapped so processes can share one copy.
         seed : int, optional
             Random seed, by default None
         scaler_fn : Callable[[np.ndarray], np.ndarray], optional
@@ -65,6 +67,8 @@ class CoolingTowerEnv(gym.Env):
         self.model_fn = model_fn
         self.scaler_fn = (lambda x: x) if scaler_fn is None else scaler_fn
         self.ticker_vars = ticker_vars
+        # Independent variables of each episode, converted once. See ticker_arrays()
+        self.tickers = ticker_arrays(ticker_vars)
         self.ticker = None
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', UserWarning)
@@ -89,9 +93,9 @@ class CoolingTowerEnv(gym.Env):
         self.t = 0
         self.ticker_idx = (
             ticker_idx if ticker_idx is not None else
-            self.random.randint(0, len(self.ticker_vars))
+            self.random.randint(0, len(self.tickers))
         )
-        self.ticker = self.ticker_vars[self.ticker_idx]
+        self.ticker = self.tickers[self.ticker_idx]
         self.state = self.check_state(self.observation_space.sample())
         self.state = self.tick(self.state)
         return self.state
@@ -111,18 +115,10 @@ class CoolingTowerEnv(gym.Env):
 
 
     def tick(self, state: np.ndarray) -> np.ndarray:
-        current_vars = self.ticker.iloc[self.t]
-        self.state[0] = current_vars.TempWetBulb
-        self.state[1] = current_vars.TempAmbient
+        # TempWetBulb, TempAmbient, Tonnage, PressDiffCond (or PerFreqConP)
         # state[2] is temp cond in, which is modeled in step by model_fn
         # state[3] is temp cond out, which is modeled in step by model_fn
-        self.state[4] = current_vars.Tonnage
-        try:
-            self.state[5] = current_vars.PressDiffCond
-        except AttributeError:
-            # Kissam cooling tower does not have differential pressure
-            # sensor, so we instead provide condenser pump frequency.
-            self.state[5] = current_vars.PerFreqConP
+        self.state[_TICKER_STATE_IDX] = self.ticker[self.t]
         self.t += 1
         return self.state
  
@@ -168,6 +164,205 @@ class CoolingTowerEnv(gym.Env):
 
 
 
+class VectorCoolingTowerEnv(gym.vector.VectorEnv):
+    """
+    A batch of `num_envs` `CoolingTowerEnv` episodes stepped in lock-step.
+    The model function is called once per step for all episodes. Episodes
+    which end are reset automatically, and can also be reset independently.
+
+    Follows the (old) gym vector API like `CoolingTowerEnv`: `reset()` returns
+    observations, and `step()` returns a tuple of observations, rewards,
+    dones, infos with one row/value/dict per episode. The last observation of
+    an episode that was automatically reset is in its info dict under
+    'terminal_observation'.
+    """
+
+
+    def __init__(self, model_fn: Callable, ticker_vars: Union[List[pd.DataFrame], str], num_envs: int,
+                 seed=None, scaler_fn: Callable=None, auto_reset: bool=True):
+        """
+        Parameters
+        ----------
+        model_fn : Callable[[np.ndarray], np.ndarray]
+            See `CoolingTowerEnv`. Called with a 2D array of all episodes'
+            [[state, action]] at once.
+        ticker_vars : Union[List[pd.DataFrame], str]
+            See `CoolingTowerEnv`.
+        num_envs : int
+            Number of episodes stepped together.
+        seed : int, optional
+            Random seed, by default None
+        scaler_fn : Callable[[np.ndarray], np.ndarray], optional
+            See `CoolingTowerEnv`.
+        auto_reset : bool, optional
+            Whether to reset episodes as soon as they are done, by default True.
+            If False, episodes which are done keep the last row of their ticker
+            and are reported as done on every step until they are `reset()`.
+        """
+        env = CoolingTowerEnv(model_fn=model_fn, ticker_vars=ticker_vars, seed=seed,
+                              scaler_fn=scaler_fn)
+        tickers = env.tickers
+        super().__init__(num_envs, env.observation_space, env.action_space)
+        self.model_fn = model_fn
+        self.scaler_fn = env.scaler_fn
+        self.ticker_vars = ticker_vars
+        self.auto_reset = auto_reset
+        self.action_domain = env.action_domain
+        self.random = np.random.RandomState(seed)
+        # All episodes' independent variables in one array, so the current
+        # rows of all episodes can be gathered with one indexing operation.
+        self._ticker_lengths = np.asarray([len(t) for t in tickers])
+        self._ticker_offsets = np.concatenate(([0], np.cumsum(self._ticker_lengths)[:-1]))
+        if isinstance(ticker_vars, (str, os.PathLike)):
+            self._tickers = np.load(os.path.join(ticker_vars, 'tickers.npy'), mmap_mode='r')
+        else:
+            self._tickers = np.concatenate(tickers)
+        self._low = env.observation_space.low
+        self._high = env.observation_space.high
+        self.state = np.zeros((num_envs,) + env.observation_space.shape, dtype=np.float32)
+        self.t = np.zeros(num_envs, dtype=int)
+        self.ticker_idx = np.zeros(num_envs, dtype=int)
+
+
+    def reset(self, mask: np.ndarray=None, ticker_idx: np.ndarray=None, **kwargs) -> np.ndarray:
+        """
+        Resets all episodes, or only those where the boolean `mask` is True,
+        optionally to specific `ticker_idx` for each reset episode. Returns
+        the observations of all episodes.
+        """
+        idx = np.arange(self.num_envs) if mask is None else np.flatnonzero(mask)
+        self.t[idx] = 0
+        self.ticker_idx[idx] = (self.random.randint(0, len(self._ticker_lengths), size=len(idx)) \
+                                if ticker_idx is None else ticker_idx)
+        state = self.random.uniform(self._low, self._high,
+                                    size=(len(idx), len(self._low))).astype(np.float32)
+        # wetbulb <= ambient
+        state[:, 0] = np.minimum(state[:, 0], state[:, 1])
+        self.state[idx] = state
+        self.tick(idx)
+        return self.state.copy()
+
+
+    def reset_wait(self, **kwargs) -> np.ndarray:
+        return self.reset(**kwargs)
+
+
+    def tick(self, idx: np.ndarray=None):
+        """
+        Sets the independent variables of the state of episodes at `idx` (by
+        default all) to the current rows of their tickers.
+        """
+        idx = np.arange(self.num_envs) if idx is None else idx
+        # Episodes past their end, which are not reset with auto_reset=False,
+        # stay at the last row instead of reading the next episode's rows.
+        lengths = self._ticker_lengths[self.ticker_idx[idx]]
+        t = np.minimum(self.t[idx], lengths - 1)
+        current_vars = self._tickers[self._ticker_offsets[self.ticker_idx[idx]] + t]
+        self.state[idx[:, None], _TICKER_STATE_IDX] = current_vars
+        self.t[idx] = t + 1
+
+
+    def step_async(self, actions: np.ndarray):
+        self._actions = actions
+
+
+    def step_wait(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Tuple[dict, ...]]:
+        return self.step(self._actions)
+
+
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Tuple[dict, ...]]:
+        actions = np.asarray(actions, dtype=np.float32).reshape(self.num_envs, -1)
+        x = self.scaler_fn(np.concatenate((self.state, actions), axis=1))
+        x[:, -1] = actions[:, 0] # action is in [-1,1] range already
+        outputs = np.asarray(self.model_fn(x))
+        temp_cond_in, temp_cond_out, pow_fan = outputs[:, 0], outputs[:, 1], outputs[:, 2]
+        temp_cond_out = np.minimum(temp_cond_out, 80.)
+        # temp into condenser/out of tower is:
+        # lower than last temp into tower,
+        # AND larger than wetbulb (cooling)
+        temp_cond_in = np.maximum(np.minimum(temp_cond_in, self.state[:, 2]), self.state[:, 0])
+        # condenser causes water to heat
+        temp_cond_out = np.maximum(temp_cond_in, temp_cond_out)
+
+        rewards = self.reward(self.state, temp_cond_in, temp_cond_out, pow_fan, actions)
+
+        self.tick()
+        self.state[:, 2] = temp_cond_in
+        self.state[:, 3] = temp_cond_out
+        dones = self.t >= self._ticker_lengths[self.ticker_idx]
+        infos = tuple({} for _ in range(self.num_envs))
+        observations = self.state.copy()
+        if self.auto_reset and np.any(dones):
+            for i in np.flatnonzero(dones):
+                infos[i]['terminal_observation'] = observations[i]
+            observations = self.reset(mask=dones)
+        return observations, rewards, dones, infos
+
+
+    @classmethod
+    def reward(cls, state, temp_cond_in, temp_cond_out, pow_fan, action) -> np.ndarray:
+        # Same as CoolingTowerEnv.reward, for a batch of states
+        return -(temp_cond_in - state[:, 0]) # state[:, 0] = TempWetBulb
+
+
+
+# Indices in the state vector of the columns of ticker arrays
+_TICKER_STATE_IDX = [0, 1, 4, 5]
+
+
+
+def ticker_arrays(ticker_vars: Union[List[pd.DataFrame], str]) -> List[np.ndarray]:
+    """
+    Converts episode dataframes into contiguous float32 arrays of the
+    independent state variables, with columns:
+
+    TempWetBulb, TempAmbient, Tonnage, PressDiffCond (or PerFreqConP)
+
+    If `ticker_vars` is a directory, memory-mapped arrays saved by
+    `save_ticker_arrays()` are returned. Arrays in the list are used as-is.
+    """
+    if isinstance(ticker_vars, (str, os.PathLike)):
+        return load_ticker_arrays(ticker_vars)
+    arrays = []
+    for ticker in ticker_vars:
+        if isinstance(ticker, np.ndarray):
+            arrays.append(ticker)
+            continue
+        # Kissam cooling tower does not have differential pressure
+        # sensor, so we instead provide condenser pump frequency.
+        last = 'PressDiffCond' if 'PressDiffCond' in ticker.columns else 'PerFreqConP'
+        columns = ['TempWetBulb', 'TempAmbient', 'Tonnage', last]
+        arrays.append(np.ascontiguousarray(ticker[columns].to_numpy(dtype=np.float32)))
+    return arrays
+
+
+
+def save_ticker_arrays(ticker_vars: List[pd.DataFrame], path: str):
+    """
+    Saves episode dataframes as arrays in a directory, to be memory-mapped by
+    `load_ticker_arrays()` or by passing `path` as `ticker_vars` to the
+    environments. Writes `tickers.npy`, all episodes' rows concatenated, and
+    `lengths.npy`, the number of rows in each episode.
+    """
+    arrays = ticker_arrays(ticker_vars)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'tickers.npy'), np.concatenate(arrays))
+    np.save(os.path.join(path, 'lengths.npy'), np.asarray([len(a) for a in arrays]))
+
+
+
+def load_ticker_arrays(path: str, mmap_mode: str='r') -> List[np.ndarray]:
+    """
+    Loads episode arrays saved by `save_ticker_arrays()`. By default the
+    arrays are read-only views of a memory-mapped file, which the OS shares
+    between processes.
+    """
+    data = np.load(os.path.join(path, 'tickers.npy'), mmap_mode=mmap_mode)
+    lengths = np.load(os.path.join(path, 'lengths.npy'))
+    return np.split(data, np.cumsum(lengths)[:-1])
+
+
+
 class CoolingTowerIOEnv(CoolingTowerEnv):
 
     
@@ -205,39 +400,133 @@ class CoolingTowerIOEnv(CoolingTowerEnv):
 
 
 class CoolingTowerPhysics(CoolingTowerEnv):
+    """
+    A physics-based cooling tower environment which needs no trained model.
+    Water leaving the condenser cools in the tower towards the wetbulb
+    temperature, while mixing with replacement water lost to evaporation.
+    The tower ODE (see `derivative()`) is integrated over each step for all
+    rows of a batch at once, so `model` can also be the `model_fn` of a
+    `VectorCoolingTowerEnv`.
+
+    The action in [-1, 1] is the fan speed fraction in [0, 1].
+
+    Parameters
+    ----------
+    ticker_vars : Union[List[pd.DataFrame], str]
+        See `CoolingTowerEnv`.
+    seed : int, optional
+        Random seed, by default None
+    scaler_fn : Callable[[np.ndarray], np.ndarray], optional
+        See `CoolingTowerEnv`. The model expects unscaled temperatures, so
+        by default no scaling is done.
+    k : float, optional
+        Cooling rate per step at full fan speed, by default 0.5.
+    k_r : float, optional
+        Evaporated (and replaced) water mass per degree of approach to the
+        wetbulb temperature, by default 0.5.
+    m : float, optional
+        Total water mass in the condenser loop, by default 100.
+    flow : float, optional
+        Condenser water flow in gpm. Condenser load heats water by
+        24 * Tonnage / flow degrees F. By default 1260 (3 gpm/ton for 420 tons).
+    fan_power : float, optional
+        Fan power at full speed. Power scales with the cube of speed. By
+        default 30.
+    dt : float, optional
+        Duration of a step, in the time units of `k`, by default 1.
+    substeps : int, optional
+        Number of fixed RK4 steps per environment step, by default 2. With the
+        default constants the error is under 0.002F (0.1F with 1 substep).
+    method : str, optional
+        'rk4' for fixed-step vectorized Runge-Kutta, or 'odeint' for adaptive
+        integration with `scipy.integrate.odeint`. By default 'rk4'.
+    """
 
 
-    def __init__(self, ticker_vars: List[pd.DataFrame], seed=None, scaler_fn: Callable = None):
-        super().__init__(model_fn=None, ticker_vars=ticker_vars, seed=seed, scaler_fn=scaler_fn)
+    def __init__(self, ticker_vars: Union[List[pd.DataFrame], str], seed=None,
+                 scaler_fn: Callable = None, k: float=0.5, k_r: float=0.5, m: float=100.,
+                 flow: float=1260., fan_power: float=30., dt: float=1., substeps: int=2,
+                 method: str='rk4'):
+        if method not in ('rk4', 'odeint'):
+            raise ValueError('method must be one of "rk4", "odeint".')
+        self.k, self.k_r, self.m = k, k_r, m
+        self.flow = flow
+        self.fan_power = fan_power
+        self.dt = dt
+        self.substeps = substeps
+        self.method = method
+        super().__init__(model_fn=self.model, ticker_vars=ticker_vars, seed=seed,
+                         scaler_fn=scaler_fn)
+
+
+    def derivative(self, temp: np.ndarray, temp_wb: np.ndarray, temp_amb: np.ndarray,
+                   fan: np.ndarray) -> np.ndarray:
+        """
+        Rate of change of the reservoir water temperature `temp` (T_R):
+
+        dT_R/dt = -k . fan . (T_eq - T_wb)
+
+        Where T_eq is the temperature after mixing with replacement water at
+        ambient temperature T_r, such that
+            m_r . c . (T_r - T_eq) = m_R . c . (T_R - T_eq)
+            T_eq = (m_R.T_R - m_r.T_r) / (m_R - m_r)
+        And, parametrizing evaporative loss and mass conservation:
+            m_r = k_r . (T_R - T_wb),
+            m_r + m_R = m, so m_R = m - m_r
+        So that
+            T_eq = ((m - m_r).T_R - m_r.T_r) / (m - 2m_r)
+        The flow rate is constant, so it is part of the constant `k`.
+        """
+        return self._rate(temp, temp_wb, temp_amb - temp_wb, -self.k * fan)
 
 
-    def step(self, action: np.ndarray) -> Tuple[np.ndarray, float, bool, Any]:
-        # ode
-        # dT/dt \prop (T-T_wb) / flow_rate
-        #       \prop (T_eq - T_wb) / flow_rate
-        # where T_eq is after mixing with replacement water, such that
-        #   m_r . c . (T_r - T_eq) = m_R . c . (T_R - T_eq)
-        #   m_r.T_r - m_r.T_eq = m_R.T_R - m_R.T_eq
-        #   T_eq = (m_R.T_R - m_r.T_r) / (m.R - m_r)
-        # where R = reservoir, r=replacement
-        # let T_r = ambient temp, T_R = temp condenser out
-        # And, parametrizing evaporative loss and mass conservation:
-        #   m_r \propto (T_R - T_wb), m_r = k_r . (T_R - T_wb),
-        #   m_r + m_R = m, so m_R = m - m_r
-        # Then, dT / dt
-        #   k . ((m_R.T_R - m_r.T_r) / (m.R - m_r) - T_wb) / flow_rate
-        # = k . (((m - m_r).T_R - m_r.T_r) / ((m - m_r) - m_r) - T_wb) / flow_rate
-        # = k . (((m - m_r).T_R - m_r.T_r) / (m - 2m_r) - T_wb) / flow_rate
-        # = k . (
-        #   ((m - k_r . (T_R - T_wb)).T_R - k_r . (T_R - T_wb).T_r) / (m - 2k_r . (T_R - T_wb)) - T_wb
-        # ) / flow_rate
-        # Where
-        #   k = proportionality constant for Newton's law + fan speed + flow rate
-        #   k_r = evaporative cooling constant
-        #   m = total water mass in condenser loop (constant)
-        #   T_R = water reservoir temperature, = condenser out temperature
-        #   T_r = replacement water temperature = ambient temperature
-        pass
+    def _rate(self, temp, temp_wb, amb_approach, gain) -> np.ndarray:
+        # derivative() with T_eq - T_wb rearranged to
+        #   (m.(T_R - T_wb) - m_r.(T_R - T_wb + T_r - T_wb)) / (m - 2m_r)
+        # and terms constant over a step precomputed, since it is evaluated
+        # several times per step.
+        approach = temp - temp_wb
+        # Evaporation stops below wetbulb, and at most a third of the water is
+        # replaced so the mixing denominator stays positive.
+        m_r = np.minimum(np.maximum(self.k_r * approach, 0.), self.m / 3)
+        return gain * (self.m * approach - m_r * (approach + amb_approach)) / (self.m - 2 * m_r)
+
+
+    def integrate(self, temp: np.ndarray, temp_wb: np.ndarray, temp_amb: np.ndarray,
+                  fan: np.ndarray) -> np.ndarray:
+        """
+        Integrates `derivative()` over one step of duration `dt` for arrays of
+        initial temperatures and conditions. Returns final temperatures.
+        """
+        amb_approach, gain = temp_amb - temp_wb, -self.k * fan
+        f = lambda y: self._rate(y, temp_wb, amb_approach, gain)
+        if self.method == 'odeint':
+            # Rows are independent equations of one system, solved together
+            return odeint(lambda y, t: f(y), temp, [0., self.dt])[-1]
+        h = self.dt / self.substeps
+        for _ in range(self.substeps):
+            k1 = f(temp)
+            k2 = f(temp + 0.5 * h * k1)
+            k3 = f(temp + 0.5 * h * k2)
+            k4 = f(temp + h * k3)
+            temp = temp + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        return temp
+
+
+    def model(self, x: np.ndarray) -> np.ndarray:
+        """
+        A model function, see `CoolingTowerEnv`. Takes a 2D array of
+        [[state, action]] and returns [[TempCondIn, TempCondOut, PowFan]].
+        """
+        # Contiguous columns, which are faster to operate on repeatedly
+        temp_wb, temp_amb, temp_cond_out, tonnage, action = \
+            np.asarray(x, dtype=float)[:, [0, 1, 3, 4, -1]].T.copy()
+        fan = 0.5 * (np.clip(action, -1., 1.) + 1.)
+        # Water returning from the condenser (TempCondOut) cools in the tower
+        temp_cond_in = self.integrate(temp_cond_out, temp_wb, temp_amb, fan)
+        temp_cond_out = temp_cond_in + 24. * tonnage / self.flow
+        pow_fan = self.fan_power * fan ** 3
+        return np.stack((temp_cond_in, temp_cond_out, pow_fan), axis=1)
 
 
 
@@ -250,4 +539,62 @@ def train_mlp_regressor(inputs: np.ndarray, outputs: np.ndarray, **model_kwargs)
 
 
 def train_ss_model(inputs: np.ndarray, outputs: np.ndarray, **model_kwargs):
-    pass
\ No newline at end of file
+    pass
+
+
+
+if __name__ == '__main__':
+    # Benchmark steps per second of environments:
+    # python -m systems.cooling_tower --help
+    from argparse import ArgumentParser
+    from time import perf_counter
+    from utils.inference import freeze
+
+    parser = ArgumentParser(description='Benchmark CoolingTowerEnv steps per second.')
+    parser.add_argument('-n', '--num-envs', type=int, nargs='+', default=[1, 16, 256],
+                        help='Numbers of episodes stepped together in the vector env.')
+    parser.add_argument('-s', '--steps', type=int, default=2000,
+                        help='Number of steps to take in each env.')
+    args = parser.parse_args()
+
+    random = np.random.RandomState(0)
+    columns = ['TempWetBulb', 'TempAmbient', 'Tonnage', 'PressDiffCond']
+    tickers = [pd.DataFrame(random.uniform(40, 80, size=(288, 4)), columns=columns)
+               for _ in range(10)]
+    model = train_mlp_regressor(random.rand(500, 7), random.rand(500, 3),
+                                hidden_layer_sizes=(32, 32), max_iter=20)
+
+    frozen = freeze(model)
+
+    for name, model_fn in (('mlp', model.predict), ('frozen mlp', frozen.predict)):
+        env = CoolingTowerEnv(model_fn=model_fn, ticker_vars=tickers, seed=0)
+        env.reset()
+        start = perf_counter()
+        for _ in range(args.steps):
+            _, _, done, _ = env.step(env.action_space.sample())
+            if done:
+                env.reset()
+        print('CoolingTowerEnv({}): {:.0f} steps/s'.format(
+              name, args.steps / (perf_counter() - start)))
+
+    physics = CoolingTowerPhysics(ticker_vars=tickers, seed=0)
+    physics.reset()
+    start = perf_counter()
+    for _ in range(args.steps):
+        _, _, done, _ = physics.step(physics.action_space.sample())
+        if done:
+            physics.reset()
+    print('CoolingTowerPhysics: {:.0f} steps/s'.format(args.steps / (perf_counter() - start)))
+
+    for num_envs in args.num_envs:
+        for name, model_fn in (('mlp', model.predict), ('frozen mlp', frozen.predict),
+                               ('physics', physics.model)):
+            venv = VectorCoolingTowerEnv(model_fn=model_fn, ticker_vars=tickers,
+                                         num_envs=num_envs, seed=0)
+            venv.reset()
+            steps = max(args.steps // num_envs, 10)
+            start = perf_counter()
+            for _ in range(steps):
+                venv.step(venv.action_space.sample())
+            print('VectorCoolingTowerEnv(num_envs={}, {}): {:.0f} steps/s'.format(
+                  num_envs, name, steps * num_envs / (perf_counter() - start)))
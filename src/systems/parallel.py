@@ -0,0 +1,296 @@
+"""
+Steps batches of environments in worker processes. Observations, actions,
+rewards and done flags are exchanged through shared memory, so only short
+commands (and the info dicts of finished episodes) pass through pipes.
+"""
+
+import os
+import traceback
+from functools import partial
+from multiprocessing import get_context, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Tuple
+
+import numpy as np
+import gym
+
+
+
+def _attach(name: str, shape: Tuple[int, ...], dtype) -> Tuple[SharedMemory, np.ndarray]:
+    """Opens a shared memory block created by another process as an array."""
+    # Workers inherit the resource tracker which SubprocVectorEnv starts before
+    # them, so the block is only unlinked by the parent in close(). Had each
+    # worker started its own tracker, that tracker would unlink the block
+    # when the worker exits.
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+
+def _worker(remote, parent_remote, env_fn: Callable, num_envs: int, seed: int,
+            start: int, stop: int):
+    """Multi-processing payload function used by SubprocVectorEnv"""
+    parent_remote.close()
+    blocks = []
+    env = None
+    try:
+        env = env_fn(num_envs=num_envs, seed=seed)
+        remote.send((env.single_observation_space, env.single_action_space))
+        buffers = {}
+        for key, (name, shape, dtype) in remote.recv().items():
+            shm, buffers[key] = _attach(name, shape, dtype)
+            blocks.append(shm)
+        obs, act = buffers['obs'][start:stop], buffers['act'][start:stop]
+        rew, done = buffers['rew'][start:stop], buffers['done'][start:stop]
+        while True:
+            cmd = remote.recv()
+            if cmd == 'step':
+                obs[:], rew[:], done[:], infos = env.step(act)
+                # Only non-empty infos, e.g. with terminal observations, are sent
+                remote.send({start + i: info for i, info in enumerate(infos) if info})
+            elif cmd == 'reset':
+                obs[:] = env.reset()
+                remote.send(None)
+            elif cmd == 'close':
+                break
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        try:
+            remote.send(RuntimeError('Worker for environments [{}, {}) failed:\n{}'.format(
+                                     start, stop, traceback.format_exc())))
+        except (BrokenPipeError, EOFError):
+            pass
+    finally:
+        if env is not None:
+            env.close()
+        for shm in blocks:
+            shm.close()
+        remote.close()
+
+
+
+class SubprocVectorEnv(gym.vector.VectorEnv):
+    """
+    A vector environment which splits `num_envs` episodes across worker
+    processes. Each worker steps its share with one batched environment made
+    by `env_fn`, e.g. `VectorCoolingTowerEnv`, and reads/writes its rows of
+    the shared observation, action, reward and done arrays in place.
+
+    Uses the same step/reset API as `VectorCoolingTowerEnv`. `step_async()`
+    returns immediately, so the caller can work while workers step.
+
+    Parameters
+    ----------
+    env_fn : Callable[..., gym.vector.VectorEnv]
+        A picklable function called in each worker as
+        `env_fn(num_envs=..., seed=...)`, e.g.
+        `functools.partial(VectorCoolingTowerEnv, model_fn, ticker_vars)`.
+        Pass `ticker_vars` as a directory from `save_ticker_arrays()` so
+        workers share one memory-mapped copy of the episodes.
+    num_envs : int
+        Total number of episodes stepped together.
+    num_workers : int, optional
+        Number of worker processes, by default the number of CPUs (at most
+        `num_envs`).
+    seed : int, optional
+        Random seed. Each worker gets an independent seed derived from it,
+        by default None.
+    start_method : str, optional
+        Multiprocessing start method: 'fork', 'spawn', 'forkserver'. By
+        default the platform's default.
+    """
+
+
+    def __init__(self, env_fn: Callable, num_envs: int, num_workers: int=None,
+                 seed: int=None, start_method: str=None):
+        num_workers = min(num_workers or os.cpu_count() or 1, num_envs)
+        self.num_workers = num_workers
+        self.closed = False
+        self._blocks = []
+        self._waiting = False
+        ctx = get_context(start_method)
+        counts = [len(s) for s in np.array_split(np.arange(num_envs), num_workers)]
+        self._bounds = np.concatenate(([0], np.cumsum(counts)))
+        seeds = [int(s.generate_state(1)[0]) for s in
+                 np.random.SeedSequence(seed).spawn(num_workers)]
+        self.remotes, self.processes = [], []
+        # Started before the workers so they share it. See _attach()
+        resource_tracker.ensure_running()
+        for i in range(num_workers):
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(target=_worker, daemon=True,
+                                  args=(work_remote, remote, env_fn, counts[i], seeds[i],
+                                        self._bounds[i], self._bounds[i + 1]))
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        try:
+            observation_space, action_space = self._receive()[0]
+            super().__init__(num_envs, observation_space, action_space)
+            specs = dict(
+                obs=((num_envs,) + observation_space.shape, observation_space.dtype),
+                act=((num_envs,) + action_space.shape, action_space.dtype),
+                rew=((num_envs,), np.float32),
+                done=((num_envs,), np.bool_))
+            buffers, names = {}, {}
+            for key, (shape, dtype) in specs.items():
+                size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+                shm = SharedMemory(create=True, size=size)
+                self._blocks.append(shm)
+                buffers[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                names[key] = (shm.name, shape, dtype)
+            self._obs, self._act = buffers['obs'], buffers['act']
+            self._rew, self._done = buffers['rew'], buffers['done']
+            for remote in self.remotes:
+                remote.send(names)
+        except BaseException:
+            self.close()
+            raise
+
+
+    def _receive(self) -> list:
+        results = []
+        for remote in self.remotes:
+            try:
+                result = remote.recv()
+            except EOFError:
+                raise RuntimeError('A worker process exited unexpectedly.')
+            if isinstance(result, Exception):
+                raise result
+            results.append(result)
+        return results
+
+
+    def reset(self, **kwargs) -> np.ndarray:
+        """
+        Resets all episodes, and returns their observations.
+        """
+        if self._waiting:
+            self.step_wait()
+        for remote in self.remotes:
+            remote.send('reset')
+        self._receive()
+        return self._obs.copy()
+
+
+    def reset_wait(self, **kwargs) -> np.ndarray:
+        return self.reset(**kwargs)
+
+
+    def step_async(self, actions: np.ndarray):
+        self._act[:] = np.reshape(actions, self._act.shape)
+        for remote in self.remotes:
+            remote.send('step')
+        self._waiting = True
+
+
+    def step_wait(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Tuple[dict, ...]]:
+        infos = [{} for _ in range(self.num_envs)]
+        for worker_infos in self._receive():
+            for i, info in worker_infos.items():
+                infos[i] = info
+        self._waiting = False
+        return self._obs.copy(), self._rew.copy(), self._done.copy(), tuple(infos)
+
+
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Tuple[dict, ...]]:
+        self.step_async(actions)
+        return self.step_wait()
+
+
+    def close(self, **kwargs):
+        """
+        Stops worker processes and frees shared memory. Called on garbage
+        collection, and safe to call more than once.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for remote in self.remotes:
+            try:
+                remote.send('close')
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for remote in self.remotes:
+            remote.close()
+        self._obs = self._act = self._rew = self._done = None
+        for shm in self._blocks:
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                # Already unlinked by another process
+                pass
+        self._blocks = []
+
+
+    def __enter__(self) -> 'SubprocVectorEnv':
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __del__(self):
+        if not getattr(self, 'closed', True):
+            self.close()
+
+
+
+if __name__ == '__main__':
+    # Benchmark steps per second with increasing numbers of workers:
+    # python -m systems.parallel --help
+    from argparse import ArgumentParser
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+    import pandas as pd
+    from systems.cooling_tower import VectorCoolingTowerEnv, train_mlp_regressor, \
+                                      save_ticker_arrays
+
+    parser = ArgumentParser(description='Benchmark SubprocVectorEnv steps per second.')
+    parser.add_argument('-n', '--num-envs', type=int, default=256,
+                        help='Numbers of episodes stepped together.')
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}),
+                        help='Numbers of worker processes.')
+    parser.add_argument('-s', '--steps', type=int, default=200,
+                        help='Number of vector steps to take.')
+    args = parser.parse_args()
+
+    random = np.random.RandomState(0)
+    columns = ['TempWetBulb', 'TempAmbient', 'Tonnage', 'PressDiffCond']
+    tickers = [pd.DataFrame(random.uniform(40, 80, size=(288, 4)), columns=columns)
+               for _ in range(10)]
+    model = train_mlp_regressor(random.rand(500, 7), random.rand(500, 3),
+                                hidden_layer_sizes=(32, 32), max_iter=20)
+
+    with TemporaryDirectory() as path:
+        save_ticker_arrays(tickers, path)
+        env_fn = partial(VectorCoolingTowerEnv, model.predict, path)
+
+        venv = env_fn(num_envs=args.num_envs, seed=0)
+        venv.reset()
+        start = perf_counter()
+        for _ in range(args.steps):
+            venv.step(venv.action_space.sample())
+        print('VectorCoolingTowerEnv(num_envs={}): {:.0f} steps/s'.format(
+              args.num_envs, args.steps * args.num_envs / (perf_counter() - start)))
+
+        for workers in args.workers:
+            with SubprocVectorEnv(env_fn, num_envs=args.num_envs, num_workers=workers,
+                                  seed=0) as venv:
+                venv.reset()
+                start = perf_counter()
+                for _ in range(args.steps):
+                    venv.step(venv.action_space.sample())
+                print('SubprocVectorEnv(num_envs={}, num_workers={}): {:.0f} steps/s'.format(
+                      args.num_envs, workers,
+                      args.steps * args.num_envs / (perf_counter() - start)))
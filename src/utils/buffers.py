@@ -0,0 +1,97 @@
+"""
+Fixed-size buffers for keeping a bounded history of values.
+"""
+
+from typing import Tuple, Any
+
+import numpy as np
+
+
+
+class RingBuffer:
+    """
+    A preallocated circular buffer which keeps the last `capacity` values
+    appended to it. Appending is O(1) and older values are overwritten.
+    Indexing follows list semantics, i.e. `buffer[-1]` is the latest value.
+
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of values kept.
+    dtype : Any, optional
+        Data type of values, by default float. Use `object` to keep references
+        to arbitrary objects, e.g. `pd.Series`.
+    shape : Tuple[int, ...], optional
+        Shape of each value. By default the shape of the first appended value
+        (or scalar for `object` dtype).
+    """
+
+
+    def __init__(self, capacity: int, dtype: Any=float, shape: Tuple[int, ...]=None):
+        self.capacity = int(capacity)
+        self.dtype = dtype
+        self.shape = () if (shape is None and dtype is object) else shape
+        self._data = None
+        self._end = 0   # Position of the next value to write
+        self._len = 0
+
+
+    def __len__(self) -> int:
+        return self._len
+
+
+    def append(self, value):
+        if self._data is None:
+            shape = np.shape(value) if self.shape is None else self.shape
+            self._data = np.empty((self.capacity,) + tuple(shape), dtype=self.dtype)
+        self._data[self._end] = value
+        self._end = (self._end + 1) % self.capacity
+        self._len = min(self._len + 1, self.capacity)
+
+
+    def clear(self):
+        self._end, self._len = 0, 0
+
+
+    def _positions(self, start: int, stop: int) -> np.ndarray:
+        # Positions in the underlying array of values [start, stop) in order
+        return (self._end - self._len + np.arange(start, stop)) % self.capacity
+
+
+    def __getitem__(self, i: int):
+        i = int(i)
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('RingBuffer index out of range')
+        value = self._data[(self._end - self._len + i) % self.capacity]
+        # Copies, so modifying a value in place does not change the history
+        return value.copy() if isinstance(value, np.ndarray) else value
+
+
+    def window(self, size: int, offset: int=0) -> np.ndarray:
+        """
+        Returns up to `size` values, in order, ending `offset` values before the
+        latest one. Equivalent to `list[-size-offset:len(list)-offset]`.
+        """
+        stop = max(self._len - int(offset), 0)
+        start = max(stop - int(size), 0)
+        if self._data is None:
+            return np.empty(0, dtype=self.dtype)
+        return self._data[self._positions(start, stop)]
+
+
+    def window_mean(self, size: int, offset: int=0) -> float:
+        """
+        Mean of all elements of the values in `window(size, offset)`. NaN if the
+        window is empty.
+        """
+        window = self.window(size, offset)
+        return np.mean(window) if window.size > 0 else np.nan
+
+
+    def to_array(self) -> np.ndarray:
+        """
+        Returns all values, oldest first.
+        """
+        return self.window(self._len)
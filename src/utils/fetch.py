@@ -0,0 +1,105 @@
+"""
+Fetching of trend data over the network. Backends are callables with the
+signature of `bdx.get_trend`:
+
+`backend(trend_id, username, password, start, end, aggregation) -> pd.DataFrame`
+
+`TrendFetcher` wraps a backend with a concurrency limit shared across threads,
+retries with exponential backoff, and latency metrics.
+"""
+
+from datetime import datetime
+from typing import Callable
+import threading as th
+import time
+
+import pandas as pd
+
+from .logs import get_logger
+from .trends import bdx_backend
+
+
+
+class TrendFetcher:
+    """
+    Wraps a trend backend so that at most `max_concurrency` requests are in
+    flight at once across all threads using this instance. Failed requests
+    are retried after exponentially increasing delays.
+
+    Parameters
+    ----------
+    backend : Callable, optional
+        The backend to request trends from, by default `bdx_backend`.
+    max_concurrency : int, optional
+        Maximum simultaneous requests, by default 4.
+    retries : int, optional
+        Number of times a failed request is retried, by default 3.
+    backoff : float, optional
+        Seconds to wait before the first retry. Doubles with each retry, up to
+        `max_backoff`. By default 0.5.
+    max_backoff : float, optional
+        Maximum seconds to wait between retries, by default 8.
+    logger : str, optional
+        Name of the logger for request latencies, by default 'trends'.
+    sleep : Callable[[float], None], optional
+        Function to wait between retries, by default `time.sleep`.
+
+    Attributes
+    ----------
+    metrics : Dict[object, Dict[str, float]]
+        Per trend ID: number of `requests`, `retries`, `failures` (requests
+        which failed after all retries), and the `latency_last`,
+        `latency_max` and `latency_total` of successful attempts in seconds.
+    """
+
+
+    def __init__(self, backend: Callable=None, max_concurrency: int=4, retries: int=3,
+                 backoff: float=0.5, max_backoff: float=8., logger: str='trends',
+                 sleep: Callable=time.sleep):
+        self.backend = bdx_backend if backend is None else backend
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.logger = get_logger(logger)
+        self.sleep = sleep
+        self.metrics = {}
+        self._semaphore = th.BoundedSemaphore(max_concurrency)
+        self._lock = th.Lock()
+
+
+    def _record(self, trend_id, **increments):
+        with self._lock:
+            metrics = self.metrics.setdefault(trend_id, dict(
+                requests=0, retries=0, failures=0,
+                latency_last=0., latency_max=0., latency_total=0.))
+            for key, value in increments.items():
+                if key == 'latency':
+                    metrics['latency_last'] = value
+                    metrics['latency_max'] = max(metrics['latency_max'], value)
+                    metrics['latency_total'] += value
+                else:
+                    metrics[key] += value
+
+
+    def __call__(self, trend_id, username, password, start: datetime, end: datetime,
+                 aggregation: str='Point') -> pd.DataFrame:
+        self._record(trend_id, requests=1)
+        for attempt in range(self.retries + 1):
+            try:
+                with self._semaphore:
+                    tstart = time.perf_counter()
+                    trend = self.backend(trend_id, username, password, start, end, aggregation)
+                    latency = time.perf_counter() - tstart
+                self._record(trend_id, latency=latency)
+                self.logger.debug('Trend %s: %d rows in %.3fs', trend_id, len(trend), latency)
+                return trend
+            except Exception as exc:
+                if attempt == self.retries:
+                    self._record(trend_id, failures=1)
+                    raise
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                self._record(trend_id, retries=1)
+                self.logger.warning('Trend %s request failed (%s). Retrying in %.1fs.',
+                                    trend_id, exc, delay)
+                self.sleep(delay)
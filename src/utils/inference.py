@@ -0,0 +1,200 @@
+"""
+Fast inference for fitted models. `freeze()` converts a fitted `MLPRegressor`,
+optionally preceded by scalers in a `Pipeline`, into a `FrozenMLP` which
+predicts with plain NumPy matrix products, skipping the input validation that
+dominates sklearn's `predict()` for small batches.
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+
+
+
+def _relu(h: np.ndarray) -> np.ndarray:
+    return np.maximum(h, 0., out=h)
+
+
+def _logistic(h: np.ndarray) -> np.ndarray:
+    np.negative(h, out=h)
+    np.exp(h, out=h)
+    h += 1.
+    return np.reciprocal(h, out=h)
+
+
+def _tanh(h: np.ndarray) -> np.ndarray:
+    return np.tanh(h, out=h)
+
+
+def _identity(h: np.ndarray) -> np.ndarray:
+    return h
+
+
+# In-place activation functions of `MLPRegressor`
+_ACTIVATIONS = {'identity': _identity, 'logistic': _logistic, 'tanh': _tanh, 'relu': _relu}
+
+
+
+class FrozenMLP:
+    """
+    A multi-layer perceptron for inference only. Intermediate results are
+    written into buffers which are allocated once for the largest batch seen,
+    so repeated calls do not allocate memory except for the returned array.
+    Buffers are shared, so an instance should not be used by several threads
+    at once.
+
+    Has the same `coefs_`, `intercepts_`, `activation`, `out_activation_` and
+    `n_outputs_` attributes as `MLPRegressor`, so it can be used wherever an
+    `MLPRegressor` is, e.g. for analytic gradients in `QuasiNewtonController`.
+
+    Parameters
+    ----------
+    coefs : List[np.ndarray]
+        Weight matrices of shape (inputs, outputs) for each layer.
+    intercepts : List[np.ndarray]
+        Bias vectors for each layer.
+    activation : str, optional
+        Activation of hidden layers: 'identity', 'logistic', 'tanh', 'relu'.
+        By default 'relu'. The output layer has no activation.
+    dtype : np.dtype, optional
+        Data type of computations, by default float. float32 is faster for
+        large batches at some loss of precision.
+    """
+
+
+    def __init__(self, coefs: List[np.ndarray], intercepts: List[np.ndarray],
+                 activation: str='relu', dtype=float):
+        if activation not in _ACTIVATIONS:
+            raise ValueError('activation must be one of {}.'.format(', '.join(_ACTIVATIONS)))
+        self.dtype = np.dtype(dtype)
+        self.coefs_ = [np.ascontiguousarray(W, dtype=self.dtype) for W in coefs]
+        self.intercepts_ = [np.ascontiguousarray(b, dtype=self.dtype) for b in intercepts]
+        self.activation = activation
+        self.out_activation_ = 'identity'
+        self.n_features_in_ = self.coefs_[0].shape[0]
+        self.n_outputs_ = self.coefs_[-1].shape[1]
+        self._activation = _ACTIVATIONS[activation]
+        self._buffers = []
+
+
+    def _allocate(self, n: int):
+        if not self._buffers or len(self._buffers[0]) < n:
+            self._buffers = [np.empty((n, W.shape[1]), dtype=self.dtype) for W in self.coefs_]
+
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """
+        Returns predictions for a 2D array of inputs (samples, features). Like
+        `MLPRegressor.predict`, a 1D array is returned for single output models.
+        """
+        X = np.asarray(X, dtype=self.dtype)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        n = len(X)
+        self._allocate(n)
+        h = X
+        last = len(self.coefs_) - 1
+        for i, (W, b, buffer) in enumerate(zip(self.coefs_, self.intercepts_, self._buffers)):
+            out = buffer[:n]
+            np.matmul(h, W, out=out)
+            out += b
+            h = out if i == last else self._activation(out)
+        return h[:, 0].copy() if self.n_outputs_ == 1 else h.copy()
+
+
+    __call__ = predict
+
+
+
+def _affine(scaler) -> Tuple[np.ndarray, np.ndarray]:
+    # Scale and offset of a fitted sklearn scaler as: X * scale + offset
+    name = type(scaler).__name__
+    if name == 'StandardScaler':
+        scale = 1. / scaler.scale_ if scaler.with_std else np.ones(scaler.n_features_in_)
+        mean = scaler.mean_ if scaler.with_mean else np.zeros(scaler.n_features_in_)
+        return scale, -mean * scale
+    if name == 'MinMaxScaler':
+        return scaler.scale_, scaler.min_
+    if name == 'MaxAbsScaler':
+        return 1. / scaler.scale_, np.zeros_like(scaler.scale_)
+    if name == 'RobustScaler':
+        n = scaler.n_features_in_
+        scale = 1. / scaler.scale_ if scaler.scale_ is not None else np.ones(n)
+        center = scaler.center_ if scaler.center_ is not None else np.zeros(n)
+        return scale, -center * scale
+    raise TypeError('Cannot fuse {} into the network. Only linear scalers are supported.'
+                    .format(name))
+
+
+
+def freeze(model, scaler=None, dtype=float) -> FrozenMLP:
+    """
+    Converts a fitted `MLPRegressor`, or a `Pipeline` of linear scalers
+    (`StandardScaler`, `MinMaxScaler`, `MaxAbsScaler`, `RobustScaler`) and an
+    `MLPRegressor`, into a `FrozenMLP`. Scalers are fused into the weights of
+    the first layer, so scaling costs nothing at inference.
+
+    Parameters
+    ----------
+    model : Union[MLPRegressor, Pipeline]
+        The fitted model.
+    scaler : Any, optional
+        A fitted linear scaler applied to inputs before `model`, if it is not
+        part of a pipeline. By default None.
+    dtype : np.dtype, optional
+        Data type of computations, by default float.
+
+    Returns
+    -------
+    FrozenMLP
+        A model whose `predict(X)` matches `model.predict(scaler.transform(X))`.
+    """
+    scalers = [] if scaler is None else [scaler]
+    if hasattr(model, 'steps'):
+        scalers.extend(step for _, step in model.steps[:-1] if step not in (None, 'passthrough'))
+        model = model.steps[-1][1]
+    if getattr(model, 'out_activation_', None) != 'identity':
+        raise TypeError('Only fitted regressors with identity output activation are supported.')
+    coefs = [np.array(W, dtype=float) for W in model.coefs_]
+    intercepts = [np.array(b, dtype=float) for b in model.intercepts_]
+    # Fuse scalers last to first: (X * s + o) @ W + b = X @ (s[:, None] * W) + (o @ W + b)
+    for s in reversed(scalers):
+        scale, offset = _affine(s)
+        intercepts[0] = intercepts[0] + offset @ coefs[0]
+        coefs[0] = scale[:, None] * coefs[0]
+    return FrozenMLP(coefs, intercepts, activation=model.activation, dtype=dtype)
+
+
+
+if __name__ == '__main__':
+    # Benchmark latency of sklearn vs. frozen models:
+    # python -m utils.inference --help
+    from argparse import ArgumentParser
+    from timeit import repeat
+    from sklearn.neural_network import MLPRegressor
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    parser = ArgumentParser(description='Benchmark MLPRegressor.predict vs. FrozenMLP.predict.')
+    parser.add_argument('-b', '--batch-sizes', type=int, nargs='+', default=[1, 64, 4096],
+                        help='Numbers of rows per call.')
+    parser.add_argument('-l', '--layers', type=int, nargs='+', default=[32, 32],
+                        help='Hidden layer sizes.')
+    args = parser.parse_args()
+
+    random = np.random.RandomState(0)
+    inputs = random.rand(1000, 7) * 50
+    pipeline = make_pipeline(StandardScaler(), MLPRegressor(hidden_layer_sizes=args.layers,
+                                                            max_iter=50))
+    pipeline.fit(inputs, random.rand(1000, 3))
+    models = (('sklearn pipeline', pipeline), ('FrozenMLP float64', freeze(pipeline)),
+              ('FrozenMLP float32', freeze(pipeline, dtype=np.float32)))
+    for batch_size in args.batch_sizes:
+        X = random.rand(batch_size, 7) * 50
+        expected = pipeline.predict(X)
+        for name, model in models:
+            number = max(20000 // batch_size, 5)
+            latency = min(repeat(lambda: model.predict(X), number=number, repeat=3)) / number
+            error = np.abs(model.predict(X) - expected).max()
+            print('{:>17} batch {:>5}: {:9.1f} us/call, max error {:.1e}'.format(
+                  name, batch_size, latency * 1e6, error))
@@ -0,0 +1,114 @@
+"""
+Scheduling of periodic tasks, like control actions, on wall-clock aligned
+intervals.
+"""
+
+import math
+import random
+import time
+from typing import NamedTuple
+
+
+
+class Tick(NamedTuple):
+    """
+    A scheduled cycle of a periodic task.
+    """
+    due: float          # Scheduled UNIX time of the cycle
+    start: float        # UNIX time the cycle actually started
+    lateness: float     # start - due, in seconds
+    missed: int         # Number of ticks skipped since the previous cycle
+
+
+
+class IntervalScheduler:
+    """
+    Schedules ticks at multiples of `interval` seconds since the UNIX epoch,
+    shifted by an offset, so ticks stay pinned to wall-clock boundaries (e.g.
+    every :00, :10 minutes for a 600s interval) regardless of how long each
+    cycle takes. The first tick is due immediately at `start()`.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between ticks. May be changed between cycles.
+    offset : float, optional
+        Seconds past each boundary to schedule ticks at, by default 0.
+    jitter : float, optional
+        Maximum random seconds added to the offset, drawn once per scheduler
+        so that schedulers with different seeds do not tick at the same
+        instant. By default 0.
+    missed : str, optional
+        What to do when a cycle overruns one or more ticks. 'skip' schedules
+        the next tick at the first boundary in the future, 'catchup' runs
+        the overrun ticks back-to-back. By default 'skip'.
+    seed : Any, optional
+        Seed for the jitter, e.g. the name of the controller. By default None.
+    clock : Callable[[], float], optional
+        Function returning the UNIX time, by default `time.time`.
+    """
+
+
+    def __init__(self, interval: float, offset: float=0., jitter: float=0.,
+                 missed: str='skip', seed=None, clock=time.time):
+        if missed not in ('skip', 'catchup'):
+            raise ValueError('missed must be one of "skip", "catchup".')
+        self.interval = interval
+        self.offset = offset
+        self.jitter = random.Random(seed).uniform(0., jitter)
+        self.missed = missed
+        self.clock = clock
+        self.due = None
+        self._missed = 0
+
+
+    @property
+    def phase(self) -> float:
+        return (self.offset + self.jitter) % self.interval
+
+
+    def boundary_after(self, t: float) -> float:
+        """
+        Returns the first tick boundary strictly after time `t`.
+        """
+        # Tolerance so that `t` on a boundary is not rounded down to it
+        k = math.floor((t - self.phase) / self.interval + 1e-9) + 1
+        return self.phase + k * self.interval
+
+
+    def start(self):
+        """
+        Schedules the first tick immediately.
+        """
+        self.due = self.clock()
+        self._missed = 0
+
+
+    def begin(self) -> Tick:
+        """
+        Marks the start of the cycle for the due tick, and returns its timing.
+        """
+        if self.due is None:
+            self.start()
+        now = self.clock()
+        tick = Tick(due=self.due, start=now, lateness=now - self.due, missed=self._missed)
+        self._missed = 0
+        return tick
+
+
+    def advance(self) -> float:
+        """
+        Schedules the next tick after the current one, and returns the seconds
+        left until it is due.
+        """
+        if self.due is None:
+            self.start()
+            return 0.
+        now = self.clock()
+        due = self.boundary_after(self.due)
+        if due <= now and self.missed == 'skip':
+            following = self.boundary_after(now)
+            self._missed = int(round((following - due) / self.interval))
+            due = following
+        self.due = due
+        return max(due - now, 0.)
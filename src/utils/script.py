@@ -5,6 +5,8 @@ from argparse import ArgumentParser
 import sys
 import os
 import logging
+import subprocess
+from typing import List
 
 
 
@@ -15,6 +17,59 @@ def restart():
     os.execv(sys.executable, ['python'] + sys.argv)
 
 
+
+def profile_imports(flag: str='--profile-imports', top: int=15) -> int:
+    """
+    Re-runs the calling python script with the same arguments, except `flag`,
+    under `python -X importtime`, and prints a summary of the time spent
+    importing modules: the slowest top level imports (including their own
+    imports), and the slowest modules by their own import time. Use with
+    e.g. `--dry-run` to measure the cold start of a script.
+
+    Parameters
+    ----------
+    flag : str, optional
+        The command line flag which requested profiling, removed from the
+        arguments, by default '--profile-imports'.
+    top : int, optional
+        Number of modules listed in each part of the summary, by default 15.
+
+    Returns
+    -------
+    int
+        The exit code of the script.
+    """
+    argv = [a for a in sys.argv if a != flag]
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + argv,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    # Lines are "import time: self [us] | cumulative | imported package",
+    # with the package name indented by its depth in the import tree.
+    imports, other = [], []
+    for line in proc.stderr.splitlines():
+        fields = line[len('import time:'):].split('|') if line.startswith('import time:') else ()
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            name = fields[2].rstrip()
+            depth = (len(name) - len(name.lstrip())) // 2
+            imports.append((int(fields[0]), int(fields[1]), depth, name.strip()))
+        else:
+            other.append(line)
+    if other:
+        print('\n'.join(other), file=sys.stderr)
+
+    def table(title: str, rows: List[tuple], key: int):
+        print(title)
+        for row in sorted(rows, key=lambda r: -r[key])[:top]:
+            print('  {:8.3f}s {:8.3f}s  {}'.format(row[0] / 1e6, row[1] / 1e6, row[3]))
+
+    # The top level of the tree is the least indented
+    depth = min((i[2] for i in imports), default=0)
+    print('Imported {} modules in {:.3f}s. Columns: self, cumulative time.'.format(
+          len(imports), sum(i[0] for i in imports) / 1e6))
+    table('Slowest top level imports:', [i for i in imports if i[2] == depth], key=1)
+    table('Slowest modules:', imports, key=0)
+    return proc.returncode
+
+
 if __name__=='__main__':
     parser = ArgumentParser()
     parser.add_argument('-r', '--restart', default=False, action='store_true')
@@ -0,0 +1,246 @@
+"""
+Local caching of time series trends downloaded from BDX. Only data newer than
+what is already cached is requested, and several trends can be fetched
+concurrently.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List
+import threading as th
+
+import numpy as np
+import pandas as pd
+
+
+
+def bdx_backend(trend_id, username, password, start, end, aggregation='Point') -> pd.DataFrame:
+    """
+    Default backend which gets trend data from the `bdx` package. `bdx` is
+    imported on first use so it is not needed for offline use.
+    """
+    import bdx
+    return bdx.get_trend(trend_id=trend_id, username=username, password=password,
+                         start=start, end=end, aggregation=aggregation)
+
+
+
+def _to_utc(value):
+    """
+    Returns a timestamp or a time-indexed dataframe in UTC. Naive times are
+    taken to already be in UTC.
+    """
+    if isinstance(value, pd.DataFrame):
+        index = pd.DatetimeIndex(value.index)
+        index = index.tz_localize('UTC') if index.tz is None else index.tz_convert('UTC')
+        return value.set_axis(index, axis=0)
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tz is None else value.tz_convert('UTC')
+
+
+
+class TrendCache:
+    """
+    An append-only, in-memory cache of trend data per trend ID. Requests for a
+    time range are served from the cache, and only data after the last cached
+    timestamp is requested from the backend.
+
+    Parameters
+    ----------
+    backend : Callable, optional
+        A function with the signature of `bdx.get_trend`:
+        `backend(trend_id, username, password, start, end, aggregation)`
+        returning a `pd.DataFrame` indexed by time. By default `bdx_backend`.
+    retention : timedelta, optional
+        How much history before the latest timestamp to keep per trend, by
+        default 3 days.
+    max_workers : int, optional
+        Maximum number of trends fetched concurrently, by default 4.
+    """
+
+
+    def __init__(self, backend: Callable=None, retention: timedelta=timedelta(days=3),
+                 max_workers: int=4):
+        self.backend = bdx_backend if backend is None else backend
+        self.retention = retention
+        self.max_workers = max_workers
+        self._frames = {}   # trend_id -> pd.DataFrame
+        self._covered = {}  # trend_id -> start of the time range in cache
+        self._locks = {}    # trend_id -> threading.Lock
+        self._lock = th.Lock()
+        self._executor = None
+
+
+    def _trend_lock(self, trend_id) -> th.Lock:
+        with self._lock:
+            return self._locks.setdefault(trend_id, th.Lock())
+
+
+    def __getitem__(self, trend_id) -> pd.DataFrame:
+        return self._frames[trend_id]
+
+
+    def __contains__(self, trend_id) -> bool:
+        return trend_id in self._frames
+
+
+    def fetch(self, trend_id, start: datetime, end: datetime, username: str=None,
+              password: str=None, aggregation: str='Point') -> pd.DataFrame:
+        """
+        Returns trend data between `start` and `end`, requesting from the backend
+        only what is not cached. Cached data is indexed in UTC; times without a
+        timezone, from the arguments or the backend, are taken to be in UTC.
+        """
+        start, end = _to_utc(start), _to_utc(end)
+        with self._trend_lock(trend_id):
+            cached = self._frames.get(trend_id)
+            covered = self._covered.get(trend_id)
+            if cached is None or covered is None or start < covered:
+                # Nothing usable in cache, get the whole range
+                new = _to_utc(self.backend(trend_id, username, password, start, end,
+                                           aggregation))
+                frame = new
+                self._covered[trend_id] = start
+            else:
+                if len(cached) > 0:
+                    # The last cached timestamp is requested again in case
+                    # it was incomplete. It is replaced by the new value.
+                    start_new = max(cached.index[-1], start)
+                else:
+                    start_new = start
+                new = _to_utc(self.backend(trend_id, username, password, start_new, end,
+                                           aggregation))
+                frame = pd.concat((cached, new)) if len(new) > 0 else cached
+            if len(new) > 0:
+                frame = frame[~frame.index.duplicated(keep='last')].sort_index()
+                if len(frame) > 0:
+                    earliest = frame.index[-1] - self.retention
+                    if earliest > self._covered[trend_id]:
+                        frame = frame[frame.index >= earliest]
+                        self._covered[trend_id] = earliest
+            self._frames[trend_id] = frame
+            return frame[(frame.index >= start) & (frame.index <= end)]
+
+
+    def fetch_many(self, trend_ids: Iterable, start: datetime, end: datetime, **kwargs) \
+        -> Dict[object, pd.DataFrame]:
+        """
+        Fetches several trends concurrently. See `fetch()`. Returns a dictionary
+        of trend IDs to trend data.
+        """
+        trend_ids = list(trend_ids)
+        if len(trend_ids) <= 1 or self.max_workers <= 1:
+            return {t: self.fetch(t, start, end, **kwargs) for t in trend_ids}
+        # The executor is kept so threads are not started on every call.
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='trends')
+        futures = [self._executor.submit(self.fetch, t, start, end, **kwargs) for t in trend_ids]
+        return {t: f.result() for t, f in zip(trend_ids, futures)}
+
+
+    def close(self):
+        """
+        Stops the threads used by `fetch_many()`.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+    def window(self, trend_id, size: int) -> pd.DataFrame:
+        """
+        Returns the last `size` cached rows of a trend.
+        """
+        frame = self._frames.get(trend_id)
+        if frame is None:
+            return pd.DataFrame()
+        return frame.iloc[-max(int(size), 1):]
+
+
+    def window_mean(self, trend_id, size: int) -> pd.Series:
+        """
+        Returns the mean of the last `size` cached rows of a trend.
+        """
+        return self.window(trend_id, size).mean(numeric_only=True)
+
+
+
+class FakeBackend:
+    """
+    An offline stand-in for BDX serving trends from dataframes. Each call is
+    recorded in `calls` as a tuple of (trend_id, start, end).
+
+    Parameters
+    ----------
+    trends : Dict[object, pd.DataFrame]
+        Trend data indexed by time for each trend ID.
+    now : Callable[[], datetime], optional
+        Function returning the current time. Data after it is not served, to
+        simulate data arriving over time. By default all data is served.
+    """
+
+
+    def __init__(self, trends: Dict[object, pd.DataFrame], now: Callable=None):
+        self.trends = trends
+        self.now = now
+        self.calls: List[tuple] = []
+
+
+    def __call__(self, trend_id, username, password, start, end, aggregation='Point') \
+        -> pd.DataFrame:
+        self.calls.append((trend_id, start, end))
+        frame = self.trends[trend_id]
+        if self.now is not None:
+            end = min(_to_utc(end), _to_utc(self.now()))
+        # Compare in the timezone of the data, which may be naive
+        start, end = _to_utc(start), _to_utc(end)
+        if frame.index.tz is None:
+            start, end = start.tz_localize(None), end.tz_localize(None)
+        return frame[(frame.index >= start) & (frame.index <= end)].copy()
+
+
+    @classmethod
+    def random(cls, trend_ids: Iterable, columns: Iterable[str], start: datetime,
+               end: datetime, freq: str='5min', seed=None, **kwargs) -> 'FakeBackend':
+        """
+        Creates a backend with random data for each trend ID and column at a
+        regular frequency between `start` and `end`.
+        """
+        random = np.random.RandomState(seed)
+        index = pd.date_range(start, end, freq=freq)
+        columns = list(columns)
+        trends = {t: pd.DataFrame(random.rand(len(index), len(columns)), index=index,
+                                  columns=columns) for t in trend_ids}
+        return cls(trends, **kwargs)
+
+
+
+if __name__ == '__main__':
+    # Checks caching against a backend serving naive and tz-aware timestamps:
+    # python -m utils.trends
+    from argparse import ArgumentParser
+    import pytz
+
+    parser = ArgumentParser(description='Check TrendCache against a fake backend.')
+    parser.add_argument('-d', '--days', type=float, default=1.,
+                        help='Days of data to fetch, in steps of an hour.')
+    args = parser.parse_args()
+
+    now = datetime.now(pytz.utc).replace(second=0, microsecond=0)
+    begin = now - timedelta(days=args.days)
+    for naive in (True, False):
+        backend = FakeBackend.random(['trend'], ['value'], begin, now, seed=0)
+        if naive:
+            backend.trends['trend'].index = backend.trends['trend'].index.tz_localize(None)
+        expected = _to_utc(backend.trends['trend'])
+        cache = TrendCache(backend=backend)
+        t = begin
+        while t < now:
+            t = min(t + timedelta(hours=1), now)
+            frame = cache.fetch('trend', begin, t)
+            assert frame.equals(expected[expected.index <= t]), 'Mismatch at {}'.format(t)
+        print('{} index: {} fetches, {} rows in cache'.format(
+              'naive' if naive else 'UTC', len(backend.calls), len(cache['trend'])))